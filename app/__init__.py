@@ -3,11 +3,16 @@ Package: app
 Package for the application models and services
 This module also sets up the logging to be used with gunicorn
 """
+import os
 import logging
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-import ibm_db_sa
-from app.vcap_services import get_database_uri
+from app.vcap_services import get_database_uri, get_pool_options
+from app.cache import create_cart_cache
+from app.coalescing import WriteCoalescer
+from app.serialization import create_serializer
+from app.metrics import RequestMetrics
+from app.slow_queries import SlowQueryLog
+from app.pool import PooledSQLAlchemy
 # Create Flask application
 app = Flask(__name__)
 
@@ -17,13 +22,62 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'please, tell nobody... Shhhh'
 app.config['LOGGING_LEVEL'] = logging.INFO
 
+# Connection pool of server databases, see DB_POOL_* in .sample-env
+app.config['SQLALCHEMY_POOL_OPTIONS'] = get_pool_options()
+
+# Read-through cache of serialized shopcarts
+app.config['CART_CACHE_ENABLED'] = (os.getenv('CART_CACHE_ENABLED', 'False') == 'True')
+app.config['CART_CACHE_BACKEND'] = os.getenv('CART_CACHE_BACKEND', 'memory')
+app.config['CART_CACHE_REDIS_URL'] = os.getenv('CART_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+app.config['CART_CACHE_SIZE'] = int(os.getenv('CART_CACHE_SIZE', '1024'))
+app.config['CART_CACHE_TTL'] = float(os.getenv('CART_CACHE_TTL', '30'))
+
+# Write-behind buffer merging the adds of the same product, see app/coalescing.py
+app.config['WRITE_COALESCE_ENABLED'] = (os.getenv('WRITE_COALESCE_ENABLED', 'False') == 'True')
+app.config['WRITE_COALESCE_WINDOW'] = float(os.getenv('WRITE_COALESCE_WINDOW', '0.05'))
+app.config['WRITE_COALESCE_MAX_PENDING'] = int(os.getenv('WRITE_COALESCE_MAX_PENDING', '1000'))
+app.config['WRITE_COALESCE_MAX_ATTEMPTS'] = int(os.getenv('WRITE_COALESCE_MAX_ATTEMPTS', '3'))
+
+# JSON encoder of the responses: ujson, json or auto for the fastest installed
+app.config['JSON_BACKEND'] = os.getenv('JSON_BACKEND', 'auto')
+
+# Per route request metrics served at /metrics
+app.config['METRICS_ENABLED'] = (os.getenv('METRICS_ENABLED', 'True') == 'True')
+
+# Slow statements kept for /admin/slow-queries, with the plans of a sample of them
+app.config['SLOW_QUERY_ENABLED'] = (os.getenv('SLOW_QUERY_ENABLED', 'False') == 'True')
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.5'))
+app.config['SLOW_QUERY_EXPLAIN_RATE'] = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+app.config['SLOW_QUERY_BUFFER'] = int(os.getenv('SLOW_QUERY_BUFFER', '100'))
+app.config['SLOW_QUERY_PARAMETERS'] = (os.getenv('SLOW_QUERY_PARAMETERS', 'False') == 'True')
+app.config['SLOW_QUERY_ADMIN_TOKEN'] = os.getenv('SLOW_QUERY_ADMIN_TOKEN', '')
+
+# Log records written by a background thread, see app/logs.py
+app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json')
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+app.config['LOG_SAMPLE_RATES'] = os.getenv('LOG_SAMPLE_RATES', '')
+
 # Initialize SQLAlchemy
-db = SQLAlchemy(app)
+db = PooledSQLAlchemy(app)
+
+# Initialize the shopcart cache
+cart_cache = create_cart_cache(app)
+
+# Initialize the write coalescer
+write_coalescer = WriteCoalescer(app)
+
+# Initialize the response serializer
+serializer = create_serializer(app)
+
+# Initialize the request metrics
+metrics = RequestMetrics(app)
+
+# Initialize the slow query log
+slow_queries = SlowQueryLog(app)
 
 from app import service, model
 
 # Set up logging for production
-print 'Setting up logging for {}...'.format(__name__)
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
     if gunicorn_logger:
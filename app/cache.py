@@ -0,0 +1,264 @@
+"""
+Cart Cache
+
+Read-through cache for serialized shopcarts, keyed by user_id.
+Every write made through the Shopcart model invalidates the entry of the
+user it touched.
+
+Backends
+--------
+CartCache - entries live in process memory, are evicted least recently
+            used first once the cache is full and expire after a time to live
+RedisCartCache - entries live in a Redis server shared by every worker and
+                 are invalidated with per-user version counters
+
+Configuration:
+--------------
+CART_CACHE_ENABLED (bool) - turns the cache on or off
+CART_CACHE_BACKEND (str)  - 'memory' or 'redis'
+CART_CACHE_SIZE (int)     - maximum number of shopcarts kept in memory
+CART_CACHE_TTL (float)    - seconds before an entry expires
+CART_CACHE_REDIS_URL (str) - where the Redis server is, e.g. redis://localhost:6379/0
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# How many times the entry TTL a version counter of the Redis cache lives
+VERSION_TTL_FACTOR = 10
+
+
+def create_cart_cache(app):
+    """ Creates the cart cache backend selected by CART_CACHE_BACKEND """
+    if app.config.get('CART_CACHE_BACKEND') == 'redis':
+        return RedisCartCache(app)
+    return CartCache(app)
+
+
+class CartCache(object):
+    """ Bounded LRU cache with a time to live for serialized shopcarts """
+
+    def __init__(self, app=None, maxsize=1024, ttl=30.0, enabled=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Reads the cache settings from the Flask configuration """
+        self.enabled = app.config.get('CART_CACHE_ENABLED', self.enabled)
+        self.maxsize = app.config.get('CART_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('CART_CACHE_TTL', self.ttl)
+
+    def get(self, key):
+        """ Returns the cached value of <key> or None if it is not cached """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            # put it back as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def get_or_load(self, key, loader):
+        """ Returns the cached value of <key>, calling <loader> to build it on a miss
+
+        The loaded value is only stored if nothing was invalidated while it
+        was being loaded, so a concurrent write can't be hidden by stale data
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        invalidations = self._invalidations
+        value = loader()
+        with self._lock:
+            if invalidations == self._invalidations:
+                self._store(key, value)
+        return value
+
+    def set(self, key, value):
+        """ Stores <value> as the cached value of <key> """
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """ Removes <key> from the cache """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the size and the hit, miss and eviction counters of the cache """
+        return {'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _store(self, key, value):
+        """ Stores an entry and evicts the least recently used ones; needs the lock """
+        if not self.enabled:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time() + self.ttl)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class RedisCartCache(object):
+    """ Cache for serialized shopcarts shared by every worker through Redis
+
+    Each user has a version counter that every write increments, and
+    shopcarts are stored under the version they were read at. A worker
+    never sees a shopcart written before the last invalidation, whichever
+    worker made it, and old versions simply expire. The counters expire too,
+    VERSION_TTL_FACTOR times later than the entries, so idle users don't
+    keep a key each forever; a new version is a random token rather than
+    an increment so a counter that expired never brings an old entry back.
+    When the server can't be reached the cache is skipped and reads go to
+    the database.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app=None, url='redis://localhost:6379/0', ttl=30.0,
+                 enabled=False, retry_interval=5.0, prefix='shopcart'):
+        self.url = url
+        self.ttl = ttl
+        self.enabled = enabled
+        self.retry_interval = retry_interval
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._client = None
+        self._down_until = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Reads the cache settings from the Flask configuration """
+        self.enabled = app.config.get('CART_CACHE_ENABLED', self.enabled)
+        self.ttl = app.config.get('CART_CACHE_TTL', self.ttl)
+        self.url = app.config.get('CART_CACHE_REDIS_URL', self.url)
+        self._client = None
+
+    @property
+    def client(self):
+        """ The Redis client, created on first use """
+        if self._client is None:
+            import redis
+            self._client = redis.StrictRedis.from_url(self.url, socket_timeout=0.5,
+                                                      socket_connect_timeout=0.5)
+        return self._client
+
+    def get(self, key):
+        """ Returns the cached value of <key> or None if it is not cached """
+        return self._get(key)[0]
+
+    def get_or_load(self, key, loader):
+        """ Returns the cached value of <key>, calling <loader> to build it on a miss
+
+        The loaded value is stored under the version read before loading, so
+        it is never served if a write invalidated <key> in the meantime
+        """
+        value, entry_key = self._get(key)
+        if value is not None:
+            return value
+        value = loader()
+        if entry_key is not None:
+            self._call(self.client.setex, entry_key, int(max(self.ttl, 1)),
+                       json.dumps(value))
+        return value
+
+    def set(self, key, value):
+        """ Stores <value> as the cached value of <key> """
+        entry_key = self._get(key)[1]
+        if entry_key is not None:
+            self._call(self.client.setex, entry_key, int(max(self.ttl, 1)),
+                       json.dumps(value))
+
+    def invalidate(self, key):
+        """ Makes every worker miss <key> by giving it a new version """
+        if self.enabled:
+            self._call(self.client.setex, self._version_key(key),
+                       int(max(self.ttl, 1) * VERSION_TTL_FACTOR), uuid.uuid4().hex)
+
+    def clear(self):
+        """ Makes every worker miss every key by bumping the generation """
+        if self.enabled:
+            self._call(self.client.incr, self._generation_key())
+
+    def stats(self):
+        """ Returns the hit, miss and error counters of this worker """
+        return {'enabled': self.enabled,
+                'backend': 'redis',
+                'available': self._down_until <= time.time(),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors}
+
+    def _get(self, key):
+        """ Returns the cached value of <key> and the key it is stored under """
+        if not self.enabled:
+            return None, None
+        versions = self._call(self.client.mget, self._generation_key(),
+                              self._version_key(key))
+        if versions is None:
+            return None, None
+        generation, version = int(versions[0] or 0), versions[1] or 0
+        entry_key = '{}:cart:{}:{}:{}'.format(self.prefix, generation, key, version)
+        data = self._call(self.client.get, entry_key)
+        if data is None:
+            self.misses += 1
+            return None, entry_key
+        self.hits += 1
+        return json.loads(data), entry_key
+
+    def _call(self, command, *args):
+        """ Runs a Redis command, or returns None while the server is unreachable """
+        if self._down_until > time.time():
+            return None
+        import redis
+        try:
+            if self._down_until:
+                # invalidations may have been missed while it was down
+                self.client.incr(self._generation_key())
+            result = command(*args)
+        except redis.RedisError as error:
+            self.errors += 1
+            self._down_until = time.time() + self.retry_interval
+            self.logger.warning('Cart cache unavailable, reading from the database: %s', error)
+            return None
+        self._down_until = 0
+        return result
+
+    def _version_key(self, key):
+        return '{}:version:{}'.format(self.prefix, key)
+
+    def _generation_key(self):
+        return '{}:generation'.format(self.prefix)
@@ -0,0 +1,280 @@
+"""
+Write Coalescer
+
+Optional write-behind buffer for the quantity increments of POST /shopcarts.
+Adds of the same (user_id, product_id) made within a short window are
+merged into one line, and a background thread (a greenlet under gevent)
+writes the lines of the window with one upsert transaction per user, so a
+burst of "+1" clicks or retries costs one write instead of one each.
+
+A line whose write fails is tried again in the next window and dropped
+after WRITE_COALESCE_MAX_ATTEMPTS failures. It is kept apart from the adds
+made meanwhile, which are written in a transaction of their own and count
+their own attempts, so a line that keeps failing never takes adds that
+were not tried yet down with it. The dropped lines are logged and the last
+of them kept in dead_letters.
+
+Every add is written at most about one window after it was made, and the
+buffer is written when the worker exits. Only the writer writes, with a
+session of its own. Reads of a user through the Shopcart model wake it and
+wait until the lines of that user pending at the time are written, so a
+worker reads its own writes. A transaction that locked a shopcart does not
+wait, as the writer may need that lock, so reads made after the lock see
+only what was written before it. Other workers see the adds once they are
+written. The coalescing ratio is the number of adds per line written.
+
+Configuration:
+--------------
+WRITE_COALESCE_ENABLED (bool)    - buffer the adds, False by default
+WRITE_COALESCE_WINDOW (float)    - seconds an add may wait before it is written
+WRITE_COALESCE_MAX_PENDING (int) - lines pending before they are written early
+WRITE_COALESCE_MAX_ATTEMPTS (int) - failed writes of a line before it is dropped
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+# Number of dropped lines kept for inspection
+DEAD_LETTERS = 100
+
+
+class WriteCoalescer(object):
+    """ Buffer that merges the increments of the same shopcart line """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app=None, window=0.05, max_pending=1000, enabled=False,
+                 flush_timeout=10.0, max_attempts=3):
+        self.app = None
+        self.window = window
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.enabled = enabled
+        self.flush_timeout = flush_timeout
+        self.pending = {}
+        self.adds = 0
+        self.writes = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dead_letters = deque(maxlen=DEAD_LETTERS)
+        self.dropped = 0
+        # the users of the lines the writer is writing, and its passes so far
+        self._in_flight = set()
+        self._started = 0
+        self._completed = 0
+        self._lock = threading.Condition()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Reads the coalescer settings from the Flask configuration """
+        self.app = app
+        self.enabled = app.config.get('WRITE_COALESCE_ENABLED', self.enabled)
+        self.window = app.config.get('WRITE_COALESCE_WINDOW', self.window)
+        self.max_pending = app.config.get('WRITE_COALESCE_MAX_PENDING', self.max_pending)
+        self.max_attempts = app.config.get('WRITE_COALESCE_MAX_ATTEMPTS', self.max_attempts)
+        atexit.register(self.stop)
+
+    def add(self, values, max_quantity=None):
+        """ Buffers an increment of a shopcart line
+
+        Lines are keyed by (user_id, product_id, attempts), so the adds are
+        merged with the others not tried yet, never with a line that failed
+
+        Args:
+            values (dict): statement parameters from Shopcart._entry_values
+            max_quantity (int): refuse the add if the pending quantity would exceed it
+
+        Returns:
+            dict: a copy of the line of the adds not tried yet, with the price
+            of the first add and the quantity of every add of the key still
+            pending, including those of lines that failed
+        """
+        key = (values['user_id'], values['product_id'], 0)
+        with self._lock:
+            retried = sum(self.pending[retry]['quantity'] for retry in self._retries(key))
+            line = self.pending.get(key)
+            quantity = retried + values['quantity'] + (line['quantity'] if line else 0)
+            if max_quantity is not None and quantity > max_quantity:
+                raise ValueError('the quantity added is over {}'.format(max_quantity))
+            if line is None:
+                line = self.pending[key] = dict(values, attempts=0)
+            else:
+                line['quantity'] += values['quantity']
+            self.adds += 1
+            line = dict(line, quantity=quantity)
+            del line['attempts']
+            full = len(self.pending) >= self.max_pending
+        self._start()
+        if full:
+            self._wake.set()
+        return line
+
+    def flush(self, user_ids=None):
+        """ Has the background writer write the lines of <user_ids>, or all of
+        them, pending now and waits until it did
+
+        The writer uses its own connection, so the transaction of the caller
+        is left alone. It may wait for locks held by requests, so never call
+        this while the transaction of the caller holds one, see
+        model.read_own_writes
+
+        Returns:
+            bool: False if the lines were not written within flush_timeout
+        """
+        if not self.pending and not self._in_flight:
+            return True
+        if threading.current_thread() is self._thread:
+            return True
+        with self._lock:
+            target = self._target(user_ids)
+        if target is None:
+            return True
+        self._start()
+        self._wake.set()
+        deadline = time.time() + self.flush_timeout
+        with self._lock:
+            while self._completed < target:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.logger.warning('Gave up waiting for the buffered adds of %s',
+                                        user_ids if user_ids is not None else 'every user')
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def stats(self):
+        """ Returns the counters of the coalescer """
+        with self._lock:
+            return {'enabled': self.enabled,
+                    'pending': len(self.pending),
+                    'adds': self.adds,
+                    'writes': self.writes,
+                    'flushes': self.flushes,
+                    'failures': self.failures,
+                    'dropped': self.dropped,
+                    'ratio': float(self.adds) / self.writes if self.writes else 0.0}
+
+    def stop(self):
+        """ Stops the background writer once it wrote what is still pending """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        elif self.pending and self.app is not None:
+            with self.app.app_context():
+                while self.pending:
+                    self._write_pending()
+        self._stopped = False
+        self._wake.clear()
+
+######################################################################
+#  B A C K G R O U N D   W R I T E R
+######################################################################
+
+    def _retries(self, key):
+        """ Returns the keys of the failed lines pending for the product of
+        <key>; needs the lock """
+        return [retry for retry in ((key[0], key[1], attempts)
+                                    for attempts in range(1, self.max_attempts))
+                if retry in self.pending]
+
+    def _target(self, user_ids):
+        """ Returns the pass of the writer that writes the lines of <user_ids>
+        pending or in flight now, or None if there are none; needs the lock """
+        if user_ids is None:
+            waiting, in_flight = bool(self.pending), bool(self._in_flight)
+        else:
+            user_ids = set(int(user_id) for user_id in user_ids)
+            waiting = any(key[0] in user_ids for key in self.pending)
+            in_flight = bool(user_ids & self._in_flight)
+        if waiting:
+            return self._started + 1
+        if in_flight:
+            return self._started
+        return None
+
+    def _start(self):
+        """ Starts the background writer of this process if it is not running """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                # threads don't survive a fork, so a worker starts its own
+                self._thread = threading.Thread(target=self._run, name='write-coalescer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._stopped:
+                self._wake.wait(self.window)
+            self._wake.clear()
+            if self.pending:
+                with self.app.app_context():
+                    self._write_pending()
+            # lines that failed are dropped after max_attempts, so this ends
+            if self._stopped and not self.pending:
+                break
+
+    def _write_pending(self):
+        """ Writes every pending line, in one transaction of the writer's session
+        per user and number of attempts, so a line that fails doesn't hold back
+        the others and the lines tried before are written first """
+        with self._lock:
+            batch, self.pending = self.pending, {}
+            self._in_flight = set(key[0] for key in batch)
+            self._started += 1
+        groups = {}
+        for key, line in batch.items():
+            groups.setdefault((key[0], -key[2]), []).append(line)
+        try:
+            for group in sorted(groups):
+                self._write_user(group[0], groups[group])
+        finally:
+            with self._lock:
+                self._in_flight = set()
+                self._completed += 1
+                self._lock.notify_all()
+
+    def _write_user(self, user_id, lines):
+        """ Upserts the lines of a user, putting them back if that fails """
+        from app.model import Shopcart
+        from app import db
+        try:
+            Shopcart.apply_increments([dict((column, line[column]) for column in
+                                            ('user_id', 'product_id', 'quantity', 'price'))
+                                       for line in lines])
+        except Exception as error:  # pylint: disable=broad-except
+            db.session.rollback()
+            self.logger.error('Could not write the buffered adds of user %s: %s', user_id, error)
+            with self._lock:
+                self.failures += 1
+                for line in lines:
+                    self._retry(line)
+            return
+        finally:
+            db.session.remove()
+        with self._lock:
+            self.writes += len(lines)
+            self.flushes += 1
+
+    def _retry(self, line):
+        """ Puts a line that failed back in the buffer, apart from the adds
+        made since, or drops it after max_attempts; needs the lock """
+        line['attempts'] += 1
+        if line['attempts'] < self.max_attempts:
+            # the lines of a pass have distinct attempts, so the key is free
+            self.pending[(line['user_id'], line['product_id'], line['attempts'])] = line
+            return
+        self.logger.error('Dropped the buffered add of %s x product %s for user %s '
+                          'after %s failed writes', line['quantity'], line['product_id'],
+                          line['user_id'], line['attempts'])
+        self.dropped += 1
+        self.dead_letters.append(line)
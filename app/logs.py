@@ -0,0 +1,172 @@
+"""
+Asynchronous Logging
+
+Moves writing the log off the request path: the handlers of the loggers
+only put the records on a bounded queue, and a background thread (a
+greenlet under gevent) formats them and writes them to the real handler.
+A full queue drops records rather than making a request wait, and counts
+what it dropped.
+
+Records are written one JSON object per line, with the method and route
+of the request that logged them. Chatty levels can be sampled so only a
+fraction of their records are kept; WARNING and above always are.
+
+Configuration:
+--------------
+LOG_FORMAT (str)       - json, or text for the classic one line format
+LOG_QUEUE_SIZE (int)   - records waiting to be written before new ones are dropped
+LOG_SAMPLE_RATES (str) - fraction of the records kept per level, e.g. DEBUG=0,INFO=0.1
+"""
+import json
+import random
+import logging
+import threading
+from Queue import Queue, Full
+from datetime import datetime
+from flask import has_request_context, request
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+# Levels that are never sampled out
+UNSAMPLED_LEVEL = logging.WARNING
+
+
+def parse_sample_rates(text):
+    """ Returns {level number: rate} from a 'LEVEL=rate,...' string """
+    rates = {}
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition('=')
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown log level in LOG_SAMPLE_RATES: {}'.format(name))
+        rates[level] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps a fraction of the records of the sampled levels """
+
+    def __init__(self, rates):
+        logging.Filter.__init__(self)
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= UNSAMPLED_LEVEL:
+            return True
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a single line JSON object """
+
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'module': record.module,
+                 'message': record.getMessage()}
+        for key in ('method', 'route'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class QueueHandler(logging.Handler):
+    """ Handler that puts the records on a queue without waiting """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Freezes what the record needs from this thread before it is queued """
+        # the arguments may change or the request end before the record is written
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule is not None else request.path
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """ Writes the records of a queue to a handler on a background thread """
+
+    _sentinel = None
+
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self._thread = None
+
+    def start(self):
+        """ Starts writing the records """
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Writes the records still queued and stops """
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+        self.handler.flush()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
+
+
+class AsyncLogging(object):
+    """ The queue, handler and listener that log the records of some loggers """
+
+    def __init__(self, handler, loggers, queue_size=10000, sample_rates=None):
+        self.loggers = loggers
+        self.queue = Queue(queue_size)
+        self.handler = QueueHandler(self.queue)
+        if sample_rates:
+            self.handler.addFilter(SamplingFilter(sample_rates))
+        self.listener = QueueListener(self.queue, handler)
+
+    def start(self):
+        """ Replaces the handlers of the loggers with the queue """
+        self.listener.start()
+        for logger in self.loggers:
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.addHandler(self.handler)
+
+    def stop(self):
+        """ Detaches the queue from the loggers and writes what it holds """
+        for logger in self.loggers:
+            logger.removeHandler(self.handler)
+        self.listener.stop()
+
+    def stats(self):
+        """ Returns the size of the queue and the records it dropped """
+        return {'queued': self.queue.qsize(), 'dropped': self.handler.dropped}
@@ -0,0 +1,242 @@
+"""
+Request Metrics
+
+Records for every route template the latency of its requests, how many SQL
+statements they ran and how long those took, the rows their writes changed
+and their reads returned, and the size of the responses, and renders them in
+the Prometheus text format. Recording takes a few clock reads and counter updates, so it
+is cheap enough to leave on in production.
+
+Statements are timed with the cursor events of every SQLAlchemy engine and
+counted against the request running on the same thread or greenlet.
+Only the rows of writes are counted there: for a SELECT the rowcount of the
+drivers is -1 (SQLite, server side cursors) or unknown until it is read, so
+the model reports the rows it reads with count_rows().
+Streamed responses are recorded once their last chunk is produced. Every
+gunicorn worker keeps its own counters, like the pool and cache stats.
+
+Configuration:
+--------------
+METRICS_ENABLED (bool) - record the requests, True by default
+"""
+import time
+import threading
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Statements whose rowcount is the number of rows they changed
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'MERGE')
+
+
+class Histogram(object):
+    """ Counts of observations under each bucket bound, with their sum """
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """ Adds one observation; needs the lock of the metrics """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        """ Yields the sample lines of the histogram with cumulative buckets """
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, total)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, total)
+
+
+class RouteMetrics(object):
+    """ The metrics of the requests to one route """
+
+    __slots__ = ('duration', 'statements', 'db_time', 'rows_returned', 'response_bytes',
+                 'rows_changed', 'statuses')
+
+    def __init__(self):
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_time = Histogram(LATENCY_BUCKETS)
+        self.rows_returned = Histogram(ROWS_BUCKETS)
+        self.response_bytes = Histogram(BYTES_BUCKETS)
+        self.rows_changed = 0
+        self.statuses = {}
+
+
+class RequestStats(object):
+    """ What one request did so far """
+
+    __slots__ = ('start', 'statements', 'db_time', 'rows_changed', 'rows_returned',
+                 'response_bytes', 'status', 'route', 'recorded')
+
+    def __init__(self):
+        self.start = time.time()
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows_changed = 0
+        self.rows_returned = 0
+        self.response_bytes = 0
+        self.status = 500
+        self.route = None
+        self.recorded = False
+
+
+class RequestMetrics(object):
+    """ Flask extension that records the metrics of every request by route """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.routes = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Hooks the request and statement events """
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def clear(self):
+        """ Forgets everything recorded """
+        with self._lock:
+            self.routes = {}
+
+    @staticmethod
+    def count_rows(count):
+        """ Adds <count> rows read from the database to the running request """
+        if not has_request_context():
+            return
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.rows_returned += count
+
+    def render(self, gauges=None):
+        """ Returns the metrics in the Prometheus text format
+
+        Args:
+            gauges (dict): extra {name: {key: value}} stats to expose as gauges,
+                           numbers and booleans only
+        """
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines = []
+            for name, kind, help_text, metric in (
+                    ('shopcart_request_duration_seconds', 'histogram',
+                     'Time to answer a request', 'duration'),
+                    ('shopcart_request_db_statements', 'histogram',
+                     'SQL statements run by a request', 'statements'),
+                    ('shopcart_request_db_seconds', 'histogram',
+                     'Time a request spent running SQL statements', 'db_time'),
+                    ('shopcart_db_rows_returned', 'histogram',
+                     'Rows a request read from the database', 'rows_returned'),
+                    ('shopcart_response_bytes', 'histogram',
+                     'Size of the response body', 'response_bytes')):
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for (method, route), stats in routes:
+                    lines.extend(getattr(stats, metric).render(
+                        name, 'method="{}",route="{}"'.format(method, route)))
+            lines.append('# HELP shopcart_db_rows_changed_total Rows inserted, updated '
+                         'or deleted')
+            lines.append('# TYPE shopcart_db_rows_changed_total counter')
+            for (method, route), stats in routes:
+                lines.append('shopcart_db_rows_changed_total{{method="{}",route="{}"}} {}'.format(
+                    method, route, stats.rows_changed))
+            lines.append('# HELP shopcart_requests_total Requests answered by status')
+            lines.append('# TYPE shopcart_requests_total counter')
+            for (method, route), stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append('shopcart_requests_total{{method="{}",route="{}",'
+                                 'status="{}"}} {}'.format(method, route, status, count))
+        for prefix, stats in sorted((gauges or {}).items()):
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (bool, int, long, float)):
+                    name = 'shopcart_{}_{}'.format(prefix, key)
+                    lines.append('# TYPE {} gauge'.format(name))
+                    lines.append('{} {}'.format(name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+######################################################################
+#  R E Q U E S T   E V E N T S
+######################################################################
+
+    def _before_request(self):
+        if self.enabled:
+            g.request_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        stats.status = response.status_code
+        if response.is_streamed:
+            response.response = self._count_bytes(response.response, stats)
+        else:
+            stats.response_bytes = response.calculate_content_length() or 0
+        return response
+
+    @staticmethod
+    def _count_bytes(chunks, stats):
+        """ Passes the chunks of a streamed response on and adds up their size """
+        for chunk in chunks:
+            stats.response_bytes += len(chunk)
+            yield chunk
+
+    def _teardown_request(self, error=None):
+        stats = g.get('request_stats')
+        if stats is None or stats.recorded:
+            return
+        stats.recorded = True
+        rule = request.url_rule
+        key = (request.method, rule.rule if rule is not None else 'unmatched')
+        duration = time.time() - stats.start
+        with self._lock:
+            route = self.routes.get(key)
+            if route is None:
+                route = self.routes[key] = RouteMetrics()
+            route.duration.observe(duration)
+            route.statements.observe(stats.statements)
+            route.db_time.observe(stats.db_time)
+            route.rows_returned.observe(stats.rows_returned)
+            route.response_bytes.observe(stats.response_bytes)
+            route.rows_changed += stats.rows_changed
+            route.statuses[stats.status] = route.statuses.get(stats.status, 0) + 1
+
+######################################################################
+#  S T A T E M E N T   E V E N T S
+######################################################################
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.time()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('query_start', None)
+        if start is None or not has_request_context():
+            return
+        stats = g.get('request_stats')
+        if stats is None:
+            return
+        stats.statements += 1
+        stats.db_time += time.time() - start
+        if cursor.rowcount > 0 and statement.lstrip().upper().startswith(WRITES):
+            stats.rows_changed += cursor.rowcount
@@ -0,0 +1,181 @@
+"""
+Schema Migrations
+
+Versioned changes to the database schema, applied in order by manage.py
+and by service.init_db() when the server starts.
+Every version that was applied is recorded in the schema_migrations table,
+so each runs once per database, and every step checks the schema first so
+a database created by db.create_all() can be migrated too.
+
+A step is either an SQL statement, an index to create, or a function that
+makes the change itself. PostgreSQL builds indexes concurrently so the
+table stays writable meanwhile, DB2 allows writes during CREATE INDEX
+already, and SQLite locks the database for the short time it takes. A
+concurrent build that fails leaves an INVALID index behind, which is not
+counted as existing but dropped and built again.
+
+Migration 1 creates the tables with db.create_all(), which on a fresh
+database makes every index the models declare too. The later migrations
+that create such indexes only change the databases made before them, and
+are recorded as applied without doing anything on fresh ones.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import inspect, text
+from . import db
+from .model import Shopcart, CartTotal
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('description', db.String(200), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False))
+
+Migration = namedtuple('Migration', 'version description steps')
+
+# Whether the PostgreSQL index :name in the search path is usable
+PG_INDEX_VALID = text('SELECT i.indisvalid FROM pg_index i JOIN pg_class c '
+                      'ON c.oid = i.indexrelid '
+                      'WHERE c.relname = :name AND pg_table_is_visible(c.oid)')
+
+
+class CreateIndex(namedtuple('CreateIndex', 'name table columns')):
+    """ A step that creates an index unless the table has it already """
+
+    __slots__ = ()
+
+    def sql(self, dialect):
+        """ Returns the statement that creates the index on <dialect> """
+        concurrently = 'CONCURRENTLY ' if dialect.name == 'postgresql' else ''
+        return 'CREATE INDEX {}{} ON {} ({})'.format(
+            concurrently, self.name, self.table, ', '.join(self.columns))
+
+    def drop_sql(self):
+        """ Returns the statement that drops an invalid index on PostgreSQL """
+        return 'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(self.name)
+
+    def exists(self):
+        """ Returns True if the table has a usable index of this name """
+        if not db.engine.has_table(self.table):
+            return False
+        if db.engine.dialect.name == 'postgresql':
+            return self._valid() is True
+        return any(index['name'].lower() == self.name.lower()
+                   for index in inspect(db.engine).get_indexes(self.table))
+
+    def invalid(self):
+        """ Returns True if a failed concurrent build left an invalid index of
+        this name, which has to be dropped before it is built again """
+        return db.engine.dialect.name == 'postgresql' and self._valid() is False
+
+    def _valid(self):
+        """ Returns pg_index.indisvalid of the index, or None if there is none """
+        return db.engine.scalar(PG_INDEX_VALID, name=self.name.lower())
+
+
+def create_tables():
+    """ Create the tables of the models that do not exist yet """
+    summed = db.engine.has_table(CartTotal.__tablename__)
+    db.create_all()
+    if not summed:
+        # sum the shopcarts made before the cart_totals table
+        CartTotal.rebuild()
+
+def convert_prices():
+    """ Convert prices stored as floating point numbers into integer cents """
+    Shopcart.migrate_prices()
+
+def widen_totals():
+    """ Store the cart totals as BIGINT cents """
+    CartTotal.migrate_bigint()
+
+
+MIGRATIONS = (
+    Migration(1, 'Create the shopcart tables', [create_tables]),
+    Migration(2, 'Store prices as integer cents', [convert_prices]),
+    # the models declare these indexes, so create_all made them on fresh databases
+    Migration(3, 'Index shopcart lines by product and totals by value', [
+        CreateIndex('ix_shopcart_product_id', Shopcart.__tablename__, ['product_id']),
+        CreateIndex('ix_cart_totals_total_value', CartTotal.__tablename__, ['total_value'])]),
+    Migration(4, 'Store the cart totals as BIGINT', [widen_totals]),
+)
+
+######################################################################
+#  M I G R A T I O N   M E T H O D S
+######################################################################
+
+def applied_versions():
+    """ Returns the versions that were applied to the database """
+    if not db.engine.has_table(schema_migrations.name):
+        return set()
+    return set(row.version for row in db.session.execute(
+        schema_migrations.select().with_only_columns([schema_migrations.c.version])))
+
+def pending(target=None):
+    """ Returns the migrations up to version <target> that were not applied yet """
+    applied = applied_versions()
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied
+            and (target is None or migration.version <= target)]
+
+def describe(step):
+    """ Returns what <step> would do to the database """
+    if isinstance(step, CreateIndex):
+        if step.exists():
+            return '-- {} exists already'.format(step.name)
+        if step.invalid():
+            return '{}; {}'.format(step.drop_sql(), step.sql(db.engine.dialect))
+        return step.sql(db.engine.dialect)
+    if callable(step):
+        return '-- {}'.format(step.__doc__.strip())
+    return step
+
+def plan(target=None):
+    """ Returns (migration, statements) for every migration that would be applied """
+    return [(migration, [describe(step) for step in migration.steps])
+            for migration in pending(target)]
+
+def migrate(target=None):
+    """ Applies the pending migrations up to version <target> in order
+
+    Each migration is recorded in the transaction of its last step, so a
+    failed migration is run again from the start next time
+
+    Returns:
+        list: the migrations that were applied
+    """
+    schema_migrations.create(db.engine, checkfirst=True)
+    migrations = pending(target)
+    for migration in migrations:
+        logger.info('Applying migration %s: %s', migration.version, migration.description)
+        for step in migration.steps:
+            _apply(step)
+        db.session.execute(schema_migrations.insert(), {
+            'version': migration.version, 'description': migration.description,
+            'applied_at': datetime.utcnow()})
+        db.session.commit()
+    return migrations
+
+def _apply(step):
+    """ Makes the change of a single step """
+    if isinstance(step, CreateIndex):
+        if step.exists():
+            return
+        if db.engine.dialect.name == 'postgresql':
+            # concurrent index builds cannot run inside a transaction
+            db.session.commit()
+            with db.engine.connect() as connection:
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                if step.invalid():
+                    logger.warning('Rebuilding the invalid index %s', step.name)
+                    connection.execute(step.drop_sql())
+                connection.execute(step.sql(db.engine.dialect))
+            return
+        db.session.execute(step.sql(db.engine.dialect))
+    elif callable(step):
+        step()
+    else:
+        db.session.execute(step)
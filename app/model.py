@@ -19,22 +19,87 @@ All of the models are stored in this module
 Models
 ------
 Shopcart - A Shopcart used by each User
+CartTotal - The totals of the Shopcart of each User
 
 Attributes:
 -----------
 product_id (int)    - the product-id of a Product used to uniquely identify it
 user_id (int)       - the user-id of the User which uniquely identifies the User
 quantity (int)     - number of items User wants to buy of that particular product
-price(float)       - cost of one item of the Product
+price(Decimal)     - cost of one item of the Product, stored as integer cents
+
+CartTotal Attributes:
+---------------------
+user_id (int)           - the user-id of the User owning the Shopcart
+total_value (Decimal)   - sum of price * quantity over the Shopcart, in cents (BIGINT)
+item_count (int)        - sum of quantity over the Shopcart (BIGINT)
+line_count (int)        - number of products in the Shopcart
+last_modified (datetime) - when the Shopcart was last written
 
 """
 import os
 import json
 import logging
-from . import db
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import groupby
+from operator import attrgetter
+from . import db, cart_cache, metrics, write_coalescer
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import and_, bindparam, cast, event, func, inspect, select, text
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.sql import label
+from sqlalchemy.types import BigInteger, Integer, TypeDecorator
+
+# Upsert statements for the dialects that have no SQLAlchemy construct for it
+SQLITE_UPSERT = (
+    'INSERT INTO {table} (user_id, product_id, quantity, price) '
+    'VALUES (:user_id, :product_id, :quantity, :price) '
+    'ON CONFLICT (user_id, product_id) '
+    'DO UPDATE SET quantity = quantity + excluded.quantity'
+)
+SQLITE_RETURNING = ' RETURNING user_id, product_id, quantity, price'
+DB2_MERGE = (
+    'MERGE INTO {table} AS t '
+    'USING (VALUES (CAST(:user_id AS INTEGER), CAST(:product_id AS INTEGER), '
+    'CAST(:quantity AS INTEGER), CAST(:price AS INTEGER))) '
+    'AS s (user_id, product_id, quantity, price) '
+    'ON t.user_id = s.user_id AND t.product_id = s.product_id '
+    'WHEN MATCHED THEN UPDATE SET t.quantity = t.quantity + s.quantity '
+    'WHEN NOT MATCHED THEN INSERT (user_id, product_id, quantity, price) '
+    'VALUES (s.user_id, s.product_id, s.quantity, s.price)'
+)
+# Shopcart versions are the modification time of their totals to the microsecond
+VERSION_FORMAT = '%Y%m%d%H%M%S%f'
+# Converts the floating point prices of the shopcart table into integer cents
+MONEY_MIGRATION = (
+    'ALTER TABLE {table} RENAME COLUMN price TO price_float',
+    'ALTER TABLE {table} ADD COLUMN price INTEGER',
+    # PostgreSQL only rounds NUMERIC to a number of places, and DB2 defaults
+    # NUMERIC to 5 digits, so the floats are cast to a DECIMAL wide enough first
+    'UPDATE {table} SET price = '
+    'CAST(ROUND(CAST(price_float AS DECIMAL(31, 6)) * 100, 0) AS INTEGER)',
+    'ALTER TABLE {table} DROP COLUMN price_float',
+)
+# DB2 only allows a table to be used again once a dropped column was reorganized away
+DB2_REORG = "CALL SYSPROC.ADMIN_CMD('REORG TABLE {table}')"
+# Widen the sums of the totals to BIGINT, as one line may already be worth more than INTEGER
+BIGINT_TOTALS = {
+    'postgresql': ('ALTER TABLE {table} ALTER COLUMN total_value TYPE BIGINT, '
+                   'ALTER COLUMN item_count TYPE BIGINT',),
+    'ibm_db_sa': ('ALTER TABLE {table} ALTER COLUMN total_value SET DATA TYPE BIGINT '
+                  'ALTER COLUMN item_count SET DATA TYPE BIGINT', DB2_REORG),
+}
+CENT = Decimal('0.01')
+# Range of the INTEGER columns, prices included as they are stored in cents
+MIN_INTEGER = -2 ** 31
+MAX_INTEGER = 2 ** 31 - 1
+# Range of the BIGINT columns, the cart totals in cents among them
+MIN_BIGINT = -2 ** 63
+MAX_BIGINT = 2 ** 63 - 1
 
 ######################################################################
 # Custom Exceptions
@@ -45,6 +110,54 @@ class DataValidationError(ValueError):
 class DatabaseConnectionError(OSError):
     pass
 
+class Money(TypeDecorator):
+    """ An exact amount of money, stored as integer cents and read as a Decimal """
+
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Money.to_decimal(value) / CENT)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value) * CENT
+
+    @staticmethod
+    def to_decimal(value):
+        """ Converts an amount into a Decimal rounded to the cent """
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        if not value.is_finite():
+            raise InvalidOperation('{} is not an amount of money'.format(value))
+        return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+    @staticmethod
+    def to_float(value):
+        """ Converts an amount into a float for JSON """
+        if value is None:
+            return None
+        return float(Money.to_decimal(value))
+
+class BigMoney(Money):
+    """ An amount of money stored as BIGINT cents, for sums of line items """
+
+    impl = BigInteger
+
+class ShopcartRecord(namedtuple('ShopcartRecord', 'user_id product_id quantity price')):
+    """ A read-only Shopcart entry selected without building an ORM instance """
+
+    __slots__ = ()
+
+    def serialize(self):
+        """ Serializes a Shopcart entry into a dictionary """
+        return {"user_id": self.user_id,
+                "product_id": self.product_id,
+                "quantity": self.quantity,
+                "price": Money.to_float(self.price)}
+
 class Shopcart(db.Model):
     """
     Class that represents a Shopcart
@@ -57,15 +170,16 @@ class Shopcart(db.Model):
 
     # Table Schema
     user_id = db.Column(db.Integer,primary_key=True)
-    product_id = db.Column(db.Integer,primary_key=True)
+    product_id = db.Column(db.Integer,primary_key=True, index=True)
     quantity = db.Column(db.Integer)
-    price = db.Column(db.Float)
+    price = db.Column(Money)
 
     def save(self):
         """
         Saves a Shopcart to the data store
         """
         db.session.add(self)
+        CartTotal.refresh([self.user_id])
         db.session.commit()
 
     def serialize(self):
@@ -73,7 +187,7 @@ class Shopcart(db.Model):
         return {"user_id": self.user_id,
                 "product_id": self.product_id,
                 "quantity": self.quantity,
-                "price": self.price}
+                "price": Money.to_float(self.price)}
 
     def deserialize(self, data):
         """
@@ -97,8 +211,234 @@ class Shopcart(db.Model):
 
     def delete(self):
         """ Removes a Shopcart from the data store """
+        user_id = self.user_id
         db.session.delete(self)
+        CartTotal.refresh([user_id])
+        db.session.commit()
+
+    @staticmethod
+    def add_or_increment(user_id, product_id, quantity, price):
+        """ Adds a product to a shopcart or increases its quantity if it is already there
+
+        The change is made by one upsert statement in the database so two
+        concurrent adds of the same product never lose an update. The price of
+        an existing entry is kept.
+
+        Returns:
+            Shopcart: the entry as it is stored after the add
+        """
+        values = Shopcart._entry_values(user_id, product_id, quantity, price)
+        Shopcart.logger.info('Processing add for user id %s and product id %s ...',
+                             user_id, product_id)
+        table = Shopcart.__table__
+        CartTotal.lock([values['user_id']])
+        row = Shopcart._upsert([values], returning=True)
+        if row is None:
+            row = db.session.execute(table.select().where(
+                (table.c.user_id == values['user_id']) &
+                (table.c.product_id == values['product_id']))).fetchone()
+        Shopcart._check_quantities([row])
+        CartTotal.refresh([values['user_id']])
         db.session.commit()
+        return Shopcart._attach(row)
+
+    @staticmethod
+    def add_or_increment_later(user_id, product_id, quantity, price):
+        """ Buffers an add in the write coalescer instead of writing it now
+
+        Adds of the same product made within the window of the coalescer are
+        merged and written together by one upsert, see app/coalescing.py
+
+        Returns:
+            ShopcartRecord: the pending add, with the quantity of every add
+            of the product not written yet
+        """
+        values = Shopcart._entry_values(user_id, product_id, quantity, price)
+        try:
+            line = write_coalescer.add(values, max_quantity=MAX_INTEGER)
+        except ValueError as error:
+            raise DataValidationError('Invalid entry for Shopcart: {}'.format(error))
+        return ShopcartRecord(line['user_id'], line['product_id'],
+                              line['quantity'], line['price'])
+
+    @staticmethod
+    def apply_increments(lines):
+        """ Adds or increments the buffered <lines> in one transaction
+
+        Args:
+            lines (list): statement parameters from _entry_values, one per product
+        """
+        lines = list(lines)
+        Shopcart.logger.info('Writing %s buffered adds', len(lines))
+        user_ids = [line['user_id'] for line in lines]
+        CartTotal.lock(user_ids)
+        Shopcart._upsert(lines)
+        if db.engine.dialect.name == 'sqlite':
+            table = Shopcart.__table__
+            Shopcart._check_quantities(db.session.execute(table.select().where(
+                table.c.user_id.in_(user_ids) & (table.c.quantity > MAX_INTEGER))))
+        CartTotal.refresh(user_ids)
+        db.session.commit()
+
+    @staticmethod
+    def add_or_increment_many(user_id, lines):
+        """ Adds many products to the shopcart of user <user_id> in one transaction
+
+        Every line is validated before anything is written, then all of them
+        are upserted with a single batched statement
+
+        Args:
+            lines (list): dictionaries with the product_id, quantity and price of each line
+
+        Returns:
+            list: the resulting Shopcart entry of every line, in the same order
+        """
+        try:
+            params = [Shopcart._entry_values(user_id, line['product_id'],
+                                             line['quantity'], line['price'])
+                      for line in lines]
+        except KeyError as error:
+            raise DataValidationError('Invalid entry for Shopcart: missing ' + error.args[0])
+        except TypeError:
+            raise DataValidationError('Invalid entry for Shopcart: body of request contained ' \
+                                      'bad or no data')
+        Shopcart.logger.info('Processing add of %s products for user id %s ...',
+                             len(params), user_id)
+        if not params:
+            return []
+        table = Shopcart.__table__
+        CartTotal.lock([params[0]['user_id']])
+        Shopcart._upsert(params)
+        product_ids = set(values['product_id'] for values in params)
+        rows = db.session.execute(table.select().where(
+            (table.c.user_id == params[0]['user_id']) &
+            (table.c.product_id.in_(product_ids)))).fetchall()
+        Shopcart._check_quantities(rows)
+        CartTotal.refresh([params[0]['user_id']])
+        db.session.commit()
+        entries = dict((row['product_id'], Shopcart._attach(row)) for row in rows)
+        return [entries[values['product_id']] for values in params]
+
+    @staticmethod
+    def _entry_values(user_id, product_id, quantity, price):
+        """ Converts the columns of an entry into statement parameters
+
+        The ids and quantity must be whole numbers and every value has to fit
+        its INTEGER column, so a bad entry is refused here instead of failing
+        the statement that writes it, possibly long after in the write coalescer
+        """
+        try:
+            values = {'user_id': Shopcart._whole_number(user_id),
+                      'product_id': Shopcart._whole_number(product_id),
+                      'quantity': Shopcart._whole_number(quantity),
+                      'price': Money.to_decimal(price)}
+        except (TypeError, ValueError, OverflowError, InvalidOperation):
+            raise DataValidationError('Invalid entry for Shopcart: body of request contained ' \
+                                      'bad data')
+        columns = (values['user_id'], values['product_id'], values['quantity'],
+                   values['price'] / CENT)
+        if not all(MIN_INTEGER <= value <= MAX_INTEGER for value in columns):
+            raise DataValidationError('Invalid entry for Shopcart: a value is out of range')
+        return values
+
+    @staticmethod
+    def _whole_number(value):
+        """ Converts a whole number, or the string of one, into an int """
+        if isinstance(value, bool):
+            raise TypeError('{} is not a number'.format(value))
+        number = int(value)
+        if isinstance(value, float) and number != value:
+            raise ValueError('{} is not a whole number'.format(value))
+        return number
+
+    @staticmethod
+    def _upsert(params, returning=False):
+        """ Adds or increments every entry of <params> in the current transaction
+
+        Uses the native upsert of the dialect in use, executed once for all
+        the entries. An increment that takes a quantity out of the INTEGER
+        range fails the statement and is refused, see _check_quantities for
+        SQLite
+
+        Args:
+            params (list): statement parameters from _entry_values
+            returning (bool): return the resulting row of the first entry
+
+        Returns:
+            the resulting row if <returning> was asked and the dialect supports it
+        """
+        try:
+            table = Shopcart.__table__
+            dialect = db.engine.dialect
+            sqlite_version = getattr(dialect.dbapi, 'sqlite_version_info', (0, 0, 0))
+            if dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert as pg_insert
+                statement = pg_insert(table)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.user_id, table.c.product_id],
+                    set_={'quantity': table.c.quantity + statement.excluded.quantity})
+                if returning:
+                    return db.session.execute(statement.returning(*table.c),
+                                              params[0]).fetchone()
+                db.session.execute(statement, params)
+            elif dialect.name == 'sqlite' and sqlite_version >= (3, 24):
+                statement = SQLITE_UPSERT.format(table=table.name)
+                if returning and sqlite_version >= (3, 35):
+                    statement = text(statement + SQLITE_RETURNING).columns(*table.c)
+                    return db.session.execute(Shopcart._bind_price(statement),
+                                              params[0]).fetchone()
+                db.session.execute(Shopcart._bind_price(text(statement)), params)
+            elif dialect.name == 'ibm_db_sa':
+                statement = text(DB2_MERGE.format(table=table.name))
+                db.session.execute(Shopcart._bind_price(statement), params)
+            else:
+                # No upsert available, fall back to update then insert
+                for values in params:
+                    key = (table.c.user_id == values['user_id']) & \
+                          (table.c.product_id == values['product_id'])
+                    updated = db.session.execute(table.update().where(key).values(
+                        quantity=table.c.quantity + values['quantity'])).rowcount
+                    if not updated:
+                        db.session.execute(table.insert().values(**values))
+            return None
+        except DataError:
+            db.session.rollback()
+            raise DataValidationError('Invalid entry for Shopcart: the quantity would be '
+                                      'out of range')
+
+    @staticmethod
+    def _check_quantities(rows):
+        """ Refuses the increments that took the quantity of one of <rows> out of
+        the INTEGER range, which SQLite stores where the other databases fail """
+        if any(row['quantity'] > MAX_INTEGER for row in rows):
+            db.session.rollback()
+            raise DataValidationError('Invalid entry for Shopcart: the quantity would be '
+                                      'out of range')
+
+    @staticmethod
+    def _fetch_records(statement, batch_size=1000):
+        """ Yields the rows of a select of the shopcart columns as ShopcartRecords """
+        result = db.session.execute(statement.execution_options(stream_results=True))
+        make = ShopcartRecord._make
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            metrics.count_rows(len(rows))
+            for row in rows:
+                yield make(row)
+
+    @staticmethod
+    def _bind_price(statement):
+        """ Sends the price of a textual statement in cents like the price column """
+        return statement.bindparams(bindparam('price', type_=Money))
+
+    @staticmethod
+    def _attach(row):
+        """ Returns a Shopcart for a row just written, without loading it again """
+        entry = Shopcart(**dict(row))
+        make_transient_to_detached(entry)
+        return db.session.merge(entry, load=False)
 
 ######################################################################
 #  F I N D E R   M E T H O D S
@@ -107,35 +447,187 @@ class Shopcart(db.Model):
     @staticmethod
     def list_users():
         """ List all user in table """
-       # users = (db.session.query(Shopcart.user_id).distinct()).all();
-        users = []
-        for user in db.session.query(Shopcart.user_id).distinct():
-            users.append(user.user_id)
+        read_own_writes()
+        table = Shopcart.__table__
+        statement = select([table.c.user_id]).distinct()
+        users = [row[0] for row in db.session.execute(statement)]
+        metrics.count_rows(len(users))
         return users
 
+    @staticmethod
+    def find_records_by_user_id(user_id):
+        """ Yields the entries of the shopcart of user <user_id> as ShopcartRecords
+
+        Read-only variant of findByUserId that selects the columns without
+        the ORM, sorted by product_id
+        """
+        Shopcart.logger.info('Processing record lookup for id %s ...', user_id)
+        read_own_writes([user_id])
+        table = Shopcart.__table__
+        statement = select(table.c).where(table.c.user_id == user_id) \
+                                   .order_by(table.c.product_id)
+        return Shopcart._fetch_records(statement)
+
+    @staticmethod
+    def all_records(batch_size=1000):
+        """ Yields every Shopcart entry as a ShopcartRecord
+
+        Read-only variant of all, sorted by user_id and product_id and fetched
+        from the cursor in batches of <batch_size>
+        """
+        Shopcart.logger.info('Processing all Shopcart records')
+        read_own_writes()
+        table = Shopcart.__table__
+        statement = select(table.c).order_by(table.c.user_id, table.c.product_id)
+        return Shopcart._fetch_records(statement, batch_size)
+
+
+    @staticmethod
+    def stream_by_user(batch_size=1000, after=None, min_user_id=None,
+                       max_user_id=None, limit=None):
+        """ Yields (user_id, entries) for every user from a single ordered query
+
+        Rows are fetched from the cursor in batches of <batch_size> so memory
+        stays flat no matter how many shopcarts exist
+
+        Args:
+            after (int): keyset cursor, only users with a greater user_id are returned
+            min_user_id (int): smallest user_id to return (inclusive)
+            max_user_id (int): largest user_id to return (inclusive)
+            limit (int): maximum number of users to return
+        """
+        Shopcart.logger.info('Processing all Shopcarts grouped by user')
+        read_own_writes()
+        table = Shopcart.__table__
+        conditions = []
+        if after is not None:
+            conditions.append(table.c.user_id > after)
+        if min_user_id is not None:
+            conditions.append(table.c.user_id >= min_user_id)
+        if max_user_id is not None:
+            conditions.append(table.c.user_id <= max_user_id)
+
+        source = table
+        if limit is not None:
+            # Range scan the primary key for the first <limit> users of the page
+            users = select([table.c.user_id]).where(and_(*conditions)) \
+                                             .distinct().order_by(table.c.user_id) \
+                                             .limit(limit).alias('users')
+            source = table.join(users, table.c.user_id == users.c.user_id)
+        statement = select(table.c).select_from(source).where(and_(*conditions)) \
+                                   .order_by(table.c.user_id, table.c.product_id)
+        records = Shopcart._fetch_records(statement, batch_size)
+        for user_id, entries in groupby(records, key=attrgetter('user_id')):
+            yield user_id, list(entries)
 
     @staticmethod
     def find(user_id, product_id):
         """ Finds if user <user_id> has product <product_id> by it's ID """
         Shopcart.logger.info('Processing lookup for user id %s and product id %s ...', user_id, product_id)
-        return Shopcart.query.get((user_id,product_id))
+        read_own_writes([user_id])
+        shopcart = Shopcart.query.get((user_id,product_id))
+        metrics.count_rows(0 if shopcart is None else 1)
+        return shopcart
 
     @staticmethod
     def findByUserId(user_id):
         """ Finds the list of product in the shopcart of user by <user_id> """
         Shopcart.logger.info('Processing lookup for id %s ...', user_id)
+        read_own_writes([user_id])
         return Shopcart.query.filter(Shopcart.user_id == user_id)
 
     @staticmethod
-    def find_users_by_shopcart_amount(amount):
-        """ Finds the list of users who have in their shopcarts good worth 'amount' or more """
-        results = db.session.query(Shopcart.user_id, label('total_amount', func.sum(Shopcart.price*Shopcart.quantity))).group_by(Shopcart.user_id).all();
-        users = []
-        for result in results:
-            #Shopcart.logger.info("Result "+ str(result.user_id) +"total_amount " + str(result.total_amount) + str(float(result.total_amount) >= float(amount)))
-            if float(result.total_amount) >= float(amount):
-                users.append(result.user_id)
+    def find_cart(user_id):
+        """ Finds the serialized shopcart of user <user_id> and its total
+
+        Reads go through the cart cache, so hot shopcarts are served without
+        a database round-trip. On a miss the entries and the totals computed
+        by the database come back from a single query joining CartTotal.
+        The result is shared and must not be changed.
+
+        Returns:
+            dict: 'products' with the serialized entries sorted by product,
+            their 'product_ids', 'total_price' and the 'version' of the
+            shopcart (see CartTotal.version)
+        """
+        def load():
+            """ Reads the shopcart and its total from the database """
+            table = Shopcart.__table__
+            totals = CartTotal.__table__
+            statement = select(list(table.c) + [totals.c.total_value, totals.c.last_modified]) \
+                .select_from(table.join(totals, totals.c.user_id == table.c.user_id)) \
+                .where(table.c.user_id == user_id).order_by(table.c.product_id)
+            rows = db.session.execute(statement).fetchall()
+            metrics.count_rows(len(rows))
+            if not rows:
+                return {'products': [], 'product_ids': [], 'total_price': 0.0, 'version': None}
+            return {'products': [ShopcartRecord._make(row[:4]).serialize() for row in rows],
+                    'product_ids': [row.product_id for row in rows],
+                    'total_price': Money.to_float(rows[0].total_value),
+                    'version': rows[0].last_modified.strftime(VERSION_FORMAT)}
+        read_own_writes([user_id])
+        return cart_cache.get_or_load(user_id, load)
 
+    @staticmethod
+    def find_cart_product(user_id, product_id):
+        """ Finds product <product_id> in the shopcart of user <user_id>
+
+        With the cart cache the product is looked up in the cached shopcart,
+        by a binary search of its product ids. Without it only the line is
+        read, by its primary key, with the version from a join of CartTotal.
+
+        Returns:
+            tuple: the serialized entry, or None if the shopcart doesn't hold
+            the product, and the version of the shopcart
+        """
+        if cart_cache.enabled:
+            cart = Shopcart.find_cart(user_id)
+            index = bisect_left(cart['product_ids'], product_id)
+            if index < len(cart['product_ids']) and cart['product_ids'][index] == product_id:
+                return cart['products'][index], cart['version']
+            return None, cart['version']
+        read_own_writes([user_id])
+        table = Shopcart.__table__
+        totals = CartTotal.__table__
+        statement = select([totals.c.last_modified] + list(table.c)) \
+            .select_from(totals.outerjoin(table, and_(table.c.user_id == totals.c.user_id,
+                                                      table.c.product_id == product_id))) \
+            .where(totals.c.user_id == user_id)
+        row = db.session.execute(statement).fetchone()
+        metrics.count_rows(0 if row is None else 1)
+        if row is None:
+            return None, None
+        version = row.last_modified.strftime(VERSION_FORMAT)
+        if row.product_id is None:
+            return None, version
+        return ShopcartRecord._make(row[1:]).serialize(), version
+
+    @staticmethod
+    def find_users_by_shopcart_amount(amount, max_amount=None, order=None, limit=None):
+        """ Finds the list of users who have in their shopcarts good worth 'amount' or more
+
+        The search is a range scan on the indexed totals kept in CartTotal
+
+        Args:
+            max_amount (float): only users whose shopcarts are worth 'max_amount' or less
+            order (str): 'asc' or 'desc' to sort by shopcart total, by user_id otherwise
+            limit (int): maximum number of users to return
+        """
+        read_own_writes()
+        total_amount = CartTotal.total_value
+        query = db.session.query(CartTotal.user_id).filter(total_amount >= amount)
+        if max_amount is not None:
+            query = query.filter(total_amount <= max_amount)
+        if order == 'asc':
+            query = query.order_by(total_amount.asc(), CartTotal.user_id)
+        elif order == 'desc':
+            query = query.order_by(total_amount.desc(), CartTotal.user_id)
+        else:
+            query = query.order_by(CartTotal.user_id)
+        if limit is not None:
+            query = query.limit(limit)
+        users = [result.user_id for result in query]
+        metrics.count_rows(len(users))
         return users
 
 
@@ -145,15 +637,44 @@ class Shopcart(db.Model):
     @staticmethod
     def remove_all():
         """ Removes all entries in shopcarts for all users from the database """
+        read_own_writes()
         db.session.query(Shopcart).delete()
+        db.session.query(CartTotal).delete()
         db.session.commit()
+        cart_cache.clear()
+
+    @staticmethod
+    def delete_by_user(user_id, product_ids=None):
+        """ Removes the shopcart of user <user_id> in a single statement
+
+        Args:
+            product_ids (list): only remove these products from the shopcart
+
+        Returns:
+            int: the number of entries that were removed
+        """
+        Shopcart.logger.info('Processing delete for user id %s ...', user_id)
+        read_own_writes([user_id])
+        query = db.session.query(Shopcart).filter(Shopcart.user_id == user_id)
+        if product_ids is not None:
+            if not product_ids:
+                return 0
+            query = query.filter(Shopcart.product_id.in_(product_ids))
+        CartTotal.lock([user_id])
+        count = query.delete(synchronize_session=False)
+        CartTotal.refresh([user_id])
+        db.session.commit()
+        return count
 
 
     @staticmethod
     def all():
         """ Returns all of the Shopcarts in the database """
         Shopcart.logger.info('Processing all Shopcarts')
-        return Shopcart.query.all()
+        read_own_writes()
+        shopcarts = Shopcart.query.all()
+        metrics.count_rows(len(shopcarts))
+        return shopcarts
 
 
 ######################################################################
@@ -164,3 +685,297 @@ class Shopcart(db.Model):
         """ Initializes the database session """
         Shopcart.logger.info('Initializing database')
         db.create_all()  # make our sqlalchemy tables
+
+    @staticmethod
+    def migrate_prices():
+        """ Converts prices stored as floating point numbers into integer cents
+
+        The cart_totals summary is created again from the converted prices
+
+        Returns:
+            bool: False if the prices were already stored in cents
+        """
+        table = Shopcart.__table__
+        columns = dict((column['name'], column['type'])
+                       for column in inspect(db.engine).get_columns(table.name))
+        if isinstance(columns['price'], Integer):
+            return False
+        Shopcart.logger.info('Converting shopcart prices into cents')
+        for statement in MONEY_MIGRATION:
+            db.session.execute(statement.format(table=table.name))
+        if db.engine.dialect.name == 'ibm_db_sa':
+            db.session.execute(DB2_REORG.format(table=table.name))
+        db.session.commit()
+        CartTotal.__table__.drop(db.engine, checkfirst=True)
+        CartTotal.__table__.create(db.engine)
+        CartTotal.rebuild()
+        return True
+
+
+class CartTotal(db.Model):
+    """
+    Class that represents the totals of the Shopcart of a User
+
+    Every write made through Shopcart recomputes the totals of the users it
+    touched in the same transaction, so they can be read by primary key
+    instead of adding up the line items on each request
+    """
+
+    logger = logging.getLogger(__name__)
+
+    __tablename__ = 'cart_totals'
+
+    # Table Schema
+    user_id = db.Column(db.Integer, primary_key=True)
+    total_value = db.Column(BigMoney, nullable=False, index=True)
+    item_count = db.Column(db.BigInteger, nullable=False)
+    line_count = db.Column(db.Integer, nullable=False)
+    last_modified = db.Column(db.DateTime, nullable=False)
+
+    def serialize(self):
+        """ Serializes the totals of a Shopcart into a dictionary """
+        return {"user_id": self.user_id,
+                "total_value": Money.to_float(self.total_value),
+                "item_count": self.item_count,
+                "line_count": self.line_count,
+                "last_modified": self.last_modified.isoformat()}
+
+######################################################################
+#  F I N D E R   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def find(user_id):
+        """ Finds the totals of the shopcart of user <user_id> """
+        CartTotal.logger.info('Processing totals lookup for id %s ...', user_id)
+        read_own_writes([user_id])
+        totals = CartTotal.query.get(user_id)
+        metrics.count_rows(0 if totals is None else 1)
+        return totals
+
+    @staticmethod
+    def version(user_id, lock=False):
+        """ Returns a stamp that changes on every write to the shopcart of <user_id>
+
+        Only the modification time of the totals is read, so it is cheap enough
+        to check before loading the shopcart. With lock the totals stay locked
+        until the transaction ends
+
+        Returns:
+            str: the version, or None if the shopcart is empty
+        """
+        read_own_writes([user_id])
+        query = db.session.query(CartTotal.last_modified).filter(CartTotal.user_id == user_id)
+        if lock:
+            query = query.with_for_update()
+        last_modified = query.scalar()
+        metrics.count_rows(0 if last_modified is None else 1)
+        if lock:
+            db.session.info['cart_locked'] = True
+            if last_modified is not None:
+                db.session.info.setdefault('cart_locks', set()).add(int(user_id))
+        if last_modified is None:
+            return None
+        return last_modified.strftime(VERSION_FORMAT)
+
+    @staticmethod
+    def compute(user_ids=None):
+        """ Adds up the line items of <user_ids>, or of every user, in the database
+
+        The products are computed as BIGINT, as price * quantity of a single
+        line may be out of the INTEGER range
+        """
+        query = db.session.query(
+            Shopcart.user_id,
+            label('total_value', cast(func.sum(cast(Shopcart.price, BigInteger) *
+                                               Shopcart.quantity), BigMoney)),
+            label('item_count', cast(func.sum(cast(Shopcart.quantity, BigInteger)), BigInteger)),
+            label('line_count', func.count())).group_by(Shopcart.user_id)
+        if user_ids is not None:
+            query = query.filter(Shopcart.user_id.in_(user_ids))
+        return query.order_by(Shopcart.user_id)
+
+######################################################################
+#  S T A T I C   D A T A B A S E   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def lock(user_ids):
+        """ Locks the totals of <user_ids> until the transaction ends
+
+        Every write to a shopcart takes this lock before it changes a line, so
+        concurrent writes to the same shopcart run one after the other and
+        each adds up the lines committed before it. Missing totals are created
+        empty first so there is always a row to lock, and rows are locked in
+        user_id order. SQLite has a single writer already, so there they are
+        only created.
+        """
+        locked = db.session.info.setdefault('cart_locks', set())
+        user_ids = sorted(set(int(user_id) for user_id in user_ids) - locked)
+        if not user_ids:
+            return
+        db.session.info['cart_locked'] = True
+        table = CartTotal.__table__
+        now = datetime.utcnow()
+        empty = [{'user_id': user_id, 'total_value': 0, 'item_count': 0, 'line_count': 0,
+                  'last_modified': now} for user_id in user_ids]
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+            db.session.execute(pg_insert(table).on_conflict_do_nothing(
+                index_elements=[table.c.user_id]), empty)
+        elif dialect == 'sqlite':
+            db.session.execute(table.insert().prefix_with('OR IGNORE'), empty)
+        else:
+            existing = set(row[0] for row in db.session.execute(
+                select([table.c.user_id]).where(table.c.user_id.in_(user_ids))))
+            for values in empty:
+                if values['user_id'] in existing:
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(table.insert(), values)
+                except IntegrityError:
+                    # created by a concurrent write, locked below once it commits
+                    pass
+        if dialect != 'sqlite':
+            db.session.execute(select([table.c.user_id]).where(table.c.user_id.in_(user_ids))
+                               .order_by(table.c.user_id).with_for_update())
+        locked.update(user_ids)
+
+    @staticmethod
+    def refresh(user_ids):
+        """ Recomputes the totals of <user_ids> inside the current transaction
+
+        The totals are locked first, see lock, then updated in place
+        """
+        user_ids = sorted(set(int(user_id) for user_id in user_ids))
+        # the cached shopcarts of these users are invalidated once this commits
+        db.session.info.setdefault('cart_users', set()).update(user_ids)
+        CartTotal.lock(user_ids)
+        db.session.flush()
+        rows = CartTotal.compute(user_ids).all()
+        table = CartTotal.__table__
+        if rows:
+            params = CartTotal._values(rows)
+            for values in params:
+                values['key'] = values.pop('user_id')
+            db.session.execute(table.update().where(table.c.user_id == bindparam('key')),
+                               params)
+        emptied = set(user_ids) - set(row.user_id for row in rows)
+        if emptied:
+            db.session.execute(table.delete().where(table.c.user_id.in_(emptied)))
+
+    @staticmethod
+    def migrate_bigint():
+        """ Widens total_value and item_count of a table created as INTEGER to BIGINT
+
+        SQLite stores every integer in 64 bits whatever the declared type, so
+        only PostgreSQL and DB2 are changed
+
+        Returns:
+            bool: False if there was nothing to change
+        """
+        table = CartTotal.__table__
+        statements = BIGINT_TOTALS.get(db.engine.dialect.name)
+        if statements is None or not db.engine.has_table(table.name):
+            return False
+        columns = dict((column['name'], column['type'])
+                       for column in inspect(db.engine).get_columns(table.name))
+        if isinstance(columns['total_value'], BigInteger):
+            return False
+        CartTotal.logger.info('Widening the cart totals to BIGINT')
+        for statement in statements:
+            db.session.execute(statement.format(table=table.name))
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def rebuild(batch_size=1000):
+        """ Recomputes the totals of every user from the line items
+
+        Returns:
+            int: the number of users with a shopcart
+        """
+        CartTotal.logger.info('Rebuilding all shopcart totals')
+        read_own_writes()
+        table = CartTotal.__table__
+        db.session.execute(table.delete())
+        count = 0
+        batch = []
+        for row in CartTotal.compute().yield_per(batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                db.session.execute(table.insert(), CartTotal._values(batch))
+                count += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(table.insert(), CartTotal._values(batch))
+            count += len(batch)
+        db.session.commit()
+        cart_cache.clear()
+        return count
+
+    @staticmethod
+    def verify():
+        """ Compares the stored totals with the line items
+
+        Returns:
+            list: (user_id, stored, expected) for every user whose totals differ,
+            where stored and expected are (total_value, item_count, line_count)
+            tuples or None when there are no totals
+        """
+        CartTotal.logger.info('Verifying all shopcart totals')
+        read_own_writes()
+        stored = dict((total.user_id, (total.total_value, total.item_count, total.line_count))
+                      for total in CartTotal.query)
+        differences = []
+        for row in CartTotal.compute():
+            expected = (row.total_value, row.item_count, row.line_count)
+            totals = stored.pop(row.user_id, None)
+            if totals != expected:
+                differences.append((row.user_id, totals, expected))
+        for user_id, totals in sorted(stored.items()):
+            differences.append((user_id, totals, None))
+        return differences
+
+    @staticmethod
+    def _values(rows):
+        """ Converts aggregate rows from compute into insert parameters """
+        now = datetime.utcnow()
+        return [{'user_id': row.user_id,
+                 'total_value': row.total_value or 0,
+                 'item_count': row.item_count or 0,
+                 'line_count': row.line_count,
+                 'last_modified': now} for row in rows]
+
+
+######################################################################
+#  B U F F E R E D   W R I T E S
+######################################################################
+def read_own_writes(user_ids=None):
+    """ Waits until the buffered adds of <user_ids>, or of every user, are written
+
+    Skipped once the transaction wrote or locked a shopcart: the writer of
+    the buffer may wait for those locks, and they are released at commit
+    """
+    if not db.session.info.get('cart_locked'):
+        write_coalescer.flush(user_ids)
+
+######################################################################
+#  C A C H E   I N V A L I D A T I O N
+######################################################################
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cached_carts(session):
+    """ Drops the cached shopcarts of the users written by the transaction """
+    session.info.pop('cart_locked', None)
+    session.info.pop('cart_locks', None)
+    for user_id in session.info.pop('cart_users', ()):
+        cart_cache.invalidate(user_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_written_carts(session):
+    """ Nothing was written by a transaction that rolled back """
+    session.info.pop('cart_locked', None)
+    session.info.pop('cart_locks', None)
+    session.info.pop('cart_users', None)
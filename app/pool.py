@@ -0,0 +1,82 @@
+"""
+Database Connection Pool
+
+SQLAlchemy extension that imports the dialect of the database only once an
+engine is created for it, and applies the pool options of the configuration
+to server databases. A queue pool counts how often a checkout had to wait
+for a connection so pool capacity can be planned from live data.
+
+Configuration:
+--------------
+SQLALCHEMY_POOL_OPTIONS (dict) - pool_size, max_overflow, pool_recycle,
+                                 pool_timeout and pool_pre_ping for create_engine
+"""
+import time
+from importlib import import_module
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Third party dialects to import for a URI scheme, SQLAlchemy has the others
+DIALECT_MODULES = {'db2': 'ibm_db_sa', 'ibm_db_sa': 'ibm_db_sa'}
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy that pools connections to server databases with MeteredQueuePool """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        backend = sa_url.get_backend_name()
+        if backend in DIALECT_MODULES:
+            import_module(DIALECT_MODULES[backend])
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        # SQLite files are opened by each request, they don't need a pool
+        if backend != 'sqlite':
+            options['poolclass'] = MeteredQueuePool
+            options.update(app.config.get('SQLALCHEMY_POOL_OPTIONS', {}))
+
+
+class MeteredQueuePool(QueuePool):
+    """ QueuePool that counts the checkouts that waited for a connection """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        # every connection is checked out and no more overflow is allowed
+        if self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow():
+            self.waits += 1
+            start = time.time()
+            try:
+                return QueuePool._do_get(self)
+            except TimeoutError:
+                self.timeouts += 1
+                raise
+            finally:
+                self.wait_time += time.time() - start
+        return QueuePool._do_get(self)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        # QueuePool forgets to pass pre-ping on, and dispose() recreates the pool
+        pool._pre_ping = self._pre_ping
+        return pool
+
+
+def pool_stats(pool):
+    """ Returns the size, usage and wait counters of a connection pool """
+    stats = {'pool': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': pool.overflow(),
+                      'max_overflow': pool._max_overflow,
+                      'timeout': pool.timeout()})
+    if isinstance(pool, MeteredQueuePool):
+        stats.update({'waits': pool.waits,
+                      'timeouts': pool.timeouts,
+                      'wait_seconds': round(pool.wait_time, 3)})
+    return stats
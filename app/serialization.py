@@ -0,0 +1,76 @@
+"""
+Response Serialization
+
+Every JSON response of the service is encoded here, by the fastest JSON
+backend that is installed unless JSON_BACKEND names one:
+
+    ujson - C encoder, prints floats with up to 10 decimals which is plenty
+            for prices in cents
+    json  - the standard library encoder, always available
+
+Shopcart rows are serialized by the models into the documented fields
+already, so the handlers return them as they are instead of marshalling
+them field by field once more; the models are only used for the docs.
+
+Configuration:
+--------------
+JSON_BACKEND (str) - ujson, json or auto for the fastest one installed
+"""
+import json
+import logging
+from importlib import import_module
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+# Backends in the order they are preferred, with the arguments of a compact dumps
+BACKENDS = (
+    ('ujson', {}),
+    ('json', {'separators': (',', ':')}),
+)
+
+
+class JSONSerializer(object):
+    """ Encodes responses into JSON with one of the BACKENDS """
+
+    def __init__(self, backend='auto'):
+        names = [name for name, _ in BACKENDS]
+        if backend != 'auto' and backend not in names:
+            raise ValueError('JSON_BACKEND should be auto or one of {}'.format(', '.join(names)))
+        self.name, self._dumps = 'json', json.dumps
+        self._options = {'separators': (',', ':')}
+        for name, options in BACKENDS:
+            if backend not in ('auto', name):
+                continue
+            try:
+                self._dumps = import_module(name).dumps
+            except ImportError:
+                logger.warning('JSON backend %s is not installed', name)
+                continue
+            self.name, self._options = name, options
+            break
+
+    def dumps(self, value):
+        """ Returns <value> encoded as JSON """
+        return self._dumps(value, **self._options)
+
+    def stream_list(self, items):
+        """ Yields the JSON of a list one item at a time, as <items> are produced """
+        yield '['
+        separator = ''
+        for item in items:
+            yield separator + self.dumps(item)
+            separator = ','
+        yield ']'
+
+    def response(self, data, code=200, headers=None):
+        """ Makes a response with <data> encoded as its JSON body """
+        return Response(self.dumps(data) + '\n', status=code, headers=headers,
+                        mimetype='application/json')
+
+
+def create_serializer(app):
+    """ Creates the serializer of the backend selected by JSON_BACKEND """
+    serializer = JSONSerializer(app.config.get('JSON_BACKEND', 'auto'))
+    logger.info('Encoding JSON with %s', serializer.name)
+    return serializer
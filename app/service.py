@@ -12,17 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import sys
+import atexit
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from decimal import InvalidOperation
+from flask import Flask, Response, request, url_for, make_response, abort, \
+                  stream_with_context
 from flask_api import status    # HTTP Status Codes
 from flask_restplus import Api, Resource, fields
-import json
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, Unauthorized
+from werkzeug.http import quote_etag
 
-from model import Shopcart, DataValidationError, DatabaseConnectionError
+from model import Shopcart, CartTotal, Money, DataValidationError, DatabaseConnectionError, \
+                  CENT, MIN_INTEGER, MAX_INTEGER, MIN_BIGINT, MAX_BIGINT
 
 # Import Flask application
-from . import app
+from . import app, db, cart_cache, serializer, metrics, slow_queries, write_coalescer
+from . import migrations
+from pool import pool_stats
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from logs import AsyncLogging, JSONFormatter, TEXT_FORMAT, parse_sample_rates
+
+# Background writer of the log records, set up by initialize_logging
+async_logging = None
 
 
 ######################################################################
@@ -63,6 +74,15 @@ shopcart_model = api.model('Shopcart', {
                                 description='Cost of one item of the product')
 }, mask='user_id, product_id, quantity, price')
 
+# Largest number of products accepted by one bulk add
+MAX_BULK_ITEMS = 1000
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """ Encodes what the resources return with the configured JSON backend """
+    return serializer.response(data, code, headers)
+
 
 ######################################################################
 # Special Error Handlers
@@ -80,11 +100,9 @@ def database_connection_error(error):
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
-    api.logger("error handler")
     message = error.message or str(error)
     app.logger.info(message)
-    #return {'status':400, 'error': 'Request Error', 'message': message}, 400
-    api.abort(status.HTTP_400_BAD_REQUEST, "Shopcart ")
+    return {'status':400, 'error': 'Request Error', 'message': message}, 400
 
 
 ######################################################################
@@ -93,7 +111,40 @@ def request_validation_error(error):
 @app.route('/healthcheck')
 def healthcheck():
     """ Let them know our heart is still beating """
-    return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
+    return serializer.response({'status': 200, 'message': 'Healthy',
+                                'cache': cart_cache.stats(),
+                                'database': pool_stats(db.engine.pool)},
+                               status.HTTP_200_OK)
+
+######################################################################
+# GET METRICS
+######################################################################
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Exposes the request, connection pool, cache and log queue metrics to Prometheus """
+    return Response(metrics.render({'db_pool': pool_stats(db.engine.pool),
+                                    'cart_cache': cart_cache.stats(),
+                                    'log': log_stats(),
+                                    'write_coalescer': write_coalescer.stats()}),
+                    status=status.HTTP_200_OK, content_type=METRICS_CONTENT_TYPE)
+
+######################################################################
+# GET SLOW QUERIES
+######################################################################
+@app.route('/admin/slow-queries')
+def slow_query_log():
+    """ Dumps the slow statements recorded by this worker, the most recent first
+
+    Only served when SLOW_QUERY_ADMIN_TOKEN is set, to requests bearing it
+    """
+    if not slow_queries.admin_token:
+        raise NotFound()
+    if not slow_queries.authorized(request.headers.get('Authorization')):
+        raise Unauthorized(www_authenticate='Bearer')
+    return serializer.response({'enabled': slow_queries.enabled,
+                                'threshold': slow_queries.threshold,
+                                'queries': slow_queries.dump()},
+                               status.HTTP_200_OK)
 
 ######################################################################
 
@@ -116,41 +167,53 @@ class ShopcartResource(Resource):
     # GET THE LIST OF THE PRODUCT IN A USER'S SHOPCART
     #################################################################
     @ns.doc('get_shopcart_list')
-    @ns.response(200, 'Success')
+    @ns.response(200, 'Success', [shopcart_model])
+    @ns.response(304, 'Shopcart not modified')
     @ns.response(404, 'Shopcart not found')
-    @ns.marshal_list_with(shopcart_model)
     def get(self, user_id):
        """ Get the shopcart entry for user (user_id)
        This endpoint will show the list of products in user's shopcart from the database
        """
        app.logger.info("Request to get the list of the product in a user [%s]'s shopcart", user_id)
-       shopcarts = []
-       shopcarts = Shopcart.findByUserId(user_id)
-       print(shopcarts.count())
-       #if not shopcarts:
-           #api.abort(status.HTTP_404_NOT_FOUND, "Shopcart with user_id '{}' was not found.".format(user_id))
-       if shopcarts.count() == 0:
+       etag = known_cart_etag(user_id)
+       if etag is not None:
+           return not_modified(etag)
+       cart = Shopcart.find_cart(user_id)
+       etag = cart_etag(user_id, cart['version'])
+       if is_not_modified(etag):
+           return not_modified(etag)
+       if not cart['products']:
            api.abort(status.HTTP_404_NOT_FOUND, "Shopcart with user_id '{}' was not found.".format(user_id))
-           #raise NotFound("Shopcart with user_id '{}' was not found.".format(user_id))
-       results = [shopcart.serialize() for shopcart in shopcarts]
-       return results, status.HTTP_200_OK
+       return cart['products'], status.HTTP_200_OK, etag_headers(etag)
 
     ######################################################################
     # DELETE ALL PRODUCT OF USER
     ######################################################################
     @ns.doc('delete_user_shopcart')
     @ns.response(204, 'User Shopcart deleted')
+    @ns.response(400, 'product_id parameter is not valid')
+    @ns.response(412, 'Shopcart was modified since If-Match')
+    @ns.param('product_id', 'Only delete these products (may be repeated)')
     def delete(self, user_id):
        """
        Delete Product of User
        This endpoint will delete all Product of user based the user_id specified in the path
+       or only the products given with the product_id parameter
        """
 
        app.logger.info('Request to delete a shopcart of user id [%s]', user_id)
-       shopcarts = Shopcart.findByUserId(user_id)
-       if shopcarts:
-          for shopcart in shopcarts:
-              shopcart.delete()
+       product_ids = None
+       if 'product_id' in request.args:
+           try:
+               product_ids = [int(pid) for pid in request.args.getlist('product_id')]
+           except ValueError:
+               app.logger.info("value error")
+               abort(status.HTTP_400_BAD_REQUEST, 'parameter product_id is not valid')
+           if not all(MIN_INTEGER <= pid <= MAX_INTEGER for pid in product_ids):
+               abort(status.HTTP_400_BAD_REQUEST, 'parameter product_id is out of range')
+       check_if_match(current_cart_etag(user_id, lock=True))
+       count = Shopcart.delete_by_user(user_id, product_ids)
+       app.logger.info('Deleted %s products from shopcart of user id [%s]', count, user_id)
        return '', status.HTTP_204_NO_CONTENT
 
 ##################################################################
@@ -172,25 +235,25 @@ class ShopcartAction(Resource):
     #################################################################
     @ns.doc('get_shopcart_total')
     @ns.response(200, 'Success')
+    @ns.response(304, 'Shopcart not modified')
     def get(self, user_id):
        """ Get the shopcart entry for user (user_id)
        This endpoint will show the total amount of the all items in the shopcart along with the list of items in user's shopcart 
        """
 
        app.logger.info("Request to get the total amount of a user [%s]'s shopcart", user_id)
-       total_amount = 0.0
-       shopcarts = Shopcart.findByUserId(user_id)
-       for shopcart in shopcarts:
-           total_amount = total_amount + (shopcart.price * shopcart.quantity)
-       total_amount = round(total_amount, 2)
+       etag = known_cart_etag(user_id)
+       if etag is not None:
+           return not_modified(etag)
+       cart = Shopcart.find_cart(user_id)
+       etag = cart_etag(user_id, cart['version'])
+       if is_not_modified(etag):
+           return not_modified(etag)
 
-       inlist = [shopcart.serialize() for shopcart in shopcarts]
+       dt = {'products':cart['products'],
+             'total_price':round(cart['total_price'], 2)}
 
-       dt = {'products':inlist,
-             'total_price':total_amount}
-
-       results = json.dumps(dt)
-       return make_response(results, status.HTTP_200_OK)
+       return serializer.response(dt, status.HTTP_200_OK, etag_headers(etag))
 
 ######################################################################
 #  PATH: /shopcarts/<int:user_id>/product/<int:product_id>
@@ -209,10 +272,9 @@ class ProductResource(Resource):
     # RETRIEVES A PRODUCT FROM USER'S SHOPCART
     #------------------------------------------------------------------
     @ns.doc('get_product')
-    @ns.response(200, 'Success')
+    @ns.response(200, 'Success', shopcart_model)
+    @ns.response(304, 'Shopcart not modified')
     @ns.response(404, 'Product not found')
-    @ns.marshal_with(shopcart_model)
-
     def get(self, user_id, product_id):
         """
         Retrieve a product from user's shopcart
@@ -220,16 +282,23 @@ class ProductResource(Resource):
         This endpoint will return a product having given product_id from user having given user_id
         """
         app.logger.info("Request to Retrieve a product with id [%s] from shopcart of user with id [%s]", product_id, user_id)
-        result = Shopcart.find(user_id, product_id)
-        if not result:
+        etag = known_cart_etag(user_id)
+        if etag is not None:
+            return not_modified(etag)
+        product, version = Shopcart.find_cart_product(user_id, product_id)
+        etag = cart_etag(user_id, version)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        if product is None:
             raise NotFound("User with id '{uid}' doesn't have product with id '{pid}' was not found.' in the shopcart ".format(uid = user_id, pid = product_id))
-        return result.serialize(),status.HTTP_200_OK
+        return product, status.HTTP_200_OK, etag_headers(etag)
 
     #------------------------------------------------------------------
     # DELETES A PRODUCT FROM USER'S SHOPCART
     #------------------------------------------------------------------
     @ns.doc('delete_product')
     @ns.response(204, 'Product deleted')
+    @ns.response(412, 'Shopcart was modified since If-Match')
     def delete(self, user_id, product_id):
         """
         Delete a product from a user's shopcart
@@ -239,6 +308,7 @@ class ProductResource(Resource):
         app.logger.info('Request to Delete a product with id [%s] from user with id [%s]', user_id, product_id)
         shopcart = Shopcart.find(user_id, product_id)
         if shopcart:
+            check_if_match(current_cart_etag(user_id, lock=True))
             shopcart.delete()
         return '', status.HTTP_204_NO_CONTENT
 
@@ -247,11 +317,11 @@ class ProductResource(Resource):
     # UPDATE A PRODUCT IN USER'S SHOPCART
     #------------------------------------------------------------------
     @ns.doc('update_product')
-    @ns.response(200, 'Success')
+    @ns.response(200, 'Success', shopcart_model)
     @ns.response(404, 'Product not found')
     @ns.response(400, 'The posted Product data was not valid')
+    @ns.response(412, 'Shopcart was modified since If-Match')
     @ns.expect(shopcart_model)
-    @ns.marshal_with(shopcart_model)
     def put(self, user_id, product_id):
         """
         Update a Shopcart entry specific to that user_id and product_id
@@ -262,25 +332,75 @@ class ProductResource(Resource):
         shopcart = Shopcart.find(user_id, product_id)
         if not shopcart:
             raise NotFound("User with id '{uid}' doesn't have product with id '{pid}' was not found.' in the shopcart ".format(uid = user_id, pid = product_id))
-
-        data = api.payload
-        app.logger.info(data)
-        shopcart.deserialize(data)
-        q = 0
-        try:
-           q = int(shopcart.quantity)
-        except ValueError:
-                app.logger.info("value error")
-                abort(status.HTTP_400_BAD_REQUEST, 'Quantity parameter is not valid: {}'.format(shopcart.quantity))
-
-        if q < 1:
-            app.logger.info("Added quantity is 0")
-            abort(status.HTTP_400_BAD_REQUEST, 'You should input number more than 0 for quantity to add a product')
-
-        shopcart.user_id = user_id
-        shopcart.product_id = product_id
+        check_if_match(current_cart_etag(user_id, lock=True))
+
+        # Checked on a copy so a bad body leaves the stored entry untouched
+        entry = Shopcart().deserialize(api.payload)
+        entry.user_id = user_id
+        entry.product_id = product_id
+        message = check_shopcart_entry(entry)
+        if message:
+            app.logger.info(message)
+            abort(status.HTTP_400_BAD_REQUEST, message)
+        values = Shopcart._entry_values(user_id, product_id, entry.quantity, entry.price)
+
+        shopcart.quantity = values['quantity']
+        shopcart.price = values['price']
         shopcart.save()
-        return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart.serialize(), status.HTTP_200_OK, etag_headers(current_cart_etag(user_id))
+
+######################################################################
+#  PATH: /shopcarts/<int:user_id>/items
+######################################################################
+@ns.route('/<int:user_id>/items', strict_slashes=False)
+@ns.param('user_id','The User Identifier')
+class ShopcartItemsResource(Resource):
+
+    """
+    ShopcartItemsResource class
+
+    Allows adding many products to a user's shopcart at once
+    POST /user{id}/items - Adds every product of the list to the shopcart of the user
+    """
+    #------------------------------------------------------------------
+    # ADD MANY PRODUCTS TO USER'S SHOPCART
+    #------------------------------------------------------------------
+    @ns.doc('add_products')
+    @ns.expect([shopcart_model])
+    @ns.response(400, 'The posted data was not valid')
+    @ns.response(200, 'Products added successfully', [shopcart_model])
+    def post(self, user_id):
+        """
+        Add many products to a shopcart
+        This endpoint will add every item of the list to a user's shopcart in one
+        transaction, or none of them if any item is not valid
+        """
+        app.logger.info('Request to Add Items to Shopcart of user [%s]', user_id)
+        check_content_type('application/json')
+        lines = api.payload
+        if not isinstance(lines, list):
+            abort(status.HTTP_400_BAD_REQUEST, 'Request body should be a list of products')
+        if len(lines) > MAX_BULK_ITEMS:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'No more than {} products can be added at once'.format(MAX_BULK_ITEMS))
+
+        # Validate every line before anything is written
+        errors = []
+        for index, line in enumerate(lines):
+            if isinstance(line, dict):
+                line = dict(line, user_id=user_id)
+            try:
+                message = check_shopcart_entry(Shopcart().deserialize(line))
+            except DataValidationError as error:
+                message = str(error)
+            if message:
+                errors.append({'index': index, 'message': message})
+        if errors:
+            app.logger.info('%s products are not valid', len(errors))
+            api.abort(status.HTTP_400_BAD_REQUEST, 'Some products are not valid', errors=errors)
+
+        shopcarts = Shopcart.add_or_increment_many(user_id, lines)
+        return [shopcart.serialize() for shopcart in shopcarts], status.HTTP_200_OK
 
 ######################################################################
 #  PATH: /shopcarts
@@ -294,35 +414,51 @@ class ShopcartCollection(Resource):
     #------------------------------------------------------------------
     @ns.doc('list_shopcarts')
     @ns.response(200, 'Success')
-    #@ns.param('category', 'List Shopcarts grouped by user_id')
+    @ns.response(400, 'Paging parameter is not valid')
+    @ns.param('limit', 'Maximum number of users in the page')
+    @ns.param('cursor', 'Return only users after this user_id (from the next link)')
+    @ns.param('min_user_id', 'Smallest user_id to return')
+    @ns.param('max_user_id', 'Largest user_id to return')
     def get(self):
-        """ 
-        Returns all of the Shopcarts grouped by user_id 
+        """
+        Returns all of the Shopcarts grouped by user_id
         This endpoint will give the information of all shopcart of all users
+        When a limit is given the result is paged and the next page is
+        advertised in the Link header
         """
 
         app.logger.info('Request to list Shopcarts...')
-
-        users = Shopcart.list_users();
-        results = ''
-        #res = []
-        for user_id in users:
-            inlist = Shopcart.findByUserId(user_id)
-            dt = []
-            for item in inlist:
-                tmp2 = {"product_id":item.product_id,
-                        "price": item.price,
-                        "quantity": item.quantity}
-                dt.append(tmp2)
-            tmp = {"user_id":user_id,
-                   "products":dt}
-            if len(results)>1: 
-                results += ","
-            results += json.dumps(tmp)
-        #res.append()
-        #res.append(results)
-        res = "["+results+"]"
-        return make_response(res, status.HTTP_200_OK)
+        limit = get_int_arg('limit', minimum=1)
+        cursor = get_int_arg('cursor')
+        min_user_id = get_int_arg('min_user_id')
+        max_user_id = get_int_arg('max_user_id')
+
+        carts = Shopcart.stream_by_user(after=cursor,
+                                        min_user_id=min_user_id,
+                                        max_user_id=max_user_id,
+                                        limit=limit)
+        headers = {}
+        if limit is not None:
+            # a page is bounded by limit so it can be read before the headers go out
+            carts = list(carts)
+            if len(carts) == limit:
+                args = request.args.to_dict()
+                args['cursor'] = carts[-1][0]
+                next_url = api.url_for(ShopcartCollection, _external=True, **args)
+                headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+        def generate():
+            """ Builds one object per user as rows come off the cursor """
+            for user_id, entries in carts:
+                products = [{"product_id": item.product_id,
+                             "price": Money.to_float(item.price),
+                             "quantity": item.quantity} for item in entries]
+                yield {"user_id": user_id, "products": products}
+
+        return Response(stream_with_context(serializer.stream_list(generate())),
+                        status=status.HTTP_200_OK,
+                        headers=headers,
+                        mimetype='application/json')
 
     #------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -330,47 +466,39 @@ class ShopcartCollection(Resource):
     @ns.doc('add_product')
     @ns.expect(shopcart_model)
     @ns.response(400, 'The posted data was not valid')
-    @ns.response(201, 'Product added successfully')
-    @ns.marshal_with(shopcart_model, code=201)
+    @ns.response(201, 'Product added successfully', shopcart_model)
+    @ns.response(202, 'Product add buffered, the quantity is what is not written yet',
+                 shopcart_model)
     def post(self):
         """
         add a product to a shopcart
         This endpoint will add a new item to a user's shopcart
+        With the write coalescer enabled the add is written shortly after
         """
         app.logger.info('Request to Add an Item to Shopcart')
         check_content_type('application/json')
         shopcart = Shopcart()
-        app.logger.info('Payload = %s', api.payload)
         shopcart.deserialize(api.payload)
 
-        q = 0;
-        try:
-            q = int(shopcart.quantity)
-        except ValueError:
-                app.logger.info("value error")
-                #raise DataValidationError
-                abort(status.HTTP_400_BAD_REQUEST, 'Quantity parameter is not valid: {}'.format(shopcart.quantity))
-
-        if shopcart.user_id is None or shopcart.user_id == '' or shopcart.product_id is None or shopcart.product_id =='' \
-            or shopcart.price is None or shopcart.price == '' or shopcart.quantity is None or shopcart.quantity == '':
-            app.logger.info("some parameter is none")
-            abort(status.HTTP_400_BAD_REQUEST, 'Some data is missing in the request')
-        elif q < 1:
-            app.logger.info("Added quantity is 0")
-            abort(status.HTTP_400_BAD_REQUEST, 'You should input number more than 0 for quantity to add a product')
-        else:
-            #Check if the entry exists, if yes then increase quantity of product
-            exists = Shopcart.find(shopcart.user_id, shopcart.product_id)
-            if exists:
-                exists.quantity = exists.quantity + q
-                exists.save()
-                shopcart = exists
+        message = check_shopcart_entry(shopcart)
+        if message:
+            app.logger.info(message)
+            abort(status.HTTP_400_BAD_REQUEST, message)
 
-            shopcart.save()
+        if write_coalescer.enabled:
+            pending = Shopcart.add_or_increment_later(shopcart.user_id, shopcart.product_id,
+                                                      shopcart.quantity, shopcart.price)
+            location_url = api.url_for(ProductResource, user_id=pending.user_id,
+                                       product_id=pending.product_id, _external=True)
+            return pending.serialize(), status.HTTP_202_ACCEPTED, {'Location': location_url}
 
-            app.logger.info('Item with new id [%s] saved to shopcart of user [%s]!', shopcart.user_id, shopcart.product_id)
-            location_url = api.url_for(ProductResource,  user_id=shopcart.user_id, product_id=shopcart.product_id, _external=True)
-            return shopcart.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        #Add the entry, or increase quantity of product if it exists
+        shopcart = Shopcart.add_or_increment(shopcart.user_id, shopcart.product_id,
+                                             shopcart.quantity, shopcart.price)
+
+        app.logger.info('Item with new id [%s] saved to shopcart of user [%s]!', shopcart.user_id, shopcart.product_id)
+        location_url = api.url_for(ProductResource,  user_id=shopcart.user_id, product_id=shopcart.product_id, _external=True)
+        return shopcart.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
 ######################################################################
@@ -385,6 +513,9 @@ class ShopcartUsersResource(Resource):
     GET /users - Returns the list of the users whose shopcarts' total is more than a certain amount
     """
     @ns.param('amount', 'amount for searching')
+    @ns.param('max_amount', 'only users with shopcarts worth no more than this amount')
+    @ns.param('order', 'asc or desc to sort the users by shopcart total')
+    @ns.param('limit', 'maximum number of users to return')
 
     ############################################################################
     # QUERY DATABASE FOR SHOPCARTS HAVING PRODUCTS WORTH MORE THAN GIVEN AMOUNT
@@ -399,21 +530,20 @@ class ShopcartUsersResource(Resource):
         with amount more than given amount
         """
         amount = request.args.get('amount');
-        app.logger.info("Request to get the list of the user shopcart having more than {}".format(amount))
+        app.logger.info('Request to get the list of the user shopcart having more than %s', amount)
 
         if amount is None:
             app.logger.info("amount is none")
             abort(status.HTTP_400_BAD_REQUEST, 'parameter amount not found')
-        else:
-            try:
-                app.logger.info("try start")
-                amount = float(amount)
-                app.logger.info("try end")
-            except ValueError:
-                app.logger.info("value error")
-                abort(status.HTTP_400_BAD_REQUEST, 'parameter is not valid: {}'.format(amount))
-        users = Shopcart.find_users_by_shopcart_amount(amount)
-        app.logger.info("get data")
+        amount = get_float_arg('amount')
+        max_amount = get_float_arg('max_amount')
+        limit = get_int_arg('limit', minimum=1)
+        order = request.args.get('order')
+        if order not in (None, 'asc', 'desc'):
+            abort(status.HTTP_400_BAD_REQUEST, 'parameter order is not valid: {}'.format(order))
+
+        users = Shopcart.find_users_by_shopcart_amount(amount, max_amount=max_amount,
+                                                       order=order, limit=limit)
         return users, status.HTTP_200_OK
 
 
@@ -433,10 +563,13 @@ def shopcarts_reset():
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-@app.before_first_request
 def init_db():
-    """ Initlaize the SQLAlchemy app"""
-    Shopcart.init_db()
+    """ Initlaize the SQLAlchemy app
+    Migrates the schema when the server starts, not in the first request,
+    so a database made by an older release is converted before it is served
+    """
+    for migration in migrations.migrate():
+        app.logger.info('Applied migration %s: %s', migration.version, migration.description)
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
@@ -445,23 +578,146 @@ def check_content_type(content_type):
     app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Content-Type must be {}'.format(content_type))
 
-#@app.before_first_request
+def check_shopcart_entry(shopcart):
+    """ Returns why a deserialized Shopcart entry can't be added, or None if it can """
+    try:
+        quantity = int(shopcart.quantity)
+    except (TypeError, ValueError):
+        return 'Quantity parameter is not valid: {}'.format(shopcart.quantity)
+    if any(value is None or value == '' for value in
+           (shopcart.user_id, shopcart.product_id, shopcart.price)):
+        return 'Some data is missing in the request'
+    try:
+        int(shopcart.user_id), int(shopcart.product_id), float(shopcart.price)
+    except (TypeError, ValueError):
+        return 'Some data is not valid in the request'
+    if quantity < 1:
+        return 'You should input number more than 0 for quantity to add a product'
+    return None
+
+def cart_etag(user_id, version):
+    """ Returns the entity tag of <version> of a shopcart or None if it is empty """
+    if version is None:
+        return None
+    return '{}-{}'.format(user_id, version)
+
+def known_cart_etag(user_id):
+    """ Returns the entity tag of the shopcart of <user_id> if the client sent
+    it in If-None-Match, so a 304 can be answered before the shopcart is loaded
+
+    Without the cart cache only the version is read, one row of the totals;
+    with it the version comes with the cached shopcart, so None is returned
+    and the handler checks after find_cart
+    """
+    if not request.if_none_match or cart_cache.enabled:
+        return None
+    etag = current_cart_etag(user_id)
+    return etag if is_not_modified(etag) else None
+
+def current_cart_etag(user_id, lock=False):
+    """ Returns the entity tag of the stored shopcart of <user_id>
+
+    For the If-Match checks of writes, with lock, and known_cart_etag;
+    reads take the version that comes with the shopcart from find_cart
+    """
+    return cart_etag(user_id, CartTotal.version(user_id, lock=lock))
+
+def etag_headers(etag):
+    """ Returns the headers that send <etag> to the client """
+    if etag is None:
+        return {}
+    return {'ETag': quote_etag(etag)}
+
+def is_not_modified(etag):
+    """ Checks if the client already has the version <etag> of a shopcart """
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+def not_modified(etag):
+    """ Returns the empty 304 response telling the client its <etag> is current """
+    return make_response('', status.HTTP_304_NOT_MODIFIED, etag_headers(etag))
+
+def check_if_match(etag):
+    """ Checks that the shopcart is still at the version the client sent in If-Match """
+    if request.if_match and (etag is None or not request.if_match.contains(etag)):
+        app.logger.info('Shopcart version %s does not match If-Match', etag)
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              'Shopcart was modified, get it again before changing it')
+
+def get_float_arg(name):
+    """ Returns the query parameter <name> as a float or None if it was not sent
+
+    The parameter is an amount of money compared with the cart totals, so it
+    has to be finite and within the range of their BIGINT cents
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+        cents = Money.to_decimal(number) / CENT
+    except (ValueError, InvalidOperation):
+        app.logger.info("value error")
+        abort(status.HTTP_400_BAD_REQUEST, 'parameter is not valid: {}'.format(value))
+    if not MIN_BIGINT <= cents <= MAX_BIGINT:
+        abort(status.HTTP_400_BAD_REQUEST, 'parameter {} is out of range'.format(name))
+    return number
+
+def get_int_arg(name, minimum=None):
+    """ Returns the query parameter <name> as an int or None if it was not sent
+
+    The parameter is compared with INTEGER columns or used as a limit, so it
+    has to be within their range, checked before a response is streamed
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        app.logger.info("value error")
+        abort(status.HTTP_400_BAD_REQUEST, 'parameter {} is not valid: {}'.format(name, value))
+    if minimum is not None and value < minimum:
+        abort(status.HTTP_400_BAD_REQUEST,
+              'parameter {} should be at least {}'.format(name, minimum))
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        abort(status.HTTP_400_BAD_REQUEST, 'parameter {} is out of range'.format(name))
+    return value
+
 def initialize_logging(log_level=logging.INFO):
-    """ Initialized the default logging to STDOUT """
+    """ Initialized the default logging to STDOUT through a background writer """
+    global async_logging
     if not app.debug:
         print 'Setting up logging...'
-        # Set up default logging for submodules to use STDOUT
-        # datefmt='%m/%d/%Y %I:%M:%S %p'
-        fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
-        # Make a new log handler that uses STDOUT
+        stop_logging()
+        # Make a new log handler that uses STDOUT, fed by the queue of the loggers
         handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter(fmt))
+        if app.config['LOG_FORMAT'] == 'json':
+            handler.setFormatter(JSONFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
         handler.setLevel(log_level)
-        # Remove the Flask default handlers and use our own
+        # Remove the Flask default handlers so app.logger goes to the root logger
         handler_list = list(app.logger.handlers)
         for log_handler in handler_list:
             app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
+        root_logger = logging.getLogger()
+        async_logging = AsyncLogging(handler, [root_logger],
+                                     queue_size=app.config['LOG_QUEUE_SIZE'],
+                                     sample_rates=parse_sample_rates(app.config['LOG_SAMPLE_RATES']))
+        async_logging.start()
+        root_logger.setLevel(log_level)
         app.logger.setLevel(log_level)
         app.logger.info('Logging handler established')
+
+def stop_logging():
+    """ Writes the queued log records and stops the background writer """
+    global async_logging
+    if async_logging is not None:
+        async_logging.stop()
+        async_logging = None
+
+def log_stats():
+    """ Returns the stats of the log queue, empty when logging is synchronous """
+    return async_logging.stats() if async_logging is not None else {}
+
+atexit.register(stop_logging)
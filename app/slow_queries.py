@@ -0,0 +1,195 @@
+"""
+Slow Query Log
+
+Opt-in recorder of the SQL statements that take longer than a threshold.
+Each one is logged with its duration and the route of the request that
+ran it, and kept in a bounded ring buffer that the admin endpoint dumps.
+The parameters of the statements hold user data, so they are only kept
+when SLOW_QUERY_PARAMETERS is set, and the admin endpoint only answers
+requests bearing SLOW_QUERY_ADMIN_TOKEN. For a sample of the statements
+the query plan of the database is captured right after they ran:
+
+    postgresql  - EXPLAIN on the same connection, inside a savepoint so a
+                  failure leaves the transaction of the request alone
+    sqlite      - EXPLAIN QUERY PLAN on the same connection
+    ibm_db_sa   - EXPLAIN PLAN FOR on a connection of its own, tagged with a
+                  query number and read back from EXPLAIN_OPERATOR by it,
+                  then rolled back. Needs the explain tables to exist
+
+Statements are timed from execute until the driver returns, so rows that
+a streamed result fetches later are not counted.
+
+Configuration:
+--------------
+SLOW_QUERY_ENABLED (bool)       - record slow statements, False by default
+SLOW_QUERY_THRESHOLD (float)    - seconds a statement may take before it is slow
+SLOW_QUERY_EXPLAIN_RATE (float) - fraction of the slow statements to explain
+SLOW_QUERY_BUFFER (int)         - number of slow statements kept for the admin endpoint
+SLOW_QUERY_PARAMETERS (bool)    - keep the parameters of the statements, False by default
+SLOW_QUERY_ADMIN_TOKEN (str)    - bearer token of the admin endpoint, which is off without one
+"""
+import os
+import hmac
+import time
+import random
+import logging
+import threading
+from itertools import count
+from collections import deque
+from datetime import datetime
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Statements a plan can be asked for without running them
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+DB2_EXPLAIN_PLAN = 'EXPLAIN PLAN SET QUERYNO = {queryno} SET QUERYTAG = \'{tag}\' FOR {statement}'
+DB2_EXPLAIN_OPERATORS = (
+    'SELECT O.OPERATOR_ID, O.OPERATOR_TYPE, O.TOTAL_COST '
+    'FROM EXPLAIN_STATEMENT S JOIN EXPLAIN_OPERATOR O '
+    'ON O.EXPLAIN_REQUESTER = S.EXPLAIN_REQUESTER AND O.EXPLAIN_TIME = S.EXPLAIN_TIME '
+    'AND O.SOURCE_NAME = S.SOURCE_NAME AND O.SOURCE_SCHEMA = S.SOURCE_SCHEMA '
+    'AND O.SOURCE_VERSION = S.SOURCE_VERSION AND O.EXPLAIN_LEVEL = S.EXPLAIN_LEVEL '
+    'AND O.STMTNO = S.STMTNO AND O.SECTNO = S.SECTNO '
+    'WHERE S.QUERYNO = ? AND S.QUERYTAG = ? AND S.EXPLAIN_LEVEL = \'P\' '
+    'ORDER BY O.OPERATOR_ID'
+)
+MAX_PARAMETERS_LENGTH = 500
+
+
+class SlowQueryLog(object):
+    """ Flask extension that records the statements slower than a threshold """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app=None, threshold=0.5, explain_rate=0.1, size=100, enabled=False,
+                 parameters=False, admin_token=None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.parameters = parameters
+        self.admin_token = admin_token
+        self.queries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        # the DB2 plans of this process are told apart by their tag and number
+        self._explain_tag = 'SLOWQ{}'.format(os.getpid())
+        self._explain_numbers = count(random.randint(1, 2 ** 30))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Reads the settings and hooks the statement events of every engine """
+        self.enabled = app.config.get('SLOW_QUERY_ENABLED', self.enabled)
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD', self.threshold)
+        self.explain_rate = app.config.get('SLOW_QUERY_EXPLAIN_RATE', self.explain_rate)
+        self.queries = deque(maxlen=app.config.get('SLOW_QUERY_BUFFER', self.queries.maxlen))
+        self.parameters = app.config.get('SLOW_QUERY_PARAMETERS', self.parameters)
+        self.admin_token = app.config.get('SLOW_QUERY_ADMIN_TOKEN') or self.admin_token
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def dump(self):
+        """ Returns the recorded slow statements, the most recent first """
+        with self._lock:
+            return list(reversed(self.queries))
+
+    def clear(self):
+        """ Forgets the recorded slow statements """
+        with self._lock:
+            self.queries.clear()
+
+    def authorized(self, authorization):
+        """ Returns whether the Authorization header <authorization> bears the
+        admin token, always False when there is none """
+        if not self.admin_token or not authorization:
+            return False
+        scheme, _, token = authorization.partition(' ')
+        return scheme.lower() == 'bearer' and \
+            hmac.compare_digest(str(token.strip()), str(self.admin_token))
+
+######################################################################
+#  S T A T E M E N T   E V E N T S
+######################################################################
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            conn.info['slow_query_start'] = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('slow_query_start', None)
+        if start is None:
+            return
+        duration = time.time() - start
+        if duration < self.threshold:
+            return
+        route = None
+        if has_request_context() and request.url_rule is not None:
+            route = '{} {}'.format(request.method, request.url_rule.rule)
+        self.logger.warning('Slow query of %.3fs on %s: %s', duration, route, statement)
+        entry = {'time': datetime.utcnow().isoformat(),
+                 'duration': round(duration, 6),
+                 'statement': statement,
+                 'parameters': repr(parameters)[:MAX_PARAMETERS_LENGTH] if self.parameters else None,
+                 'route': route,
+                 'plan': None}
+        if not executemany and random.random() < self.explain_rate:
+            entry['plan'] = self.explain(conn.dialect.name, cursor.connection,
+                                         statement, parameters, conn.engine)
+        with self._lock:
+            self.queries.append(entry)
+
+    def explain(self, dialect, connection, statement, parameters, engine=None):
+        """ Returns the plan of <statement> as a list of rows, or the error getting it
+
+        DB2 writes its plans to tables, so they are explained on a connection
+        of <engine> rather than in the transaction of the request
+        """
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return None
+        if dialect == 'ibm_db_sa':
+            return self._explain_db2(engine, statement)
+        cursor = connection.cursor()
+        try:
+            if dialect == 'postgresql':
+                cursor.execute('SAVEPOINT slow_query_explain')
+                try:
+                    cursor.execute('EXPLAIN ' + statement, parameters)
+                    plan = cursor.fetchall()
+                finally:
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                    cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            elif dialect == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = cursor.fetchall()
+            else:
+                return None
+            return [' '.join(str(column) for column in row) for row in plan]
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.info('Could not explain a slow query: %s', error)
+            return ['EXPLAIN failed: {}'.format(error)]
+        finally:
+            cursor.close()
+
+    def _explain_db2(self, engine, statement):
+        """ Returns the DB2 plan of <statement>, explained under a query number
+        of its own on a separate connection that is rolled back afterwards so
+        the explain tables don't grow """
+        queryno = next(self._explain_numbers)
+        try:
+            connection = engine.raw_connection()
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.info('Could not explain a slow query: %s', error)
+            return ['EXPLAIN failed: {}'.format(error)]
+        cursor = connection.cursor()
+        try:
+            cursor.execute(DB2_EXPLAIN_PLAN.format(queryno=queryno, tag=self._explain_tag,
+                                                   statement=statement))
+            cursor.execute(DB2_EXPLAIN_OPERATORS, (queryno, self._explain_tag))
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.info('Could not explain a slow query: %s', error)
+            return ['EXPLAIN failed: {}'.format(error)]
+        finally:
+            cursor.close()
+            connection.rollback()
+            connection.close()
@@ -0,0 +1,5 @@
+"""
+Package: benchmarks
+Performance benchmarks of the Shopcart service, run as modules from the
+project root, e.g. python -m benchmarks.read_path
+"""
@@ -0,0 +1,351 @@
+"""
+Endpoint Benchmark Suite
+
+Seeds the database with line items at one or more scales, then times every
+route of the service through the Flask test client, a real gunicorn server
+or both. The results are printed as JSON with the throughput and the p50,
+p95 and p99 latency of each endpoint, and can be saved as a baseline that
+later runs are compared with to flag regressions.
+
+Writes go to users above the seeded ones, prepared before they are timed,
+so every run reads the same data. /shopcarts/reset is left out as it would
+empty the seeded database. Every request bears the admin token the service
+is started with, which only /admin/slow-queries reads.
+
+Run it from the project root with:
+  python -m benchmarks.endpoints [--scales 1k,100k,1m] [--drivers client,server]
+      [--users N] [--distribution uniform|skewed] [--requests N]
+      [--concurrency N] [--output results.json] [--baseline results.json]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: database to benchmark, a temporary SQLite file by default
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib2
+from threading import Thread
+from app import app, db, slow_queries
+from app.model import Shopcart, CartTotal
+from benchmarks.servers import free_port, wait_until_up
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+DISTRIBUTIONS = ('uniform', 'skewed')
+BATCH_SIZE = 10000
+# Write endpoints add and remove items of these users, above any seeded user
+SCRATCH_USER_ID = 10 ** 8
+# Lets the requests read /admin/slow-queries
+ADMIN_TOKEN = 'benchmark'
+HEADERS = {'Authorization': 'Bearer {}'.format(ADMIN_TOKEN)}
+
+
+######################################################################
+#  S E E D I N G
+######################################################################
+
+def cart_users(lines, users, distribution, seed=0):
+    """ Yields the user of every line, every user having at least one line
+
+    uniform gives every user the same number of lines, skewed gives a few
+    users most of them like a power law
+    """
+    users = min(users, lines)
+    rand = random.Random(seed)
+    for number in range(lines):
+        if number < users or distribution == 'uniform':
+            yield 1 + number % users
+        else:
+            yield 1 + int(users * rand.random() ** 3)
+
+def insert_lines(lines):
+    """ Inserts (user_id, product_id, quantity, price) rows in batches """
+    table = Shopcart.__table__
+    batch = []
+    for user_id, product_id, quantity, price in lines:
+        batch.append({'user_id': user_id, 'product_id': product_id,
+                      'quantity': quantity, 'price': price})
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+def seed(lines, users, distribution):
+    """ Creates <lines> line items spread over <users> users
+
+    Returns:
+        int: the number of users with a shopcart
+    """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    products = {}
+    def generate():
+        for user_id in cart_users(lines, users, distribution):
+            product_id = products.get(user_id, 0)
+            products[user_id] = product_id + 1
+            yield user_id, product_id, 1 + product_id % 5, 0.99 + product_id % 100
+    insert_lines(generate())
+    count = CartTotal.rebuild()
+    db.session.remove()
+    return count
+
+def prepare_writes(requests):
+    """ Creates the line items the write endpoints change and remove """
+    for table in (Shopcart.__table__, CartTotal.__table__):
+        db.session.execute(table.delete().where(table.c.user_id >= SCRATCH_USER_ID))
+    lines = [(SCRATCH_USER_ID, product_id, 1, 1.99) for product_id in range(requests)]
+    lines += [(SCRATCH_USER_ID + 1, 0, 1, 1.99)]
+    lines += [(SCRATCH_USER_ID + 10 + number, 0, 1, 1.99) for number in range(requests)]
+    insert_lines(lines)
+    CartTotal.refresh([user_id for user_id, _, _, _ in lines])
+    db.session.commit()
+    db.session.remove()
+
+
+######################################################################
+#  E N D P O I N T S
+######################################################################
+
+def endpoints(users):
+    """ Returns (name, method, url, body, status) of every route to time
+
+    url and body are functions of the request number, so requests spread
+    over the seeded users and every removal has its own line item
+    """
+    def user(number):
+        return 1 + number % users
+    items = [{'product_id': product_id, 'quantity': 1, 'price': 2.49}
+             for product_id in range(10)]
+    return [
+        ('index', 'GET', lambda n: '/', None, 200),
+        ('healthcheck', 'GET', lambda n: '/healthcheck', None, 200),
+        ('get_cart', 'GET', lambda n: '/shopcarts/{}'.format(user(n)), None, 200),
+        ('get_total', 'GET', lambda n: '/shopcarts/{}/total'.format(user(n)), None, 200),
+        ('get_product', 'GET', lambda n: '/shopcarts/{}/product/0'.format(user(n)), None, 200),
+        ('list_carts', 'GET', lambda n: '/shopcarts?limit=100&cursor={}'.format(
+            (n * 100) % users), None, 200),
+        ('list_all_carts', 'GET', lambda n: '/shopcarts', None, 200),
+        ('find_users', 'GET', lambda n: '/shopcarts/users?amount={}&limit=100'.format(
+            n % 50), None, 200),
+        ('add_product', 'POST', lambda n: '/shopcarts',
+         lambda n: {'user_id': SCRATCH_USER_ID + 2, 'product_id': n % 100,
+                    'quantity': 1, 'price': 2.49}, 201),
+        ('add_items', 'POST', lambda n: '/shopcarts/{}/items'.format(SCRATCH_USER_ID + 3),
+         lambda n: items, 200),
+        ('update_product', 'PUT', lambda n: '/shopcarts/{}/product/0'.format(SCRATCH_USER_ID + 1),
+         lambda n: {'user_id': SCRATCH_USER_ID + 1, 'product_id': 0,
+                    'quantity': 1 + n % 9, 'price': 1.99}, 200),
+        ('delete_product', 'DELETE', lambda n: '/shopcarts/{}/product/{}'.format(
+            SCRATCH_USER_ID, n), None, 204),
+        ('delete_cart', 'DELETE', lambda n: '/shopcarts/{}'.format(
+            SCRATCH_USER_ID + 10 + n), None, 204),
+        ('metrics', 'GET', lambda n: '/metrics', None, 200),
+        ('slow_queries', 'GET', lambda n: '/admin/slow-queries', None, 200),
+    ]
+
+
+######################################################################
+#  D R I V E R S
+######################################################################
+
+def client_request(client):
+    """ Returns a function that sends a request through the Flask test client """
+    def send(method, url, body):
+        data = json.dumps(body) if body is not None else None
+        response = client.open(url, method=method, data=data, content_type='application/json',
+                               headers=HEADERS)
+        # streamed bodies are only produced as they are read
+        response.get_data()
+        return response.status_code
+    return send
+
+def server_request(base_url):
+    """ Returns a function that sends a request to a server over HTTP """
+    def send(method, url, body):
+        data = json.dumps(body) if body is not None else None
+        request = urllib2.Request(base_url + url, data=data,
+                                  headers=dict(HEADERS, **{'Content-Type': 'application/json'}))
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as error:
+            return error.code
+    return send
+
+def time_endpoint(send, endpoint, requests, concurrency):
+    """ Sends <requests> requests from <concurrency> threads and returns the latencies """
+    _, method, url, body, expected = endpoint
+    latencies = []
+    errors = []
+    def worker(index):
+        for number in range(index, requests, concurrency):
+            start = time.time()
+            code = send(method, url(number), body(number) if body else None)
+            latencies.append(time.time() - start)
+            if code != expected:
+                errors.append(code)
+    start = time.time()
+    if concurrency == 1:
+        worker(0)
+    else:
+        threads = [Thread(target=worker, args=(index,)) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        sys.stderr.write('{} answered {} instead of {}\n'.format(
+            endpoint[0], ', '.join(sorted(set(str(code) for code in errors))), expected))
+    return sorted(latencies), time.time() - start, errors
+
+def summarize(latencies, elapsed, errors):
+    """ Returns the throughput and latency percentiles of an endpoint """
+    def percentile(fraction):
+        return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 3)
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99)}
+
+def run_endpoints(send, users, requests, concurrency):
+    """ Times every endpoint with <send> and returns their summaries """
+    results = {}
+    for endpoint in endpoints(users):
+        if endpoint[1] == 'GET':
+            # a few reads first so connections and caches are warm
+            time_endpoint(send, endpoint, 5, 1)
+        results[endpoint[0]] = summarize(*time_endpoint(send, endpoint, requests, concurrency))
+    return results
+
+def run_client(users, requests, concurrency):
+    """ Times every endpoint through the Flask test client """
+    prepare_writes(requests)
+    slow_queries.admin_token = ADMIN_TOKEN
+    return run_endpoints(client_request(app.test_client()), users, requests, 1)
+
+def run_server(users, requests, concurrency):
+    """ Times every endpoint on gunicorn, configured like production """
+    prepare_writes(requests)
+    db.engine.dispose()
+    port = free_port()
+    environ = dict(os.environ, PORT=str(port), SLOW_QUERY_ADMIN_TOKEN=ADMIN_TOKEN,
+                   DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'])
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(['gunicorn', '--config=gunicorn_config.py',
+                                   '--bind=127.0.0.1:{}'.format(port), 'app:app'],
+                                  env=environ, stdout=devnull, stderr=devnull)
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        wait_until_up(base_url)
+        return run_endpoints(server_request(base_url), users, requests, concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+DRIVERS = {'client': run_client, 'server': run_server}
+
+
+######################################################################
+#  B A S E L I N E
+######################################################################
+
+def compare(runs, baseline, tolerance):
+    """ Returns the endpoints slower than in the baseline by more than <tolerance>
+
+    Runs are matched on scale, distribution and driver. An endpoint regressed
+    when its p95 latency grew or its throughput fell by more than the tolerance
+    """
+    def key(run):
+        return run['scale'], run['distribution'], run['driver']
+    before = dict((key(run), run['endpoints']) for run in baseline)
+    regressions = []
+    for run in runs:
+        for name, result in sorted(run['endpoints'].items()):
+            expected = before.get(key(run), {}).get(name)
+            if expected is None:
+                continue
+            if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance) or \
+               result['throughput'] < expected['throughput'] / (1 + tolerance):
+                regressions.append({'scale': run['scale'], 'driver': run['driver'],
+                                    'endpoint': name, 'p95_ms': result['p95_ms'],
+                                    'baseline_p95_ms': expected['p95_ms'],
+                                    'throughput': result['throughput'],
+                                    'baseline_throughput': expected['throughput']})
+    return regressions
+
+def run(options):
+    """ Seeds every scale, runs every driver and returns the results """
+    runs = []
+    for scale in options.scales.split(','):
+        users = seed(SCALES[scale], options.users, options.distribution)
+        for driver in options.drivers.split(','):
+            sys.stderr.write('{} lines, {} driver...\n'.format(scale, driver))
+            runs.append({'scale': scale, 'lines': SCALES[scale], 'users': users,
+                         'distribution': options.distribution, 'driver': driver,
+                         'concurrency': options.concurrency if driver == 'server' else 1,
+                         'endpoints': DRIVERS[driver](users, options.requests,
+                                                      options.concurrency)})
+    return runs
+
+def parse_args(args):
+    """ Reads the command line options """
+    parser = argparse.ArgumentParser(description='Times every endpoint of the service')
+    parser.add_argument('--scales', default='1k',
+                        help='comma separated line item counts among {}'.format(
+                            ', '.join(sorted(SCALES))))
+    parser.add_argument('--drivers', default='client,server',
+                        help='comma separated among {}'.format(', '.join(sorted(DRIVERS))))
+    parser.add_argument('--users', type=int, default=1000, help='number of users to seed')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='uniform',
+                        help='how the line items are spread over the users')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='concurrent clients of the server')
+    parser.add_argument('--output', help='file to save the results in, as a new baseline')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline flagged as a regression')
+    options = parser.parse_args(args)
+    for scale in options.scales.split(','):
+        if scale not in SCALES:
+            parser.error('unknown scale {}'.format(scale))
+    for driver in options.drivers.split(','):
+        if driver not in DRIVERS:
+            parser.error('unknown driver {}'.format(driver))
+    return options
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    directory = tempfile.mkdtemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+        'DATABASE_URI', 'sqlite:///{}'.format(os.path.join(directory, 'benchmark.db')))
+    try:
+        report = {'runs': run(options)}
+    finally:
+        shutil.rmtree(directory)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            report['regressions'] = compare(report['runs'], json.load(baseline)['runs'],
+                                            options.tolerance)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    sys.exit(1 if report.get('regressions') else 0)
@@ -0,0 +1,270 @@
+"""
+Shopcart Load Generator
+
+Replays a mix of shopcart traffic against a running service at a target
+request rate. Requests arrive open loop: they are scheduled ahead of time
+whether or not earlier ones were answered, and latency is measured from
+the scheduled time, so a saturated service shows up as growing latency
+instead of a slower load. Every user is served by one client worker with
+a keep-alive session, so the products a worker updates, reads and deletes
+are the ones it added itself.
+
+The entries posted have the shape the behave steps in features/ post.
+Arrivals and choices come from a seeded random generator, so the same
+options replay the same traffic.
+
+Run it from the project root with:
+  python -m benchmarks.load [--rate 50] [--duration 60] [--workers 8]
+      [--mix add=30,update=15,get=30,total=15,delete=10] [--reset] [--json]
+
+Enviroment Variables:
+---------------------
+    - BASE_URL: the service to load, http://localhost:5000 by default
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from collections import defaultdict
+from threading import Lock, Thread
+from Queue import Queue
+import requests
+
+BASE_URL = os.getenv('BASE_URL', 'http://localhost:5000')
+OPERATIONS = ('add', 'update', 'get', 'total', 'delete')
+DEFAULT_MIX = 'add=30,update=15,get=30,total=15,delete=10'
+# Upper bounds in milliseconds of the latency histogram buckets
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+HEADERS = {'Content-Type': 'application/json'}
+
+
+def shopcart_entry(user_id, product_id, quantity, price):
+    """ Returns a shopcart entry as the behave steps post it """
+    return {"product_id": product_id,
+            "user_id": user_id,
+            "quantity": quantity,
+            "price": price}
+
+
+class Stats(object):
+    """ Latencies, statuses and errors of every operation """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self._lock = Lock()
+
+    def record(self, operation, latency, status, error):
+        """ Records one answered or failed request """
+        with self._lock:
+            self.latencies[operation].append(latency)
+            self.statuses[operation][status] += 1
+            if error:
+                self.errors[operation] += 1
+
+    def summary(self, elapsed):
+        """ Returns the rate, error rate, percentiles and histogram of every operation """
+        summary = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            histogram = [0] * len(BUCKETS)
+            for latency in latencies:
+                histogram[next(index for index, bound in enumerate(BUCKETS)
+                               if latency * 1000 <= bound)] += 1
+            def percentile(fraction):
+                return round(latencies[min(int(len(latencies) * fraction),
+                                           len(latencies) - 1)] * 1000, 2)
+            summary[operation] = {
+                'requests': len(latencies),
+                'rate': round(len(latencies) / elapsed, 1),
+                'error_rate': round(float(self.errors[operation]) / len(latencies), 4),
+                'statuses': dict((str(status), count) for status, count
+                                 in self.statuses[operation].items()),
+                'p50_ms': percentile(0.50),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': round(latencies[-1] * 1000, 2),
+                'histogram_ms': dict((str(bound), count) for bound, count
+                                     in zip(BUCKETS, histogram) if count)}
+        return summary
+
+
+class Client(Thread):
+    """ A worker that sends the requests of its users over one keep-alive session """
+
+    def __init__(self, base_url, stats, seed, products):
+        Thread.__init__(self)
+        self.daemon = True
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.queue = Queue()
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.random = random.Random(seed)
+        self.products = products
+        # products of each user that this worker added and did not delete
+        self.lines = defaultdict(set)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            scheduled, operation, user_id = item
+            self.send(scheduled, operation, user_id)
+
+    def send(self, scheduled, operation, user_id):
+        """ Sends <operation> for <user_id> and records its latency from <scheduled> """
+        lines = self.lines[user_id]
+        if operation in ('update', 'get', 'delete') and not lines:
+            # nothing to change yet, fill the cart first
+            operation = 'add'
+        if operation == 'add':
+            product_id = self.random.randint(1, self.products)
+            # 202 when the write coalescer buffers the add
+            method, url, expected = 'POST', '/shopcarts', (201, 202)
+            body = shopcart_entry(user_id, product_id, self.random.randint(1, 5),
+                                  round(self.random.uniform(0.5, 100), 2))
+        elif operation == 'update':
+            product_id = self.random.choice(sorted(lines))
+            method, expected = 'PUT', (200,)
+            url = '/shopcarts/{}/product/{}'.format(user_id, product_id)
+            body = shopcart_entry(user_id, product_id, self.random.randint(1, 5),
+                                  round(self.random.uniform(0.5, 100), 2))
+        elif operation == 'delete':
+            product_id = self.random.choice(sorted(lines))
+            method, url, body, expected = 'DELETE', '/shopcarts/{}/product/{}'.format(
+                user_id, product_id), None, (204,)
+        elif operation == 'get':
+            method, url, body, expected = 'GET', '/shopcarts/{}'.format(user_id), None, (200,)
+        else:
+            method, body, expected = 'GET', None, (200,)
+            url = '/shopcarts/{}/total'.format(user_id)
+        try:
+            response = self.session.request(method, self.base_url + url,
+                                            data=json.dumps(body) if body else None)
+            status = response.status_code
+        except requests.RequestException as error:
+            status = type(error).__name__
+        self.stats.record(operation, time.time() - scheduled, status, status not in expected)
+        if status in expected:
+            if operation == 'add':
+                lines.add(product_id)
+            elif operation == 'delete':
+                lines.discard(product_id)
+
+
+def parse_mix(mix):
+    """ Returns the (operation, weight) pairs of a mix like add=30,get=70 """
+    weights = []
+    for part in mix.split(','):
+        operation, _, weight = part.partition('=')
+        if operation not in OPERATIONS:
+            raise ValueError('operation should be one of {}'.format(', '.join(OPERATIONS)))
+        weights.append((operation, float(weight)))
+    return weights
+
+def schedule(options):
+    """ Yields (time offset, operation, user_id) of every request to send """
+    rand = random.Random(options.seed)
+    weights = parse_mix(options.mix)
+    total = sum(weight for _, weight in weights)
+    offset = 0.0
+    while True:
+        # Poisson arrivals at the target rate
+        offset += rand.expovariate(options.rate)
+        if offset >= options.duration:
+            return
+        pick = rand.uniform(0, total)
+        for operation, weight in weights:
+            pick -= weight
+            if pick <= 0:
+                break
+        yield offset, operation, rand.randint(1, options.users)
+
+def run(options):
+    """ Sends the traffic and returns the summary of every operation """
+    if options.reset:
+        response = requests.delete(options.base_url.rstrip('/') + '/shopcarts/reset',
+                                   headers=HEADERS)
+        response.raise_for_status()
+    stats = Stats()
+    clients = [Client(options.base_url, stats, options.seed + index, options.products)
+               for index in range(options.workers)]
+    for client in clients:
+        client.start()
+    start = time.time()
+    late = 0
+    for offset, operation, user_id in schedule(options):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -0.01:
+            late += 1
+        # users are spread over the workers so one cart is only changed by one of them
+        clients[user_id % len(clients)].queue.put((start + offset, operation, user_id))
+    for client in clients:
+        client.queue.put(None)
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    if late:
+        sys.stderr.write('{} requests were scheduled late, the generator is overloaded\n'
+                         .format(late))
+    return {'target_rate': options.rate, 'elapsed': round(elapsed, 2),
+            'workers': options.workers, 'operations': stats.summary(elapsed)}
+
+def print_report(report):
+    """ Prints the summary as a table and a latency histogram per operation """
+    print('{} s at {} req/s from {} workers'.format(
+        report['elapsed'], report['target_rate'], report['workers']))
+    print('{:<8}{:>9}{:>8}{:>9}{:>10}{:>10}{:>10}{:>10}'.format(
+        'op', 'requests', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for operation, result in sorted(report['operations'].items()):
+        print('{:<8}{:>9}{:>8.1f}{:>8.1f}%{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            operation, result['requests'], result['rate'], result['error_rate'] * 100,
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms']))
+    for operation, result in sorted(report['operations'].items()):
+        print('\n{} latency'.format(operation))
+        for bound in BUCKETS:
+            count = result['histogram_ms'].get(str(bound), 0)
+            if count:
+                print('  <= {:>6} ms {:>7} {}'.format(
+                    bound, count, '#' * int(50.0 * count / result['requests'])))
+
+def parse_args(args):
+    """ Reads the command line options """
+    parser = argparse.ArgumentParser(description='Replays shopcart traffic at a target rate')
+    parser.add_argument('--base-url', default=BASE_URL, help='the service to load')
+    parser.add_argument('--rate', type=float, default=50, help='requests per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to send for')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent client workers')
+    parser.add_argument('--users', type=int, default=1000, help='number of users')
+    parser.add_argument('--products', type=int, default=500, help='number of products')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weights of {}'.format(', '.join(OPERATIONS)))
+    parser.add_argument('--seed', type=int, default=0, help='seed of the traffic')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete every shopcart of the service first')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    options = parser.parse_args(args)
+    try:
+        parse_mix(options.mix)
+    except ValueError as error:
+        parser.error(str(error))
+    return options
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    report = run(options)
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
@@ -0,0 +1,94 @@
+"""
+Read Path Benchmark
+
+Compares serializing a large shopcart read through the ORM with reading it
+as Core-level ShopcartRecords. Each path runs in its own process so the
+growth of its peak memory can be measured.
+
+Run it from the project root with:
+  python -m benchmarks.read_path [lines] [repeat]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: database to benchmark, a temporary SQLite file by default
+"""
+import os
+import sys
+import resource
+import tempfile
+import timeit
+from multiprocessing import Process, Queue
+from app import app, db
+from app.model import Shopcart, CartTotal
+
+USER_ID = 1
+WARMUP_USER_ID = 2
+
+
+def read_orm(user_id):
+    """ Serializes the shopcart from ORM instances """
+    return [entry.serialize() for entry in Shopcart.findByUserId(user_id).all()]
+
+def read_records(user_id):
+    """ Serializes the shopcart from Core-level records """
+    return [record.serialize() for record in Shopcart.find_records_by_user_id(user_id)]
+
+PATHS = (('orm', read_orm), ('records', read_records))
+
+
+def populate(lines):
+    """ Creates a shopcart of <lines> products and a small one to warm up with """
+    db.drop_all()
+    db.create_all()
+    table = Shopcart.__table__
+    rows = [{'user_id': USER_ID, 'product_id': product_id,
+             'quantity': 1 + product_id % 5, 'price': 0.99 + product_id % 100}
+            for product_id in range(lines)]
+    rows += [{'user_id': WARMUP_USER_ID, 'product_id': product_id,
+              'quantity': 1, 'price': 1.00} for product_id in range(10)]
+    db.session.execute(table.insert(), rows)
+    CartTotal.refresh([USER_ID, WARMUP_USER_ID])
+    db.session.commit()
+    db.session.remove()
+    db.engine.dispose()
+
+def measure(read, lines, repeat, results):
+    """ Times <read> and measures the memory it holds on to, in a fresh process """
+    read(WARMUP_USER_ID)
+    db.session.remove()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        cart = read(USER_ID)
+        timings.append(timeit.default_timer() - start)
+        db.session.remove()
+    assert len(cart) == lines
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((min(timings), peak - baseline))
+
+def run(lines=10000, repeat=5):
+    """ Runs every read path and prints how it compares """
+    print('Reading a shopcart of {} lines, best of {} runs'.format(lines, repeat))
+    populate(lines)
+    print('{:<10}{:>12}{:>16}{:>18}'.format('path', 'ms/read', 'us/row', 'KB peak/1k rows'))
+    for name, read in PATHS:
+        results = Queue()
+        process = Process(target=measure, args=(read, lines, repeat, results))
+        process.start()
+        best, memory = results.get()
+        process.join()
+        print('{:<10}{:>12.1f}{:>16.2f}{:>18.1f}'.format(
+            name, best * 1000, best * 1e6 / lines, memory * 1000.0 / lines))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    if os.getenv('DATABASE_URI'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI')
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,102 @@
+"""
+Serialization Benchmark
+
+Times every read endpoint with each installed JSON backend, and the field
+by field marshalling pass the handlers no longer make, on a large shopcart.
+Requests go through the Flask test client so only the service is measured.
+
+Run it from the project root with:
+  python -m benchmarks.serialization [lines] [repeat]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: database to benchmark, a temporary SQLite file by default
+"""
+import os
+import sys
+import json
+import tempfile
+import timeit
+from flask_restplus import marshal
+from app import app, db, service
+from app.model import Shopcart, CartTotal
+from app.serialization import BACKENDS, JSONSerializer
+
+USER_ID = 1
+USERS = 100
+
+ENDPOINTS = (
+    ('cart', '/shopcarts/{}'.format(USER_ID)),
+    ('total', '/shopcarts/{}/total'.format(USER_ID)),
+    ('product', '/shopcarts/{}/product/1'.format(USER_ID)),
+    ('list', '/shopcarts?limit={}'.format(USERS)),
+)
+
+
+def populate(lines):
+    """ Creates a shopcart of <lines> products and USERS small ones """
+    db.drop_all()
+    db.create_all()
+    rows = [{'user_id': USER_ID, 'product_id': product_id,
+             'quantity': 1 + product_id % 5, 'price': 0.99 + product_id % 100}
+            for product_id in range(lines)]
+    rows += [{'user_id': user_id, 'product_id': product_id, 'quantity': 1, 'price': 1.99}
+             for user_id in range(USER_ID + 1, USER_ID + USERS) for product_id in range(10)]
+    db.session.execute(Shopcart.__table__.insert(), rows)
+    CartTotal.rebuild()
+    db.session.remove()
+
+def best_time(function, repeat):
+    """ Returns the fastest of <repeat> calls of <function> """
+    function()
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def request(client, url):
+    """ Returns a function that reads <url> and checks it succeeded """
+    def get():
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+        return response.data
+    return get
+
+def run(lines=10000, repeat=5):
+    """ Times every endpoint with every backend and prints how they compare """
+    print('Reading a shopcart of {} lines, best of {} runs'.format(lines, repeat))
+    populate(lines)
+    client = app.test_client()
+    backends = []
+    for name, _ in BACKENDS:
+        serializer = JSONSerializer(name)
+        if serializer.name == name:
+            backends.append(serializer)
+    print(('{:<10}' + '{:>12}' * len(backends)).format(
+        'ms', *[serializer.name for serializer in backends]))
+    default = service.serializer
+    try:
+        for endpoint, url in ENDPOINTS:
+            timings = []
+            for serializer in backends:
+                service.serializer = serializer
+                timings.append(best_time(request(client, url), repeat))
+            print(('{:<10}' + '{:>12.2f}' * len(timings)).format(
+                endpoint, *[timing * 1000 for timing in timings]))
+    finally:
+        service.serializer = default
+
+    products = Shopcart.find_cart(USER_ID)['products']
+    marshalled = best_time(lambda: json.dumps(marshal(products, service.shopcart_model)), repeat)
+    encoded = best_time(lambda: service.serializer.dumps(products), repeat)
+    print('cart body: marshal + json {:.2f} ms, {} alone {:.2f} ms'.format(
+        marshalled * 1000, service.serializer.name, encoded * 1000))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    if os.getenv('DATABASE_URI'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI')
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    run(*[int(arg) for arg in sys.argv[1:3]])
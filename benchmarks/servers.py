@@ -0,0 +1,120 @@
+"""
+Server Benchmark
+
+Compares the throughput and latency of the gunicorn sync workers of the
+Procfile with the gevent event loop of green.py, both serving the same
+database. Each server is started in turn and sent the same number of
+concurrent cart reads.
+
+Run it from the project root with:
+  python -m benchmarks.servers [requests] [concurrency]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: database to benchmark, a temporary SQLite file by default
+    - WORKERS: number of gunicorn sync workers (default 2)
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+import urllib2
+from threading import Thread
+
+SERVERS = (
+    ('gunicorn', ['gunicorn', '--config=gunicorn_config.py', '--bind=127.0.0.1:{port}',
+                  '--worker-class=sync', '--workers={}'.format(os.getenv('WORKERS', '2')),
+                  'app:app']),
+    ('green', [sys.executable, 'green.py']),
+)
+USERS = 50
+LINES = 20
+
+
+def free_port():
+    """ Returns a port nobody listens on """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_until_up(base_url):
+    """ Waits for a server to answer its health check """
+    for _ in range(200):
+        try:
+            urllib2.urlopen(base_url + '/healthcheck', timeout=1)
+            return
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.1)
+    raise RuntimeError('{} did not start'.format(base_url))
+
+def populate(base_url):
+    """ Creates the shopcarts the benchmark reads """
+    reset = urllib2.Request(base_url + '/shopcarts/reset')
+    reset.get_method = lambda: 'DELETE'
+    urllib2.urlopen(reset).read()
+    for user_id in range(1, USERS + 1):
+        lines = [dict(product_id=product_id, quantity=1, price=1.99)
+                 for product_id in range(LINES)]
+        request = urllib2.Request('{}/shopcarts/{}/items'.format(base_url, user_id),
+                                  data=json.dumps(lines),
+                                  headers={'Content-Type': 'application/json'})
+        urllib2.urlopen(request).read()
+
+def load(base_url, requests, concurrency):
+    """ Reads shopcarts from <concurrency> threads and returns every latency """
+    latencies = []
+    def client(index):
+        for number in range(index, requests, concurrency):
+            start = time.time()
+            urllib2.urlopen('{}/shopcarts/{}'.format(base_url, number % USERS + 1)).read()
+            latencies.append(time.time() - start)
+    threads = [Thread(target=client, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def run(requests=2000, concurrency=20):
+    """ Benchmarks every server and prints how they compare """
+    directory = tempfile.mkdtemp()
+    database_uri = os.getenv('DATABASE_URI',
+                             'sqlite:///{}'.format(os.path.join(directory, 'benchmark.db')))
+    print('{} cart reads from {} clients on {}'.format(requests, concurrency, database_uri))
+    print('{:<10}{:>10}{:>12}{:>12}'.format('server', 'req/s', 'p50 ms', 'p99 ms'))
+    try:
+        for name, command in SERVERS:
+            port = free_port()
+            environ = dict(os.environ, PORT=str(port), DATABASE_URI=database_uri)
+            with open(os.devnull, 'w') as devnull:
+                server = subprocess.Popen([part.format(port=port) for part in command],
+                                          env=environ, stdout=devnull, stderr=devnull)
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            try:
+                wait_until_up(base_url)
+                populate(base_url)
+                start = time.time()
+                latencies = sorted(load(base_url, requests, concurrency))
+                elapsed = time.time() - start
+            finally:
+                server.terminate()
+                server.wait()
+            print('{:<10}{:>10.0f}{:>12.1f}{:>12.1f}'.format(
+                name, len(latencies) / elapsed,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
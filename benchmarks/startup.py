@@ -0,0 +1,146 @@
+"""
+Startup Benchmark
+
+Measures how long a fresh interpreter takes from importing the application
+to answering its first shopcart request. The schema is created beforehand,
+as the server runners do before serving.
+
+Seconds depend on the machine, so the median is divided by the median time
+a fresh interpreter takes to import the frameworks the service is built on,
+measured alongside on the same machine. The check fails when that ratio is
+over STARTUP_MAX_RATIO, or over the ratio of a baseline saved by an earlier
+run by more than the tolerance, so a slower cold start is caught before it
+ships. tests/test_startup.py runs it with the test suite.
+
+Run it from the project root with:
+  python -m benchmarks.startup [--runs N] [--output results.json]
+      [--baseline results.json] [--tolerance 0.2]
+
+Enviroment Variables:
+---------------------
+    - DATABASE_URI: database to start against, a temporary SQLite file by default
+    - STARTUP_MAX_RATIO: most the import-to-ready time may take, in times the
+      import of the frameworks (default 2.0)
+"""
+import os
+import sys
+import json
+import argparse
+import shutil
+import tempfile
+import subprocess
+
+# Runs in the child: times the import and the first request, and reports
+# which database dialects got imported on the way
+PROBE = """
+import sys, time, json
+start = time.time()
+from app import app
+imported = time.time() - start
+response = app.test_client().get('/shopcarts/1/total')
+ready = time.time() - start
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': imported, 'ready': ready,
+                  'dialects': sorted(name for name in ('ibm_db_sa', 'ibm_db', 'psycopg2')
+                                     if name in sys.modules)}))
+"""
+
+# Runs in the child: times the import of the frameworks alone, the yardstick
+# of this machine
+REFERENCE = """
+import time, json
+start = time.time()
+import flask, flask_restplus, flask_sqlalchemy, sqlalchemy
+print(json.dumps({'import': time.time() - start}))
+"""
+
+DEFAULT_MAX_RATIO = 2.0
+
+
+def measure(database_uri, probe=PROBE):
+    """ Runs <probe> in a fresh interpreter and returns its timings """
+    environ = dict(os.environ, DATABASE_URI=database_uri)
+    output = subprocess.check_output([sys.executable, '-c', probe], env=environ,
+                                     stderr=open(os.devnull, 'w'))
+    return json.loads(output.strip().splitlines()[-1])
+
+def create_schema(database_uri):
+    """ Creates the schema in a separate interpreter, like the runners do at startup """
+    environ = dict(os.environ, DATABASE_URI=database_uri)
+    subprocess.check_call([sys.executable, '-c', 'from app import service; service.init_db()'],
+                          env=environ, stdout=open(os.devnull, 'w'),
+                          stderr=open(os.devnull, 'w'))
+
+def median(values):
+    """ Returns the middle one of <values> """
+    return sorted(values)[len(values) // 2]
+
+def run(runs=5, database_uri=None):
+    """ Measures the startup <runs> times, alternating with the reference
+
+    Returns:
+        dict: the median 'import', 'ready' and 'reference' seconds, the
+        'ratio' of ready to reference and the database 'dialects' imported
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        database_uri = database_uri or os.getenv(
+            'DATABASE_URI', 'sqlite:///{}'.format(os.path.join(directory, 'startup.db')))
+        create_schema(database_uri)
+        results, references = [], []
+        for _ in range(runs):
+            references.append(measure(database_uri, REFERENCE))
+            results.append(measure(database_uri))
+    finally:
+        shutil.rmtree(directory)
+    report = {'runs': runs,
+              'import': median([result['import'] for result in results]),
+              'ready': median([result['ready'] for result in results]),
+              'reference': median([reference['import'] for reference in references]),
+              'dialects': results[0]['dialects']}
+    report['ratio'] = report['ready'] / report['reference']
+    return report
+
+def check(report, max_ratio, baseline=None, tolerance=0.2):
+    """ Returns why the startup of <report> regressed, or None if it didn't """
+    if report['ratio'] > max_ratio:
+        return 'ready in {:.2f} times the reference, over {:.2f}'.format(
+            report['ratio'], max_ratio)
+    if baseline is not None and report['ratio'] > baseline['ratio'] * (1 + tolerance):
+        return 'ready in {:.2f} times the reference, {:.2f} in the baseline'.format(
+            report['ratio'], baseline['ratio'])
+    return None
+
+def parse_args(args):
+    """ Reads the command line options """
+    parser = argparse.ArgumentParser(description='Times the cold start of the service')
+    parser.add_argument('--runs', type=int, default=5, help='starts to take the median of')
+    parser.add_argument('--output', help='file to save the results in, as a new baseline')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline flagged as a regression')
+    return parser.parse_args(args)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    report = run(options.runs)
+    print('median of {} starts: import {:.3f}s, ready {:.3f}s, reference {:.3f}s, '
+          'ratio {:.2f}'.format(report['runs'], report['import'], report['ready'],
+                                report['reference'], report['ratio']))
+    print('database drivers imported: {}'.format(', '.join(report['dialects']) or 'none'))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as source:
+            baseline = json.load(source)
+    failure = check(report, float(os.getenv('STARTUP_MAX_RATIO', DEFAULT_MAX_RATIO)),
+                    baseline, options.tolerance)
+    if failure:
+        print('FAIL: startup regressed, {}'.format(failure))
+    sys.exit(1 if failure else 0)
@@ -0,0 +1,43 @@
+"""
+Shopcart Service Green Runner
+Serves the Shopcart Service on a gevent event loop, so a single process
+keeps handling requests while others wait on the database
+
+The standard library and the psycopg2 driver are patched to yield to the
+event loop instead of blocking, and the SQLAlchemy connection pool waits
+cooperatively for a free connection. Size it with DB_POOL_SIZE and
+DB_MAX_OVERFLOW so it can serve GREEN_CONCURRENCY requests at once.
+SQLite works too, but its queries still block the loop.
+
+Enviroment Variables:
+---------------------
+    - PORT: port to listen on
+    - GREEN_CONCURRENCY: maximum number of requests served at once
+"""
+from gevent import monkey
+monkey.patch_all()
+
+# pylint: disable=wrong-import-position
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from psycogreen.gevent import patch_psycopg
+from app import app, service
+
+patch_psycopg()
+
+PORT = os.getenv('PORT', '5000')
+CONCURRENCY = int(os.getenv('GREEN_CONCURRENCY', '100'))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print "*********************************"
+    print " S H O P C A R T   S E R V I C E "
+    print "*********************************"
+    service.initialize_logging()
+    service.init_db()
+    server = WSGIServer(('0.0.0.0', int(PORT)), app, spawn=Pool(CONCURRENCY))
+    print 'Serving {} requests at once on port {}'.format(CONCURRENCY, PORT)
+    server.serve_forever()
@@ -0,0 +1,99 @@
+"""
+Gunicorn Configuration
+Runs the Shopcart Service with the worker model selected by the environment:
+
+    sync    - one request at a time per worker process
+    gthread - a pool of threads per worker process (default)
+    gevent  - many requests per worker process on an event loop, with
+              psycopg2 made green so database calls don't block it
+
+Worker and thread counts are sized to the CPUs unless they are given.
+The application is preloaded in the master so workers fork with it already
+imported, the schema is migrated there before the first worker starts, and
+every worker drops the database connections it inherited and writes its
+log records from a background thread of its own.
+
+Usage:
+------
+    gunicorn --config=gunicorn_config.py app:app
+
+Enviroment Variables:
+---------------------
+    - PORT: port to listen on
+    - GUNICORN_WORKER_CLASS: sync, gthread or gevent
+    - GUNICORN_WORKERS: number of worker processes
+    - GUNICORN_MAX_WORKERS: most worker processes sized to the CPUs (default 8)
+    - GUNICORN_THREADS: threads of each gthread worker
+    - GUNICORN_WORKER_CONNECTIONS: concurrent requests of each gevent worker
+    - GUNICORN_KEEPALIVE: seconds to keep an idle connection open
+    - GUNICORN_MAX_REQUESTS: requests served before a worker is recycled
+    - GUNICORN_TIMEOUT: seconds before a silent worker is restarted
+    - GUNICORN_PRELOAD: False to import the application in every worker
+"""
+import os
+import logging
+import multiprocessing
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+
+def worker_model(worker_class, cpus, max_workers=8):
+    """ Returns the default (workers, threads) of <worker_class> on <cpus> CPUs """
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError('GUNICORN_WORKER_CLASS should be one of {}'.format(
+            ', '.join(WORKER_CLASSES)))
+    if worker_class == 'sync':
+        # processes wait on the database, so have more of them than CPUs
+        return min(2 * cpus + 1, max_workers), 1
+    if worker_class == 'gthread':
+        return min(cpus + 1, max_workers), 4
+    # one event loop per CPU
+    return min(cpus, max_workers), 1
+
+def env_int(name, default):
+    """ Returns the environment variable <name> as an int """
+    return int(os.getenv(name, default))
+
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+_workers, _threads = worker_model(worker_class, multiprocessing.cpu_count(),
+                                  env_int('GUNICORN_MAX_WORKERS', 8))
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = env_int('GUNICORN_WORKERS', _workers)
+threads = env_int('GUNICORN_THREADS', _threads)
+worker_connections = env_int('GUNICORN_WORKER_CONNECTIONS', 100)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = max_requests // 10
+timeout = env_int('GUNICORN_TIMEOUT', 30)
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True') == 'True'
+accesslog = '-'
+
+if worker_class == 'gevent':
+    # Patch before the application is preloaded, so everything it creates is green
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def when_ready(server):
+    """ Migrates the schema once, before any worker serves a request """
+    from app import service
+    service.init_db()
+    server.log.info('Database schema up to date')
+
+def post_fork(server, worker):
+    """ Drops the database connections inherited from the master and starts
+    the log writer of the worker, as threads don't survive the fork """
+    from app import db, service
+    db.engine.dispose()
+    server.log.info('Worker %s disposed of the inherited database connections', worker.pid)
+    service.initialize_logging(logging.getLogger('gunicorn.error').level)
+
+def worker_exit(server, worker):
+    """ Writes the adds the worker still has buffered, then its queued log records """
+    from app import service, write_coalescer
+    write_coalescer.stop()
+    service.stop_logging()
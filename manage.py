@@ -10,8 +10,16 @@ Enviroment Variables:
 ---------------------
     - SQLALCHEMY_DATABASE_URI : connection string from config
     - DATABASE_URI: override config string
+Pending schema migrations are applied in order unless --plan is given.
 Arguments:
 ----------
+    - --plan : print the migrations that would be applied and their SQL
+               without changing the database
+    - --verify-totals : compare the cart_totals summary with the line items
+                        and exit with status 1 if they differ
+    - --rebuild-totals : recompute the cart_totals summary from the line items
+    - --migrate-prices : convert prices stored as floating point numbers into
+                         integer cents and recompute the cart_totals summary
     - database_name : String the name of the database
 """
 import os
@@ -19,10 +27,18 @@ import sys
 import re
 import psycopg2
 from app import app, db
+from app import migrations
+from app.model import Shopcart, CartTotal
 
 DATABASE_URI = os.getenv('DATABASE_URI', None)
+COMMANDS = ('--plan', '--verify-totals', '--rebuild-totals', '--migrate-prices')
 
 if __name__ == '__main__':
+    args = sys.argv[1:]
+    command = None
+    if args and args[0] in COMMANDS:
+        command = args.pop(0)
+
     if DATABASE_URI:
         print('Using: {}'.format(DATABASE_URI))
         app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
@@ -30,8 +46,8 @@ if __name__ == '__main__':
         print('DATABASE_URI not set, using SQLALCHEMY_DATABASE_URI from app.')
 
     # check to see if there is a database name override
-    if len(sys.argv) > 1:
-        dbname = sys.argv[1]
+    if args:
+        dbname = args[0]
         app.config['SQLALCHEMY_DATABASE_URI'] = '{}/{}'.format(
             app.config['SQLALCHEMY_DATABASE_URI'].rsplit('/', 1)[0],
             dbname
@@ -39,11 +55,38 @@ if __name__ == '__main__':
 
     print('Database URI {}'.format(app.config['SQLALCHEMY_DATABASE_URI']))
 
-    # If the database doesn't exist an exception will be thrown
-    # so we catch it and create the database
+    if command == '--verify-totals':
+        differences = CartTotal.verify()
+        for user_id, stored, expected in differences:
+            print('user {}: stored {} expected {}'.format(user_id, stored, expected))
+        print('{} shopcart totals differ from the line items.'.format(len(differences)))
+        sys.exit(1 if differences else 0)
+
+    if command == '--plan':
+        pending = migrations.plan()
+        for migration, statements in pending:
+            print('{}: {}'.format(migration.version, migration.description))
+            for statement in statements:
+                print('    {}'.format(statement))
+        print('{} migrations pending.'.format(len(pending)))
+        sys.exit(0)
+
     try:
-        print('Creating database schema...')
-        db.create_all()
-        print('Schema created.')
+        print('Migrating database schema...')
+        for migration in migrations.migrate():
+            print('Applied {}: {}'.format(migration.version, migration.description))
+        print('Schema is up to date.')
     except Exception as error:
-        print('Oops, got error {}'.format(error.message))
+        print('Oops, got error {}'.format(error))
+        sys.exit(1)
+
+    if command == '--rebuild-totals':
+        print('Rebuilding shopcart totals...')
+        print('Totals rebuilt for {} users.'.format(CartTotal.rebuild()))
+
+    if command == '--migrate-prices':
+        print('Converting prices into cents...')
+        if Shopcart.migrate_prices():
+            print('Prices converted.')
+        else:
+            print('Prices are already stored in cents.')
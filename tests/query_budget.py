@@ -0,0 +1,93 @@
+"""
+Query Budget
+
+Test helpers that record the SQL statements run while a block of a test
+executes, so a test can assert how many a request may run. Statements
+that differ only in their parameters have the same shape; a shape that
+runs again and again is the mark of a query in a loop (N+1), so it fails
+the budget even when the total is still under it.
+
+Usage:
+------
+    class TestSomething(QueryBudgetMixin, unittest.TestCase):
+
+        def test_list(self):
+            with self.assertQueryBudget(2):
+                self.app.get('/shopcarts')
+"""
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Bound parameters of the qmark, pyformat and named styles
+PARAMETER = r'(?:\?|%\(\w+\)s|%s|:\w+)'
+IN_LIST = re.compile(r'IN \({0}(?:, {0})*\)'.format(PARAMETER))
+WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """ Returns <statement> with its whitespace and IN lists collapsed """
+    return IN_LIST.sub('IN (?)', WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryLog(object):
+    """ The statements run while it was recording """
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def shapes(self):
+        """ Returns how often every statement shape ran, in the order they first ran """
+        shapes = OrderedDict()
+        for statement in self.statements:
+            shape = statement_shape(statement)
+            shapes[shape] = shapes.get(shape, 0) + 1
+        return shapes
+
+    def repeated(self, max_repeats=1):
+        """ Returns (shape, count) of the shapes that ran more than <max_repeats> times """
+        return [(shape, count) for shape, count in self.shapes().items()
+                if count > max_repeats]
+
+    def report(self):
+        """ Returns the statements one per line, to explain a failure """
+        return '\n'.join('{:>3}. {}'.format(number, statement_shape(statement))
+                         for number, statement in enumerate(self.statements, 1))
+
+
+@contextmanager
+def recorded_queries():
+    """ Records the statements every engine runs until the block ends """
+    log = QueryLog()
+    def record(conn, cursor, statement, parameters, context, executemany):
+        log.statements.append(statement)
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        yield log
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+
+class QueryBudgetMixin(object):
+    """ Assertions on the statements a block of a unittest.TestCase runs """
+
+    @contextmanager
+    def assertQueryBudget(self, budget, max_repeats=1, label=''):
+        """ Fails unless the block runs at most <budget> statements and
+        no statement shape more than <max_repeats> times """
+        with recorded_queries() as log:
+            yield log
+        prefix = '{}: '.format(label) if label else ''
+        if len(log) > budget:
+            self.fail('{}{} statements ran, over the budget of {}:\n{}'.format(
+                prefix, len(log), budget, log.report()))
+        repeated = log.repeated(max_repeats)
+        if repeated:
+            self.fail('{}likely N+1, statements ran more than {} times:\n{}'.format(
+                prefix, max_repeats,
+                '\n'.join('{} x {}'.format(count, shape) for shape, count in repeated)))
@@ -0,0 +1,305 @@
+"""
+Test cases for the Cart Cache
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import threading
+import SocketServer
+from mock import patch
+from app.cache import CartCache, RedisCartCache, create_cart_cache
+from app.model import Shopcart, CartTotal, db
+from app.service import app
+from app import cart_cache
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestCartCache(unittest.TestCase):
+
+    """ Test Cases for the CartCache """
+
+    def test_get_and_set(self):
+        """ Cache a shopcart and read it back """
+        cache = CartCache(maxsize=2, enabled=True)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, ['cart'])
+        self.assertEqual(cache.get(1), ['cart'])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_lru_eviction(self):
+        """ Evict the least recently used shopcart when full """
+        cache = CartCache(maxsize=2, enabled=True)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'one')
+        self.assertEqual(cache.get(3), 'three')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+        """ Expire shopcarts after their time to live """
+        cache = CartCache(ttl=10, enabled=True)
+        with patch('app.cache.time.time', return_value=100.0):
+            cache.set(1, 'one')
+        with patch('app.cache.time.time', return_value=105.0):
+            self.assertEqual(cache.get(1), 'one')
+        with patch('app.cache.time.time', return_value=111.0):
+            self.assertIsNone(cache.get(1))
+
+    def test_disabled(self):
+        """ Never cache anything when disabled """
+        cache = CartCache(enabled=False)
+        self.assertEqual(cache.get_or_load(1, lambda: 'one'), 'one')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_get_or_load_skips_stale_value(self):
+        """ Don't keep a shopcart loaded while it was being invalidated """
+        cache = CartCache(enabled=True)
+        def loader():
+            cache.invalidate(1)
+            return 'stale'
+        self.assertEqual(cache.get_or_load(1, loader), 'stale')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get_or_load(1, lambda: 'fresh'), 'fresh')
+        self.assertEqual(cache.get(1), 'fresh')
+
+
+class RedisStandIn(SocketServer.ThreadingTCPServer):
+    """ In-process server speaking enough of the Redis protocol for the cart cache """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RedisStandInHandler)
+        self.data = {}
+        self.ttls = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:{}/0'.format(self.server_address[1])
+
+    def execute(self, args):
+        """ Runs one command and returns its encoded reply """
+        command = args[0].upper()
+        with self.lock:
+            if command == 'GET':
+                return self.bulk(self.data.get(args[1]))
+            if command == 'MGET':
+                values = [self.bulk(self.data.get(key)) for key in args[1:]]
+                return '*{}\r\n{}'.format(len(values), ''.join(values))
+            if command == 'SETEX':
+                self.data[args[1]] = args[3]
+                self.ttls[args[1]] = int(args[2])
+                return '+OK\r\n'
+            if command == 'INCRBY':
+                value = int(self.data.get(args[1], 0)) + int(args[2])
+                self.data[args[1]] = str(value)
+                return ':{}\r\n'.format(value)
+        return '-ERR unknown command {}\r\n'.format(command)
+
+    @staticmethod
+    def bulk(value):
+        if value is None:
+            return '$-1\r\n'
+        return '${}\r\n{}\r\n'.format(len(value), value)
+
+
+class RedisStandInHandler(SocketServer.StreamRequestHandler):
+    """ Reads commands sent as arrays of bulk strings """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.server.execute(args))
+
+
+class TestRedisCartCache(unittest.TestCase):
+
+    """ Test Cases for the RedisCartCache """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Start the stand-in server once per Test suite """
+        cls.server = RedisStandIn()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.data.clear()
+        self.server.ttls.clear()
+
+    def test_shared_between_workers(self):
+        """ Share a cached shopcart between workers and invalidate it for all """
+        worker1 = RedisCartCache(url=self.server.url, enabled=True)
+        worker2 = RedisCartCache(url=self.server.url, enabled=True)
+        self.assertEqual(worker1.get_or_load(1, lambda: {'products': [1]}), {'products': [1]})
+        self.assertEqual(worker2.get(1), {'products': [1]})
+        worker2.invalidate(1)
+        self.assertIsNone(worker1.get(1))
+        worker1.set(1, {'products': [2]})
+        self.assertEqual(worker2.get(1), {'products': [2]})
+        worker1.clear()
+        self.assertIsNone(worker2.get(1))
+        self.assertEqual(worker2.stats()['hits'], 2)
+
+    def test_versions_expire(self):
+        """ Expire the version of a shopcart after its entries, never reusing it """
+        cache = RedisCartCache(url=self.server.url, enabled=True, ttl=30)
+        cache.set(1, 'cached')
+        cache.invalidate(1)
+        version = self.server.data['shopcart:version:1']
+        self.assertEqual(self.server.ttls['shopcart:cart:0:1:0'], 30)
+        self.assertEqual(self.server.ttls['shopcart:version:1'], 300)
+        cache.invalidate(1)
+        self.assertNotEqual(self.server.data['shopcart:version:1'], version)
+        self.assertIsNone(cache.get(1))
+
+    def test_get_or_load_skips_stale_value(self):
+        """ Never serve a shopcart loaded while another worker wrote it """
+        worker1 = RedisCartCache(url=self.server.url, enabled=True)
+        worker2 = RedisCartCache(url=self.server.url, enabled=True)
+        def loader():
+            worker2.invalidate(1)
+            return 'stale'
+        self.assertEqual(worker1.get_or_load(1, loader), 'stale')
+        self.assertIsNone(worker2.get(1))
+
+    def test_server_unreachable(self):
+        """ Read from the database while the cache server is unreachable """
+        cache = RedisCartCache(url='redis://127.0.0.1:1/0', enabled=True)
+        self.assertEqual(cache.get_or_load(1, lambda: 'loaded'), 'loaded')
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        stats = cache.stats()
+        self.assertFalse(stats['available'])
+        self.assertEqual(stats['errors'], 1)
+
+    def test_recovery_drops_old_entries(self):
+        """ Forget every shopcart cached before the server was unreachable """
+        worker1 = RedisCartCache(url=self.server.url, enabled=True)
+        worker1.set(1, 'old')
+        worker2 = RedisCartCache(url='redis://127.0.0.1:1/0', enabled=True,
+                                 retry_interval=0)
+        worker2.invalidate(1)
+        worker2._client = None
+        worker2.url = self.server.url
+        self.assertIsNone(worker2.get(1))
+        self.assertIsNone(worker1.get(1))
+
+    def test_disabled(self):
+        """ Never reach the server when disabled """
+        cache = RedisCartCache(url='redis://127.0.0.1:1/0', enabled=False)
+        self.assertEqual(cache.get_or_load(1, lambda: 'one'), 'one')
+        cache.invalidate(1)
+        cache.clear()
+        self.assertEqual(cache.stats()['errors'], 0)
+
+    def test_create_cart_cache(self):
+        """ Create the backend selected in the configuration """
+        self.assertIsInstance(create_cart_cache(app), CartCache)
+        with patch.dict(app.config, {'CART_CACHE_BACKEND': 'redis'}):
+            self.assertIsInstance(create_cart_cache(app), RedisCartCache)
+
+
+class TestShopcartCaching(unittest.TestCase):
+
+    """ Test Cases for reading Shopcarts through the cache """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        Shopcart.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        cart_cache.clear()
+        cart_cache.enabled = True
+
+    def tearDown(self):
+        cart_cache.enabled = app.config['CART_CACHE_ENABLED']
+        cart_cache.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def test_find_cart_is_cached(self):
+        """ Read a shopcart from the cache once it was loaded """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        cart = Shopcart.find_cart(1)
+        self.assertEqual(cart['total_price'], 20.00)
+        with patch.object(Shopcart, 'findByUserId') as find:
+            self.assertIs(Shopcart.find_cart(1), cart)
+            self.assertFalse(find.called)
+
+    def test_find_cached_product(self):
+        """ Find a product in the cached shopcart """
+        Shopcart.add_or_increment_many(1, [{"product_id": product_id, "quantity": 1, "price": 2.5}
+                                           for product_id in (3, 1, 7)])
+        cart = Shopcart.find_cart(1)
+        self.assertEqual(cart['product_ids'], [1, 3, 7])
+        with patch.object(db.session, 'execute') as execute:
+            self.assertIs(Shopcart.find_cart_product(1, 3)[0], cart['products'][1])
+            self.assertEqual(Shopcart.find_cart_product(1, 4), (None, cart['version']))
+            self.assertEqual(Shopcart.find_cart_product(1, 9), (None, cart['version']))
+            self.assertFalse(execute.called)
+
+    def test_writes_invalidate_cart(self):
+        """ Drop a cached shopcart on every write to it """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        Shopcart.find_cart(1)
+        Shopcart.add_or_increment(1, 1, 1, 10.00)
+        self.assertEqual(Shopcart.find_cart(1)['products'][0]['quantity'], 3)
+        Shopcart.add_or_increment_many(1, [{"product_id": 2, "quantity": 1, "price": 5.00}])
+        self.assertEqual(Shopcart.find_cart(1)['total_price'], 35.00)
+        Shopcart.find(1, 2).delete()
+        self.assertEqual(len(Shopcart.find_cart(1)['products']), 1)
+        Shopcart.delete_by_user(1)
+        self.assertEqual(Shopcart.find_cart(1)['products'], [])
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        self.assertEqual(len(Shopcart.find_cart(1)['products']), 1)
+        Shopcart.remove_all()
+        self.assertEqual(Shopcart.find_cart(1)['products'], [])
+
+    def test_rollback_keeps_cart(self):
+        """ Keep a cached shopcart when its write is rolled back """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        cart = Shopcart.find_cart(1)
+        db.session.add(Shopcart(user_id=1, product_id=2, quantity=1, price=5.00))
+        CartTotal.refresh([1])
+        db.session.rollback()
+        self.assertIs(Shopcart.find_cart(1), cart)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
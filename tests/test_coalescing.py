@@ -0,0 +1,245 @@
+"""
+Test cases for the Write Coalescer
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import json
+import time
+from mock import patch
+from query_budget import QueryBudgetMixin
+from app.model import Shopcart, CartTotal, db
+from app import write_coalescer
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestWriteCoalescer(QueryBudgetMixin, unittest.TestCase):
+
+    """ Test Cases for the write-behind buffer of the adds """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        write_coalescer.enabled = True
+        write_coalescer.window = 60
+        write_coalescer.adds = write_coalescer.writes = 0
+        write_coalescer.flushes = write_coalescer.failures = write_coalescer.dropped = 0
+        self.app = app.test_client()
+
+    def tearDown(self):
+        write_coalescer.stop()
+        write_coalescer.enabled = False
+        write_coalescer.window = 0.05
+        db.session.remove()
+        db.drop_all()
+
+    def add(self, product_id, quantity=1, user_id=1):
+        """ Posts an add of a product and returns the response """
+        data = {'user_id': user_id, 'product_id': product_id, 'quantity': quantity, 'price': 5.0}
+        return self.app.post('/shopcarts', data=json.dumps(data),
+                             content_type='application/json')
+
+    def stored_quantity(self, user_id, product_id):
+        """ Returns the quantity in the database, without flushing the buffer """
+        row = db.session.execute(Shopcart.__table__.select().where(
+            (Shopcart.user_id == user_id) & (Shopcart.product_id == product_id))).fetchone()
+        db.session.remove()
+        return row.quantity if row is not None else None
+
+    def test_merge_adds(self):
+        """ Merge the adds of the same product into one write """
+        for count in range(1, 6):
+            resp = self.add(1)
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(json.loads(resp.data)['quantity'], count)
+        self.add(2, quantity=3)
+        self.assertEqual(self.stored_quantity(1, 1), 1)
+        self.assertEqual(write_coalescer.stats()['pending'], 2)
+        self.assertTrue(write_coalescer.flush())
+        self.assertEqual(self.stored_quantity(1, 1), 6)
+        self.assertEqual(self.stored_quantity(1, 2), 3)
+        stats = write_coalescer.stats()
+        self.assertEqual((stats['adds'], stats['writes'], stats['flushes']), (6, 2, 1))
+        self.assertEqual(stats['ratio'], 3.0)
+
+    def test_read_your_writes(self):
+        """ Write the pending adds of a user before reading the shopcart """
+        self.add(1)
+        self.add(1)
+        self.add(3, user_id=2)
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[0]['quantity'], 3)
+        resp = self.app.get('/shopcarts/1/total')
+        self.assertEqual(json.loads(resp.data)['total_price'], 36.0)
+        resp = self.app.get('/shopcarts')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertEqual(write_coalescer.stats()['pending'], 0)
+
+    def test_bounded_latency(self):
+        """ Write the adds one window after they were made """
+        write_coalescer.window = 0.01
+        write_coalescer.stop()
+        self.add(1)
+        deadline = time.time() + 5
+        while write_coalescer.stats()['writes'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.stored_quantity(1, 1), 2)
+
+    def test_flush_on_stop(self):
+        """ Write the buffered adds when the coalescer stops """
+        self.add(1)
+        self.add(4)
+        write_coalescer.stop()
+        self.assertEqual(self.stored_quantity(1, 1), 2)
+        self.assertEqual(self.stored_quantity(1, 4), 1)
+
+    def test_failed_write(self):
+        """ Keep the adds of a failed write for the next one """
+        self.add(1)
+        with patch.object(Shopcart, 'apply_increments', side_effect=RuntimeError('down')):
+            self.assertTrue(write_coalescer.flush())
+        self.add(1)
+        stats = write_coalescer.stats()
+        self.assertEqual((stats['pending'], stats['failures']), (2, 1))
+        write_coalescer.flush()
+        self.assertEqual(self.stored_quantity(1, 1), 3)
+
+    def test_retry_apart_from_new_adds(self):
+        """ Drop only the line that keeps failing, not the adds made after it """
+        self.add(1, quantity=2)
+        apply_increments = Shopcart.apply_increments
+        def fail_twos(lines):
+            if any(line['quantity'] == 2 for line in lines):
+                raise RuntimeError('down')
+            apply_increments(lines)
+        with patch.object(Shopcart, 'apply_increments', side_effect=fail_twos):
+            write_coalescer.flush()
+            for _ in range(2):
+                self.assertEqual(json.loads(self.add(1).data)['quantity'], 3)
+                write_coalescer.flush()
+        stats = write_coalescer.stats()
+        self.assertEqual((stats['pending'], stats['failures'], stats['dropped']), (0, 3, 1))
+        self.assertEqual(write_coalescer.dead_letters[-1]['quantity'], 2)
+        self.assertEqual(self.stored_quantity(1, 1), 3)
+
+    def test_refuse_adds_over_failed_lines(self):
+        """ Count the lines that failed in the quantity an add may reach """
+        self.add(1, quantity=2 ** 31 - 3)
+        with patch.object(Shopcart, 'apply_increments', side_effect=RuntimeError('down')):
+            write_coalescer.flush()
+        self.assertEqual(self.add(1, quantity=3).status_code, 400)
+        resp = self.add(1)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(json.loads(resp.data)['quantity'], 2 ** 31 - 2)
+
+    def test_failing_user(self):
+        """ Write the lines of the other users when those of one fail """
+        self.add(1)
+        self.add(7, user_id=2)
+        apply_increments = Shopcart.apply_increments
+        def fail_user_2(lines):
+            if lines[0]['user_id'] == 2:
+                raise RuntimeError('down')
+            apply_increments(lines)
+        with patch.object(Shopcart, 'apply_increments', side_effect=fail_user_2):
+            write_coalescer.flush()
+            self.assertEqual(self.stored_quantity(1, 1), 2)
+            self.assertEqual(write_coalescer.stats()['pending'], 1)
+            resp = self.app.get('/shopcarts/users?amount=0')
+            self.assertEqual(resp.status_code, 200)
+            write_coalescer.flush()
+        stats = write_coalescer.stats()
+        self.assertEqual((stats['pending'], stats['failures'], stats['dropped']), (0, 3, 1))
+        self.assertEqual(write_coalescer.dead_letters[-1]['product_id'], 7)
+        self.assertEqual(self.stored_quantity(2, 7), None)
+
+    def test_stop_with_failing_lines(self):
+        """ Stop without raising when lines can't be written """
+        self.add(1)
+        with patch.object(Shopcart, 'apply_increments', side_effect=RuntimeError('down')):
+            write_coalescer.stop()
+        self.assertEqual(write_coalescer.stats()['pending'], 0)
+        self.assertEqual(write_coalescer.stats()['dropped'], 1)
+
+    def test_refuse_bad_adds(self):
+        """ Refuse the adds that can't be written instead of buffering them """
+        for product_id, quantity in ((2 ** 64, 1), (1, 2 ** 31), (1, 1.5), ('x', 1)):
+            resp = self.add(product_id, quantity=quantity)
+            self.assertEqual(resp.status_code, 400, (product_id, quantity))
+        self.assertEqual(write_coalescer.stats()['pending'], 0)
+        self.assertEqual(self.add(1, quantity=2 ** 31 - 1).status_code, 202)
+        self.assertEqual(self.add(1).status_code, 400)
+        self.assertEqual(write_coalescer.stats()['adds'], 1)
+
+    def test_flush_leaves_transaction_alone(self):
+        """ Write the buffer without committing the transaction of the reader """
+        self.add(1)
+        db.session.add(Shopcart(user_id=5, product_id=5, quantity=1, price=1.0))
+        write_coalescer.flush([1])
+        self.assertEqual(len(db.session.new), 1)
+        db.session.rollback()
+        self.assertEqual(self.stored_quantity(1, 1), 2)
+        self.assertEqual(self.stored_quantity(5, 5), None)
+
+    def test_no_wait_under_lock(self):
+        """ Don't wait for the writer once the transaction locked a shopcart """
+        CartTotal.version(1, lock=True)
+        Shopcart.add_or_increment_later(1, 1, 1, 5.0)
+        with patch.object(write_coalescer, 'flush') as flush:
+            self.assertEqual(Shopcart.find(1, 1).quantity, 1)
+            self.assertFalse(flush.called)
+        db.session.commit()
+        self.assertEqual(Shopcart.find(1, 1).quantity, 2)
+
+    def test_locked_write(self):
+        """ Write the buffered adds before an If-Match write locks the shopcart """
+        self.add(1)
+        etag = self.app.get('/shopcarts/1').headers['ETag']
+        resp = self.app.delete('/shopcarts/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.stored_quantity(1, 1), None)
+
+    def test_post_budget(self):
+        """ Buffer an add without running a statement """
+        with self.assertQueryBudget(0):
+            self.assertEqual(self.add(1).status_code, 202)
+
+    def test_disabled(self):
+        """ Write every add right away when the coalescer is disabled """
+        write_coalescer.enabled = False
+        resp = self.add(1)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(json.loads(resp.data)['quantity'], 2)
+        self.assertEqual(write_coalescer.stats()['adds'], 0)
+
+    def test_metrics(self):
+        """ Expose the coalescing ratio at /metrics """
+        self.add(1)
+        self.add(1)
+        write_coalescer.flush()
+        body = self.app.get('/metrics').get_data()
+        self.assertIn('shopcart_write_coalescer_ratio 2.0', body)
+        self.assertIn('shopcart_write_coalescer_pending 0.0', body)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Test cases for the Green Runner
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+import urllib2
+from threading import Thread
+from app.model import Shopcart, db
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestGreenServer(unittest.TestCase):
+
+    """ Test Cases for the Shopcart Service served by green.py """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Start the green server on a SQLite database of its own """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        cls.directory = tempfile.mkdtemp()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        environ = dict(os.environ, PORT=str(port), GREEN_CONCURRENCY='20',
+                       DATABASE_URI='sqlite:///{}/green.db'.format(cls.directory))
+        cls.log = open(os.path.join(cls.directory, 'green.log'), 'w')
+        cls.server = subprocess.Popen([sys.executable, 'green.py'], cwd=ROOT, env=environ,
+                                      stdout=cls.log, stderr=subprocess.STDOUT)
+        cls.base_url = 'http://127.0.0.1:{}'.format(port)
+        for _ in range(100):
+            try:
+                urllib2.urlopen(cls.base_url + '/healthcheck', timeout=1)
+                break
+            except (urllib2.URLError, socket.error):
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        cls.log.close()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        self.request('DELETE', '/shopcarts/reset')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def request(self, method, path, data=None):
+        """ Sends a request to the green server and returns the status and the body """
+        request = urllib2.Request(self.base_url + path, data=data and json.dumps(data))
+        request.get_method = lambda: method
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+        except urllib2.HTTPError as error:
+            response = error
+        return response.getcode(), response.read()
+
+    def assert_same_response(self, method, path, data=None):
+        """ Checks that the green server answers like the WSGI application """
+        code, body = self.request(method, path, data)
+        resp = self.client.open(path, method=method, content_type='application/json',
+                                data=data and json.dumps(data))
+        self.assertEqual(code, resp.status_code)
+        if body or resp.data:
+            self.assertEqual(json.loads(body), json.loads(resp.data))
+
+    def test_same_responses(self):
+        """ Serve the same routes and responses as the WSGI application """
+        self.assert_same_response('POST', '/shopcarts',
+                                  dict(user_id=1, product_id=1, quantity=1, price=12.00))
+        self.assert_same_response('POST', '/shopcarts',
+                                  dict(user_id=1, product_id=1, quantity=2, price=12.00))
+        self.assert_same_response('POST', '/shopcarts/2/items',
+                                  [dict(product_id=1, quantity=1, price=2.50),
+                                   dict(product_id=2, quantity=4, price=0.10)])
+        self.assert_same_response('PUT', '/shopcarts/2/product/2',
+                                  dict(user_id=2, product_id=2, quantity=5, price=0.10))
+        for path in ('/shopcarts', '/shopcarts/1', '/shopcarts/2/total',
+                     '/shopcarts/2/product/1', '/shopcarts/users?amount=3',
+                     '/shopcarts/3', '/shopcarts/users'):
+            self.assert_same_response('GET', path)
+        self.assert_same_response('DELETE', '/shopcarts/2/product/1')
+        self.assert_same_response('DELETE', '/shopcarts/1')
+        self.assert_same_response('GET', '/shopcarts')
+
+    def test_concurrent_requests(self):
+        """ Serve many requests at once """
+        results = []
+        def add(user_id):
+            results.append(self.request('POST', '/shopcarts/{}/items'.format(user_id),
+                                        [dict(product_id=1, quantity=1, price=1.00)]))
+        threads = [Thread(target=add, args=(user_id,)) for user_id in range(1, 21)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([code for code, _ in results], [200] * 20)
+        code, body = self.request('GET', '/shopcarts')
+        self.assertEqual(len(json.loads(body)), 20)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Test cases for the Gunicorn Configuration
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import imp
+from mock import patch, MagicMock
+from app import db, write_coalescer
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'gunicorn_config.py')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestGunicornConfig(unittest.TestCase):
+
+    """ Test Cases for gunicorn_config.py """
+
+    def load(self, **environ):
+        """ Loads the configuration module with the given environment """
+        with patch.dict(os.environ, environ):
+            return imp.load_source('gunicorn_config', CONFIG)
+
+    def test_worker_model(self):
+        """ Size the workers and threads of every worker class to the CPUs """
+        config = self.load()
+        self.assertEqual(config.worker_model('sync', 2), (5, 1))
+        self.assertEqual(config.worker_model('sync', 32), (8, 1))
+        self.assertEqual(config.worker_model('gthread', 2), (3, 4))
+        self.assertEqual(config.worker_model('gevent', 4, max_workers=2), (2, 1))
+        self.assertRaises(ValueError, config.worker_model, 'eventlet', 2)
+
+    def test_environment(self):
+        """ Read the settings from the environment """
+        config = self.load(PORT='8080', GUNICORN_WORKER_CLASS='sync', GUNICORN_WORKERS='3',
+                           GUNICORN_MAX_REQUESTS='500', GUNICORN_PRELOAD='False')
+        self.assertEqual(config.bind, '0.0.0.0:8080')
+        self.assertEqual((config.worker_class, config.workers, config.threads), ('sync', 3, 1))
+        self.assertEqual((config.max_requests, config.max_requests_jitter), (500, 50))
+        self.assertFalse(config.preload_app)
+        config = self.load()
+        self.assertEqual(config.worker_class, 'gthread')
+        self.assertTrue(config.preload_app)
+
+    def test_when_ready(self):
+        """ Migrate the schema before the workers start """
+        config = self.load()
+        with patch('app.service.init_db') as init_db:
+            config.when_ready(MagicMock())
+            self.assertTrue(init_db.called)
+
+    def test_post_fork(self):
+        """ Drop the inherited database connections in every worker """
+        config = self.load()
+        with patch.object(db.engine, 'dispose') as dispose, \
+             patch('app.service.initialize_logging') as initialize_logging:
+            config.post_fork(MagicMock(), MagicMock(pid=1))
+            self.assertTrue(dispose.called)
+            self.assertTrue(initialize_logging.called)
+
+    def test_worker_exit(self):
+        """ Write the buffered adds and queued log records when a worker exits """
+        config = self.load()
+        with patch('app.service.stop_logging') as stop_logging, \
+             patch.object(write_coalescer, 'stop') as stop:
+            config.worker_exit(MagicMock(), MagicMock(pid=1))
+            self.assertTrue(stop.called)
+            self.assertTrue(stop_logging.called)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
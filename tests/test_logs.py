@@ -0,0 +1,119 @@
+"""
+Test cases for the Asynchronous Logging
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import json
+import logging
+from StringIO import StringIO
+from app.logs import AsyncLogging, JSONFormatter, SamplingFilter, parse_sample_rates
+from app.service import app
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestAsyncLogging(unittest.TestCase):
+
+    """ Test Cases for the queued log writer """
+
+    def setUp(self):
+        self.stream = StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(JSONFormatter())
+        self.logger = logging.getLogger('test_logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.async_logging = None
+        self.handler = handler
+
+    def tearDown(self):
+        if self.async_logging is not None:
+            self.async_logging.stop()
+
+    def start(self, **kwargs):
+        """ Sends the records of the test logger through a queue """
+        self.async_logging = AsyncLogging(self.handler, [self.logger], **kwargs)
+        self.async_logging.start()
+
+    def records(self):
+        """ Returns the records written so far as dicts """
+        self.async_logging.stop()
+        self.async_logging = None
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_write_json_records(self):
+        """ Write the records as JSON lines once they are dequeued """
+        self.start()
+        data = {'quantity': 1}
+        self.logger.info('Payload %s', data)
+        data['quantity'] = 2
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            self.logger.exception('Failed')
+        records = self.records()
+        self.assertEqual([record['message'] for record in records],
+                         ["Payload {'quantity': 1}", 'Failed'])
+        self.assertEqual(records[0]['level'], 'INFO')
+        self.assertEqual(records[0]['logger'], 'test_logs')
+        self.assertIn('ValueError: bad', records[1]['exception'])
+
+    def test_request_route(self):
+        """ Record the route of the request that logged """
+        self.start()
+        with app.test_request_context('/shopcarts/1', method='GET'):
+            app.preprocess_request()
+            self.logger.info('In a request')
+        record = self.records()[0]
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['route'], '/shopcarts/<int:user_id>')
+
+    def test_full_queue(self):
+        """ Drop the records that don't fit instead of waiting """
+        self.start(queue_size=1)
+        self.async_logging.listener.stop()
+        for number in range(3):
+            self.logger.info('Record %s', number)
+        self.assertEqual(self.async_logging.stats(), {'queued': 1, 'dropped': 2})
+        self.async_logging.listener.start()
+        self.assertEqual([record['message'] for record in self.records()], ['Record 0'])
+
+    def test_sampling(self):
+        """ Sample the chatty levels but keep every warning """
+        self.start(sample_rates={logging.DEBUG: 0, logging.INFO: 0.5})
+        for _ in range(200):
+            self.logger.debug('debug')
+            self.logger.info('info')
+            self.logger.warning('warning')
+        levels = [record['level'] for record in self.records()]
+        self.assertEqual(levels.count('DEBUG'), 0)
+        self.assertTrue(0 < levels.count('INFO') < 200)
+        self.assertEqual(levels.count('WARNING'), 200)
+
+    def test_sampling_filter(self):
+        """ Keep the levels without a rate """
+        sampler = SamplingFilter({logging.INFO: 0})
+        record = logging.LogRecord('x', logging.ERROR, __file__, 1, 'error', None, None)
+        self.assertTrue(sampler.filter(record))
+        record.levelno = logging.DEBUG
+        self.assertTrue(sampler.filter(record))
+        record.levelno = logging.INFO
+        self.assertFalse(sampler.filter(record))
+
+    def test_parse_sample_rates(self):
+        """ Read the sample rates of the levels """
+        self.assertEqual(parse_sample_rates('DEBUG=0, info=0.25'),
+                         {logging.DEBUG: 0.0, logging.INFO: 0.25})
+        self.assertEqual(parse_sample_rates(''), {})
+        self.assertRaises(ValueError, parse_sample_rates, 'CHATTY=0.5')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Test cases for the Request Metrics
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import json
+from app.metrics import Histogram
+from app.model import Shopcart, db
+from app import metrics, cart_cache
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestRequestMetrics(unittest.TestCase):
+
+    """ Test Cases for the request metrics """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        metrics.clear()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        metrics.enabled = True
+        db.session.remove()
+        db.drop_all()
+
+    def samples(self):
+        """ Returns the samples served at /metrics by name and labels """
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in resp.get_data().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_route_metrics(self):
+        """ Record the requests of every route template """
+        self.app.get('/shopcarts/1')
+        self.app.get('/shopcarts/1')
+        self.app.get('/shopcarts/2')
+        samples = self.samples()
+        labels = '{method="GET",route="/shopcarts/<int:user_id>"}'
+        self.assertEqual(samples['shopcart_request_duration_seconds_count' + labels], 3)
+        self.assertGreater(samples['shopcart_request_db_statements_sum' + labels], 0)
+        self.assertGreater(samples['shopcart_request_db_seconds_sum' + labels], 0)
+        self.assertGreater(samples['shopcart_response_bytes_sum' + labels], 0)
+        self.assertEqual(samples['shopcart_requests_total{method="GET",'
+                                 'route="/shopcarts/<int:user_id>",status="200"}'], 2)
+        self.assertEqual(samples['shopcart_requests_total{method="GET",'
+                                 'route="/shopcarts/<int:user_id>",status="404"}'], 1)
+        self.assertIn('shopcart_cart_cache_hits', samples)
+
+    def test_rows_changed(self):
+        """ Count the rows changed by the writes of a request, not those read """
+        self.app.get('/shopcarts/1')
+        self.app.post('/shopcarts/1/items', data=json.dumps([
+            {'product_id': product_id, 'quantity': 1, 'price': 1.5} for product_id in (7, 8)]),
+                      content_type='application/json')
+        samples = self.samples()
+        self.assertEqual(samples['shopcart_db_rows_changed_total{method="GET",'
+                                 'route="/shopcarts/<int:user_id>"}'], 0)
+        self.assertGreaterEqual(samples['shopcart_db_rows_changed_total{method="POST",'
+                                        'route="/shopcarts/<int:user_id>/items"}'], 2)
+
+    def test_rows_returned(self):
+        """ Count the rows read by every request of a route """
+        Shopcart(user_id=1, product_id=2, quantity=1, price=15.00).save()
+        cart_cache.clear()
+        self.app.get('/shopcarts/1')
+        self.app.get('/shopcarts').get_data()
+        samples = self.samples()
+        labels = '{method="GET",route="/shopcarts/<int:user_id>"}'
+        self.assertEqual(samples['shopcart_db_rows_returned_count' + labels], 1)
+        self.assertGreaterEqual(samples['shopcart_db_rows_returned_sum' + labels], 2)
+        self.assertEqual(samples['shopcart_db_rows_returned_sum{method="GET",'
+                                 'route="/shopcarts/"}'], 2)
+
+    def test_streamed_response(self):
+        """ Count the bytes and statements of a streamed response """
+        body = self.app.get('/shopcarts').get_data()
+        samples = self.samples()
+        labels = '{method="GET",route="/shopcarts/"}'
+        self.assertEqual(samples['shopcart_response_bytes_sum' + labels], len(body))
+        self.assertGreater(samples['shopcart_request_db_statements_sum' + labels], 0)
+
+    def test_disabled(self):
+        """ Record nothing when the metrics are disabled """
+        metrics.enabled = False
+        self.app.get('/shopcarts/1')
+        self.assertNotIn('shopcart_request_duration_seconds_count'
+                         '{method="GET",route="/shopcarts/<int:user_id>"}', self.samples())
+
+    def test_histogram(self):
+        """ Render cumulative buckets """
+        histogram = Histogram((1, 5))
+        for value in (0, 1, 3, 9):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.render('x', 'a="b"')), [
+            'x_bucket{a="b",le="1"} 2', 'x_bucket{a="b",le="5"} 3',
+            'x_bucket{a="b",le="+Inf"} 4', 'x_sum{a="b"} 13', 'x_count{a="b"} 4'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
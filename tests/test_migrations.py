@@ -0,0 +1,146 @@
+"""
+Test cases for the Schema Migrations
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+from datetime import datetime
+from decimal import Decimal
+from mock import patch
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from app import migrations
+from app.migrations import CreateIndex, schema_migrations
+from app.model import Shopcart, CartTotal, db
+from app import service
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestMigrations(unittest.TestCase):
+
+    """ Test Cases for Schema Migrations """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def indexes(self, table):
+        """ Returns the names of the indexes of <table> """
+        return set(index['name'] for index in inspect(db.engine).get_indexes(table))
+
+    def test_migrate_empty_database(self):
+        """ Apply every migration to an empty database once """
+        applied = migrations.migrate()
+        self.assertEqual([migration.version for migration in applied],
+                         [migration.version for migration in migrations.MIGRATIONS])
+        self.assertIn('ix_shopcart_product_id', self.indexes('shopcart'))
+        self.assertEqual(migrations.applied_versions(),
+                         set(migration.version for migration in migrations.MIGRATIONS))
+        self.assertEqual(migrations.migrate(), [])
+        self.assertEqual(migrations.plan(), [])
+
+    def test_migrate_legacy_database(self):
+        """ Convert and index a database made before the migrations """
+        db.session.execute('CREATE TABLE shopcart (user_id INTEGER NOT NULL, '
+                           'product_id INTEGER NOT NULL, quantity INTEGER, price FLOAT, '
+                           'PRIMARY KEY (user_id, product_id))')
+        db.session.execute('INSERT INTO shopcart VALUES (1, 1, 3, 0.1), (1, 2, 1, 19.99)')
+        db.session.commit()
+        self.assertEqual(len(migrations.migrate(target=1)), 1)
+        self.assertNotIn('ix_shopcart_product_id', self.indexes('shopcart'))
+        self.assertEqual(len(migrations.migrate()), 3)
+        self.assertEqual(Shopcart.find(1, 2).price, Decimal('19.99'))
+        self.assertEqual(CartTotal.find(1).total_value, Decimal('20.29'))
+        self.assertIn('ix_shopcart_product_id', self.indexes('shopcart'))
+
+    def test_migrate_at_startup(self):
+        """ Migrate a database made before the migrations when the server starts """
+        db.session.execute('CREATE TABLE shopcart (user_id INTEGER NOT NULL, '
+                           'product_id INTEGER NOT NULL, quantity INTEGER, price REAL, '
+                           'PRIMARY KEY (user_id, product_id))')
+        db.session.execute('INSERT INTO shopcart VALUES (1, 1, 3, 0.1), (1, 2, 1, 19.99)')
+        db.session.commit()
+        service.init_db()
+        self.assertEqual(Shopcart.find(1, 1).price, Decimal('0.10'))
+        self.assertEqual(CartTotal.find(1).total_value, Decimal('20.29'))
+        self.assertEqual(migrations.plan(), [])
+
+    def test_sum_shopcarts_without_totals(self):
+        """ Sum the shopcarts stored in cents before the cart_totals table """
+        db.session.execute('CREATE TABLE shopcart (user_id INTEGER NOT NULL, '
+                           'product_id INTEGER NOT NULL, quantity INTEGER, price INTEGER, '
+                           'PRIMARY KEY (user_id, product_id))')
+        db.session.execute('INSERT INTO shopcart VALUES (1, 1, 3, 10), (1, 2, 1, 1999)')
+        db.session.commit()
+        service.init_db()
+        self.assertEqual(CartTotal.find(1).total_value, Decimal('20.29'))
+        self.assertEqual(CartTotal.find(1).item_count, 4)
+
+    def test_plan(self):
+        """ Describe the pending migrations without applying them """
+        db.create_all()
+        db.session.execute(schema_migrations.insert(), {
+            'version': 1, 'description': 'baseline', 'applied_at': datetime.utcnow()})
+        db.session.commit()
+        pending = migrations.plan()
+        self.assertEqual([migration.version for migration, _ in pending], [2, 3, 4])
+        self.assertEqual(pending[0][1],
+                         ['-- Convert prices stored as floating point numbers into integer cents'])
+        # create_all made the indexes of the models already
+        self.assertEqual(pending[1][1], ['-- ix_shopcart_product_id exists already',
+                                         '-- ix_cart_totals_total_value exists already'])
+        self.assertEqual(migrations.applied_versions(), set([1]))
+        db.session.remove()
+        db.drop_all()
+        self.assertEqual(len(migrations.plan()), len(migrations.MIGRATIONS))
+        self.assertFalse(db.engine.has_table(schema_migrations.name))
+
+    def test_concurrent_index(self):
+        """ Build indexes concurrently on PostgreSQL only """
+        step = CreateIndex('ix_shopcart_product_id', 'shopcart', ['product_id'])
+        self.assertEqual(step.sql(postgresql.dialect()),
+                         'CREATE INDEX CONCURRENTLY ix_shopcart_product_id ON shopcart (product_id)')
+        self.assertEqual(step.sql(sqlite.dialect()),
+                         'CREATE INDEX ix_shopcart_product_id ON shopcart (product_id)')
+
+    def test_invalid_index(self):
+        """ Rebuild an index whose concurrent build failed on PostgreSQL """
+        db.create_all()
+        step = CreateIndex('ix_shopcart_product_id', 'shopcart', ['product_id'])
+        with patch.object(db.engine.dialect, 'name', 'postgresql'), \
+             patch.object(CreateIndex, '_valid', return_value=False):
+            self.assertFalse(step.exists())
+            self.assertTrue(step.invalid())
+            self.assertEqual(migrations.describe(step),
+                             'DROP INDEX CONCURRENTLY IF EXISTS ix_shopcart_product_id; '
+                             'CREATE INDEX CONCURRENTLY ix_shopcart_product_id '
+                             'ON shopcart (product_id)')
+        with patch.object(db.engine.dialect, 'name', 'postgresql'), \
+             patch.object(CreateIndex, '_valid', return_value=True):
+            self.assertTrue(step.exists())
+            self.assertFalse(step.invalid())
+        self.assertFalse(step.invalid())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
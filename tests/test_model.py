@@ -7,8 +7,12 @@ Test cases can be run with:
 
 import unittest
 import os
-from app.model import Shopcart, DataValidationError, db
+from datetime import datetime
+from decimal import Decimal
+from mock import patch
+from app.model import Shopcart, CartTotal, DataValidationError, db
 from app.service import app
+from query_budget import recorded_queries
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
 
@@ -98,6 +102,16 @@ class TestShopcarts(unittest.TestCase):
         self.assertEqual(shopcart.price, 15.00)
 
 
+    def test_stream_by_user(self):
+        """ Stream all shopcarts grouped by user_id """
+        Shopcart(user_id=2, product_id=1, quantity=1, price=12.00).save()
+        Shopcart(user_id=1, product_id=2, quantity=1, price=15.00).save()
+        Shopcart(user_id=1, product_id=1, quantity=3, price=12.00).save()
+
+        groups = [(user_id, [entry.product_id for entry in entries])
+                  for user_id, entries in Shopcart.stream_by_user(batch_size=1)]
+        self.assertEqual(groups, [(1, [1, 2]), (2, [1])])
+
     def test_find_users_by_shopcart_amount(self):
         """Find users having goods worth more than specified amount in their shopcarts """
         Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
@@ -107,6 +121,17 @@ class TestShopcarts(unittest.TestCase):
         result = Shopcart.find_users_by_shopcart_amount(13)
         self.assertEqual(result, [1])
 
+    def test_find_users_by_shopcart_amount_range(self):
+        """Find users having goods worth within a range, sorted by shopcart total """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        Shopcart(user_id=2, product_id=1, quantity=5, price=10.00).save()
+        Shopcart(user_id=3, product_id=1, quantity=3, price=10.00).save()
+        Shopcart(user_id=4, product_id=1, quantity=9, price=10.00).save()
+
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(25, max_amount=60), [2, 3])
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(0, order='desc', limit=2), [4, 2])
+        self.assertEqual(Shopcart.find_users_by_shopcart_amount(0, order='asc'), [1, 3, 2, 4])
+
     def test_create_a_shopcart_entry(self):
         """ Create a shopcart entry and assert that it exists """
         shopcart = Shopcart(user_id=999, product_id=999, quantity=999, price=999.99)
@@ -166,7 +191,21 @@ class TestShopcarts(unittest.TestCase):
         self.assertEqual(shopcarts[0].user_id, shopcart.user_id)
         self.assertEqual(shopcarts[0].product_id, shopcart.product_id)
 
-
+    def test_find_records(self):
+        """ Read shopcart entries as records without the ORM """
+        Shopcart(user_id=2, product_id=1, quantity=1, price=12.00).save()
+        Shopcart(user_id=1, product_id=2, quantity=1, price=15.00).save()
+        Shopcart(user_id=1, product_id=1, quantity=3, price=12.50).save()
+        db.session.expunge_all()
+
+        records = list(Shopcart.find_records_by_user_id(1))
+        self.assertEqual(records, [(1, 1, 3, Decimal('12.50')), (1, 2, 1, Decimal('15.00'))])
+        self.assertEqual([(record.user_id, record.product_id)
+                          for record in Shopcart.all_records(batch_size=2)],
+                         [(1, 1), (1, 2), (2, 1)])
+        self.assertEqual(sorted(Shopcart.list_users()), [1, 2])
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertEqual(records[0].serialize(), Shopcart.find(1, 1).serialize())
 
     def test_delete_user_product(self):
         """ Delete User Products """
@@ -182,6 +221,186 @@ class TestShopcarts(unittest.TestCase):
         self.assertIsNot(shopcarts, None)
 
 
+    def test_add_or_increment(self):
+        """ Add a product to a shopcart and increase its quantity in one statement """
+        entry = Shopcart.add_or_increment(1, 1, 2, 12.00)
+        self.assertEqual(entry.serialize(),
+                         {"user_id": 1, "product_id": 1, "quantity": 2, "price": 12.00})
+        entry = Shopcart.add_or_increment('1', '1', '3', '15.00')
+        self.assertEqual(entry.quantity, 5)
+        self.assertEqual(entry.price, 12.00)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 5)
+        self.assertEqual(len(Shopcart.all()), 1)
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment, 1, 'a', 1, 12.00)
+
+    def test_add_or_increment_many(self):
+        """ Add many products to a shopcart in one transaction """
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        lines = [{"product_id": 1, "quantity": 2, "price": 12.00},
+                 {"product_id": 2, "quantity": 1, "price": 15.00}]
+        entries = Shopcart.add_or_increment_many(1, lines)
+        self.assertEqual([(entry.product_id, entry.quantity) for entry in entries],
+                         [(1, 3), (2, 1)])
+        self.assertEqual(Shopcart.find(1, 2).price, 15.00)
+        self.assertEqual(Shopcart.add_or_increment_many(1, []), [])
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment_many,
+                          1, [{"product_id": 3, "quantity": 1}])
+
+    def test_add_or_increment_without_upsert(self):
+        """ Add a product to a shopcart on a database without upsert support """
+        with patch.object(db.engine.dialect.dbapi, 'sqlite_version_info', (3, 7, 0)):
+            Shopcart.add_or_increment(1, 1, 2, 12.00)
+            entry = Shopcart.add_or_increment(1, 1, 3, 12.00)
+        self.assertEqual(entry.quantity, 5)
+        self.assertEqual(Shopcart.find(1, 1).quantity, 5)
+
+    def test_delete_by_user(self):
+        """ Delete a whole shopcart or some of its products in one statement """
+        for product_id in (1, 2, 3, 4):
+            Shopcart(user_id=1, product_id=product_id, quantity=1, price=12.00).save()
+        Shopcart(user_id=2, product_id=1, quantity=1, price=12.00).save()
+
+        self.assertEqual(Shopcart.delete_by_user(1, [2, 3, 99]), 2)
+        self.assertEqual([entry.product_id for entry in Shopcart.findByUserId(1)], [1, 4])
+        self.assertEqual(Shopcart.delete_by_user(1, []), 0)
+        self.assertEqual(Shopcart.delete_by_user(1), 2)
+        self.assertEqual(Shopcart.findByUserId(1).count(), 0)
+        self.assertEqual(Shopcart.findByUserId(2).count(), 1)
+
+    def test_cart_totals_follow_writes(self):
+        """ Keep the shopcart totals up to date on every write """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        Shopcart.add_or_increment(1, 2, 1, 5.00)
+        Shopcart.add_or_increment_many(1, [{"product_id": 1, "quantity": 1, "price": 10.00}])
+        totals = CartTotal.find(1)
+        self.assertEqual((totals.total_value, totals.item_count, totals.line_count),
+                         (35.00, 4, 2))
+        self.assertIn('last_modified', totals.serialize())
+
+        Shopcart.find(1, 2).delete()
+        self.assertEqual(CartTotal.find(1).total_value, 30.00)
+        Shopcart.delete_by_user(1)
+        self.assertIsNone(CartTotal.find(1))
+
+        Shopcart(user_id=2, product_id=1, quantity=1, price=10.00).save()
+        Shopcart.remove_all()
+        self.assertEqual(CartTotal.query.count(), 0)
+        self.assertEqual(CartTotal.verify(), [])
+
+    def test_cart_totals_locked_first(self):
+        """ Lock the totals before changing a line and update them in place """
+        Shopcart.add_or_increment(1, 1, 1, 10.00)
+        with recorded_queries() as log:
+            Shopcart.add_or_increment(1, 2, 1, 5.00)
+        writes = [statement.split()[0:3] for statement in log.statements
+                  if not statement.startswith('SELECT')]
+        self.assertEqual(writes[0], ['INSERT', 'OR', 'IGNORE'])
+        self.assertIn('cart_totals', log.statements[0])
+        self.assertEqual(writes[-1][0], 'UPDATE')
+        self.assertNotIn('DELETE', ' '.join(log.statements))
+        self.assertEqual(CartTotal.find(1).total_value, 15.00)
+
+        # a shopcart locked by an If-Match check isn't locked again
+        CartTotal.version(1, lock=True)
+        with recorded_queries() as log:
+            CartTotal.lock([1])
+        self.assertEqual(len(log), 0)
+        db.session.commit()
+
+    def test_cart_totals_verify_and_rebuild(self):
+        """ Find shopcart totals that drifted and rebuild them """
+        Shopcart(user_id=1, product_id=1, quantity=2, price=10.00).save()
+        Shopcart(user_id=2, product_id=1, quantity=1, price=10.00).save()
+        db.session.query(CartTotal).filter(CartTotal.user_id == 1) \
+                  .update({'total_value': 1.00})
+        db.session.query(CartTotal).filter(CartTotal.user_id == 2).delete()
+        db.session.add(CartTotal(user_id=3, total_value=5.00, item_count=1,
+                                 line_count=1, last_modified=datetime.utcnow()))
+        db.session.commit()
+
+        self.assertEqual(CartTotal.verify(), [(1, (1.00, 2, 1), (20.00, 2, 1)),
+                                              (2, None, (10.00, 1, 1)),
+                                              (3, (5.00, 1, 1), None)])
+        self.assertEqual(CartTotal.rebuild(batch_size=1), 2)
+        self.assertEqual(CartTotal.verify(), [])
+
+    def test_exact_prices(self):
+        """ Add up prices exactly however many products there are """
+        Shopcart.add_or_increment_many(1, [{"product_id": product_id, "quantity": 3, "price": 0.1}
+                                           for product_id in range(1, 101)])
+        Shopcart.add_or_increment(1, 101, 1, '19.999')
+        self.assertEqual(Shopcart.find(1, 101).price, Decimal('20.00'))
+        self.assertEqual(CartTotal.find(1).total_value, Decimal('50.00'))
+        cart = Shopcart.find_cart(1)
+        self.assertEqual(cart['total_price'], 50.00)
+        self.assertEqual(cart['products'][0]['price'], 0.1)
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment, 1, 1, 1, 'abc')
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment, 1, 1, 1, 'nan')
+
+    def test_find_cart_product(self):
+        """ Find one product of a shopcart by its key """
+        Shopcart.add_or_increment_many(1, [{"product_id": product_id, "quantity": 1, "price": 2.5}
+                                           for product_id in (3, 1, 7)])
+        version = CartTotal.version(1)
+        with recorded_queries() as statements:
+            product, found_version = Shopcart.find_cart_product(1, 7)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual((product['product_id'], product['price']), (7, 2.5))
+        self.assertEqual(found_version, version)
+        self.assertEqual(Shopcart.find_cart_product(1, 2), (None, version))
+        self.assertEqual(Shopcart.find_cart_product(2, 7), (None, None))
+
+    def test_large_totals(self):
+        """ Add up lines worth more than the INTEGER range of cents """
+        Shopcart.add_or_increment(1, 1, 10 ** 6, 30000)
+        Shopcart.add_or_increment_many(1, [{"product_id": 2, "quantity": 2 ** 31 - 1,
+                                            "price": 21474836.47}])
+        total = CartTotal.find(1)
+        self.assertEqual(total.total_value, Decimal('30000000000') +
+                         (2 ** 31 - 1) * Decimal('21474836.47'))
+        self.assertEqual(total.item_count, 10 ** 6 + 2 ** 31 - 1)
+        self.assertEqual(CartTotal.verify(), [])
+
+    def test_refuse_quantity_overflow(self):
+        """ Refuse the adds that take a quantity out of the INTEGER range """
+        Shopcart.add_or_increment(1, 1, 2 ** 31 - 1, 1.0)
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment, 1, 1, 1, 1.0)
+        self.assertRaises(DataValidationError, Shopcart.add_or_increment_many, 1,
+                          [{"product_id": 1, "quantity": 1, "price": 1.0}])
+        self.assertRaises(DataValidationError, Shopcart.apply_increments,
+                          [Shopcart._entry_values(1, 1, 1, 1.0)])
+        self.assertEqual(Shopcart.find(1, 1).quantity, 2 ** 31 - 1)
+        self.assertEqual(CartTotal.find(1).item_count, 2 ** 31 - 1)
+
+    def test_migrate_bigint(self):
+        """ Widen cart totals created as INTEGER """
+        db.drop_all()
+        db.session.execute('CREATE TABLE cart_totals (user_id INTEGER NOT NULL PRIMARY KEY, '
+                           'total_value INTEGER NOT NULL, item_count INTEGER NOT NULL, '
+                           'line_count INTEGER NOT NULL, last_modified TIMESTAMP NOT NULL)')
+        db.session.commit()
+        widened = CartTotal.migrate_bigint()
+        self.assertEqual(widened, db.engine.dialect.name in ('postgresql', 'ibm_db_sa'))
+        self.assertFalse(CartTotal.migrate_bigint())
+
+    def test_migrate_prices(self):
+        """ Convert floating point prices into cents """
+        Shopcart.migrate_prices()
+        self.assertFalse(Shopcart.migrate_prices())
+        db.drop_all()
+        db.session.execute('CREATE TABLE shopcart (user_id INTEGER NOT NULL, '
+                           'product_id INTEGER NOT NULL, quantity INTEGER, price FLOAT, '
+                           'PRIMARY KEY (user_id, product_id))')
+        db.session.execute('INSERT INTO shopcart VALUES (1, 1, 3, 0.1), (1, 2, 1, 19.99), '
+                           '(1, 3, 1, 0.125)')
+        db.session.commit()
+        self.assertTrue(Shopcart.migrate_prices())
+        self.assertEqual(Shopcart.find(1, 1).price, Decimal('0.10'))
+        self.assertEqual(Shopcart.find(1, 2).price, Decimal('19.99'))
+        self.assertEqual(Shopcart.find(1, 3).price, Decimal('0.13'))
+        self.assertEqual(CartTotal.find(1).total_value, Decimal('20.42'))
+        self.assertFalse(Shopcart.migrate_prices())
+
     def test_remove_all(self):
         """ Remove all the shopcart data in the system """
         shopcart = Shopcart(user_id=1, product_id=1, quantity=1, price=12.00)
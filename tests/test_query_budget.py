@@ -0,0 +1,160 @@
+"""
+Test cases for the SQL statements every endpoint may run
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import json
+from query_budget import QueryBudgetMixin, recorded_queries, statement_shape
+from app.model import Shopcart, CartTotal, db
+from app import cart_cache, slow_queries
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+# (method, url, body, budget, max_repeats) of a request to every route
+BUDGETS = (
+    ('GET', '/', None, 0, 1),
+    ('GET', '/healthcheck', None, 0, 1),
+    ('GET', '/metrics', None, 0, 1),
+    ('GET', '/admin/slow-queries', None, 0, 1),
+    ('GET', '/shopcarts/1', None, 1, 1),
+    ('GET', '/shopcarts/1/total', None, 1, 1),
+    ('GET', '/shopcarts/1/product/1', None, 1, 1),
+    ('GET', '/shopcarts', None, 1, 1),
+    ('GET', '/shopcarts?limit=3', None, 1, 1),
+    ('GET', '/shopcarts/users?amount=1&order=desc', None, 1, 1),
+    ('POST', '/shopcarts', {'user_id': 1, 'product_id': 9, 'quantity': 1, 'price': 1.5}, 4, 1),
+    ('POST', '/shopcarts/1/items',
+     [{'product_id': product_id, 'quantity': 1, 'price': 1.5} for product_id in range(10)], 5, 1),
+    # the response reads the updated line and the new version again
+    ('PUT', '/shopcarts/1/product/1',
+     {'user_id': 1, 'product_id': 1, 'quantity': 3, 'price': 1.5}, 8, 2),
+    ('DELETE', '/shopcarts/1/product/2', None, 6, 1),
+    ('DELETE', '/shopcarts/2?product_id=1&product_id=2', None, 5, 1),
+    ('DELETE', '/shopcarts/3', None, 5, 1),
+    ('DELETE', '/shopcarts/reset', None, 2, 1),
+)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestQueryBudgets(QueryBudgetMixin, unittest.TestCase):
+
+    """ Test Cases for the statements each endpoint runs """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        slow_queries.admin_token = 'secret'
+        self.app = app.test_client()
+
+    def tearDown(self):
+        slow_queries.admin_token = None
+        db.session.remove()
+        db.drop_all()
+
+    def populate(self, users, lines=3):
+        """ Creates <users> shopcarts of <lines> products """
+        rows = [{'user_id': user_id, 'product_id': product_id, 'quantity': 1, 'price': 2.50}
+                for user_id in range(1, users + 1) for product_id in range(1, lines + 1)]
+        db.session.execute(Shopcart.__table__.insert(), rows)
+        CartTotal.rebuild()
+        db.session.remove()
+
+    def request(self, method, url, body=None):
+        """ Sends a request and reads the whole response """
+        resp = self.app.open(url, method=method, content_type='application/json',
+                             headers={'Authorization': 'Bearer secret'},
+                             data=json.dumps(body) if body is not None else None)
+        resp.get_data()
+        return resp
+
+    def test_every_endpoint_has_a_budget(self):
+        """ Declare a budget for every route of the service """
+        adapter = app.url_map.bind('localhost')
+        budgeted = set()
+        for method, url, _, _, _ in BUDGETS:
+            rule, _ = adapter.match(url.split('?')[0], method, return_rule=True)
+            budgeted.add((method, rule.rule))
+        routes = set((method, rule.rule) for rule in app.url_map.iter_rules()
+                     if rule.rule.startswith('/shopcarts')
+                     or rule.rule.startswith('/admin')
+                     or rule.rule in ('/', '/healthcheck', '/metrics')
+                     for method in rule.methods - set(['HEAD', 'OPTIONS']))
+        self.assertEqual(routes - budgeted, set())
+
+    def test_endpoint_budgets(self):
+        """ Keep every endpoint within its statement budget """
+        self.populate(10)
+        for method, url, body, budget, max_repeats in BUDGETS:
+            with self.assertQueryBudget(budget, max_repeats, label='{} {}'.format(method, url)):
+                resp = self.request(method, url, body)
+            self.assertLess(resp.status_code, 400, '{} {}'.format(method, url))
+
+    def test_cached_reads(self):
+        """ Serve a cached shopcart and its entity tag without a statement """
+        self.populate(2)
+        cart_cache.enabled = True
+        try:
+            for url in ('/shopcarts/1', '/shopcarts/1/total', '/shopcarts/1/product/1'):
+                etag = self.request('GET', url).headers['ETag']
+                with self.assertQueryBudget(0, label=url):
+                    self.assertEqual(self.request('GET', url).status_code, 200)
+                with self.assertQueryBudget(0, label=url):
+                    resp = self.app.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(resp.status_code, 304)
+        finally:
+            cart_cache.enabled = False
+            cart_cache.clear()
+
+    def test_budgets_do_not_grow_with_users(self):
+        """ Run as many statements for 2 users as for 20 """
+        counts = []
+        for users in (2, 20):
+            db.drop_all()
+            db.create_all()
+            self.populate(users)
+            counts.append([])
+            for url in ('/shopcarts', '/shopcarts?limit=50', '/shopcarts/users?amount=1'):
+                with recorded_queries() as log:
+                    self.request('GET', url)
+                counts[-1].append(len(log))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_detect_repeated_statements(self):
+        """ Fail a block that runs a statement in a loop """
+        self.populate(3)
+        with self.assertRaises(AssertionError) as context:
+            with self.assertQueryBudget(10):
+                for user_id in (1, 2, 3):
+                    list(Shopcart.find_records_by_user_id(user_id))
+        self.assertIn('likely N+1', str(context.exception))
+        with self.assertRaises(AssertionError) as context:
+            with self.assertQueryBudget(0):
+                list(Shopcart.find_records_by_user_id(1))
+        self.assertIn('over the budget of 0', str(context.exception))
+
+    def test_statement_shape(self):
+        """ Give statements that differ only in parameters the same shape """
+        self.assertEqual(statement_shape('SELECT a\n  FROM t WHERE id IN (?, ?, ?)'),
+                         'SELECT a FROM t WHERE id IN (?)')
+        self.assertEqual(statement_shape('DELETE FROM t WHERE id IN (%(id_1)s, %(id_2)s)'),
+                         'DELETE FROM t WHERE id IN (?)')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
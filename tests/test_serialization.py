@@ -0,0 +1,61 @@
+"""
+Test cases for the Response Serialization
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import json
+from mock import patch
+from app.serialization import JSONSerializer, create_serializer
+from app import app
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestJSONSerializer(unittest.TestCase):
+
+    """ Test Cases for the JSON serializer """
+
+    def test_backends(self):
+        """ Encode the same JSON with every backend """
+        value = {'user_id': 1, 'products': [{'product_id': 2, 'price': 19.99}]}
+        for backend in ('auto', 'ujson', 'json'):
+            self.assertEqual(json.loads(JSONSerializer(backend).dumps(value)), value)
+        self.assertEqual(JSONSerializer('json').dumps([1, {'a': 2}]), '[1,{"a":2}]')
+        self.assertRaises(ValueError, JSONSerializer, 'yaml')
+
+    def test_missing_backend(self):
+        """ Fall back to the standard library when a backend is not installed """
+        with patch('app.serialization.import_module', side_effect=ImportError):
+            serializer = JSONSerializer('ujson')
+        self.assertEqual(serializer.name, 'json')
+        self.assertEqual(serializer.dumps({'a': 1}), '{"a":1}')
+        with patch.dict(app.config, {'JSON_BACKEND': 'json'}):
+            self.assertEqual(create_serializer(app).name, 'json')
+
+    def test_stream_list(self):
+        """ Stream a list one item at a time """
+        serializer = JSONSerializer()
+        self.assertEqual(''.join(serializer.stream_list(iter([]))), '[]')
+        chunks = list(serializer.stream_list({'user_id': user_id} for user_id in range(3)))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(''.join(chunks)), [{'user_id': 0}, {'user_id': 1},
+                                                      {'user_id': 2}])
+
+    def test_response(self):
+        """ Make a JSON response """
+        response = JSONSerializer().response({'a': 1}, 201, {'ETag': '"1"'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.headers['ETag'], '"1"')
+        self.assertEqual(json.loads(response.get_data()), {'a': 1})
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,8 @@ from app.model import Shopcart, DataValidationError, db
 import app.vcap_services as vcap
 import app.service as service
 from app.service import app
+from app import cart_cache
+from query_budget import recorded_queries
 
 # Status Codes
 HTTP_200_OK = 200
@@ -148,6 +150,52 @@ class TestShopcartServer(unittest.TestCase):
         self.assertIn(new_json, data)
         self.assertEqual(len(data), product_count + 1)
 
+    def test_create_shopcart_entry_existing_product(self):
+        """ Create a Shopcart entry - add a product already in the shopcart """
+        new_product = dict(user_id=1, product_id=2, quantity=3, price=15.00)
+        resp = self.app.post('/shopcarts',
+                             data=json.dumps(new_product),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['quantity'], 4)
+        self.assertEqual(Shopcart.find(1, 2).quantity, 4)
+
+        new_product = dict(user_id=1, product_id='abc', quantity=3, price=15.00)
+        resp = self.app.post('/shopcarts',
+                             data=json.dumps(new_product),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_many_products(self):
+        """ Add many products to a Shopcart in one request """
+        lines = [dict(product_id=1, quantity=2, price=12.00),
+                 dict(product_id=3, quantity=1, price=20.00)]
+        resp = self.app.post('/shopcarts/1/items',
+                             data=json.dumps(lines),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data, [dict(user_id=1, product_id=1, quantity=3, price=12.00),
+                                dict(user_id=1, product_id=3, quantity=1, price=20.00)])
+
+        # nothing is written when one of the products is not valid
+        lines = [dict(product_id=4, quantity=1, price=12.00),
+                 dict(product_id=5, quantity=0, price=12.00),
+                 dict(product_id=6, price=12.00)]
+        resp = self.app.post('/shopcarts/1/items',
+                             data=json.dumps(lines),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = json.loads(resp.data)['errors']
+        self.assertEqual([error['index'] for error in errors], [1, 2])
+        self.assertIsNone(Shopcart.find(1, 4))
+
+        resp = self.app.post('/shopcarts/1/items',
+                             data=json.dumps(dict(product_id=4)),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_list_shop_cart_entry_by_user_id(self):
         """ Query shopcart by user_id """
         shopcart = Shopcart.findByUserId(1)
@@ -197,10 +245,56 @@ class TestShopcartServer(unittest.TestCase):
 
 
 
+    def test_list_all_shopcarts_grouped_by_user(self):
+        """ Query all the shopcarts and check they are grouped by user """
+        Shopcart(user_id=2, product_id=5, quantity=2, price=10.00).save()
+        resp = self.app.get('/shopcarts')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([cart['user_id'] for cart in data], [1, 2])
+        self.assertEqual([item['product_id'] for item in data[0]['products']], [1, 2])
+        self.assertEqual(data[1]['products'],
+                         [{'product_id': 5, 'price': 10.00, 'quantity': 2}])
+
+    def test_list_shopcarts_paged(self):
+        """ Walk all the shopcarts one page at a time """
+        for user_id in (2, 3, 4):
+            Shopcart(user_id=user_id, product_id=1, quantity=1, price=10.00).save()
+        resp = self.app.get('/shopcarts?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([cart['user_id'] for cart in json.loads(resp.data)], [1, 2])
+        self.assertIn('cursor=2', resp.headers['Link'])
+        self.assertIn('rel="next"', resp.headers['Link'])
+
+        resp = self.app.get('/shopcarts?limit=2&cursor=2')
+        self.assertEqual([cart['user_id'] for cart in json.loads(resp.data)], [3, 4])
+        resp = self.app.get('/shopcarts?limit=2&cursor=4')
+        self.assertEqual(json.loads(resp.data), [])
+        self.assertNotIn('Link', resp.headers)
+
+        resp = self.app.get('/shopcarts?min_user_id=2&max_user_id=3')
+        self.assertEqual([cart['user_id'] for cart in json.loads(resp.data)], [2, 3])
+
+        resp = self.app.get('/shopcarts?limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts?cursor=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_shopcarts_out_of_range(self):
+        """ Refuse the parameters outside the INTEGER range before streaming """
+        for query in ('cursor=99999999999999999999', 'min_user_id=-2147483649',
+                      'max_user_id=2147483648', 'limit=2147483648'):
+            resp = self.app.get('/shopcarts?' + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+            self.assertIn('out of range', json.loads(resp.data)['message'])
+        resp = self.app.get('/shopcarts?cursor=2147483647')
+        self.assertEqual(json.loads(resp.data), [])
+
     def test_shop_cart_amount_by_user_id(self):
         """ Query the total amount of products in shopcart by user_id"""
         shopcarts = Shopcart.findByUserId(1)
-        total = 0.0
+        total = 0
         for shopcart in shopcarts:
              total = total + shopcart.price * shopcart.quantity
         total = round(total, 2)
@@ -263,6 +357,20 @@ class TestShopcartServer(unittest.TestCase):
                             content_type='application/json')
         self.assertRaises(NotFound)
 
+    def test_update_shopcart_bad_data(self):
+        """ Refuse to update a Shopcart entry with a price or quantity it can't hold """
+        test_product = dict(user_id=1, product_id=1, quantity=5, price=12.00)
+        for bad in (dict(price='abc'), dict(quantity=2 ** 31), dict(quantity=2.5),
+                    dict(price=2 ** 31)):
+            test_error = dict(test_product, **bad)
+            resp = self.app.put('/shopcarts/1/product/1', data=json.dumps(test_error),
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, bad)
+
+        shopcart = Shopcart.find(1, 1)
+        self.assertEqual(shopcart.quantity, 1)
+        self.assertEqual(shopcart.price, 12.00)
+
     def test_get_shopcart_product_info(self):
         """ Query quantity and price of a product shopcart by user_id and product_id """
         # Add test product in database
@@ -285,7 +393,61 @@ class TestShopcartServer(unittest.TestCase):
                             content_type='application/json')
         self.assertRaises(NotFound)
 
+    def test_get_shopcart_not_modified(self):
+        """ Answer a conditional GET of an unchanged Shopcart with 304 """
+        for url in ('/shopcarts/1', '/shopcarts/1/total', '/shopcarts/1/product/1'):
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            etag = resp.headers['ETag']
+            # the version comes with the shopcart, from the cache or one query
+            with recorded_queries() as log:
+                resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertLessEqual(len(log), 1)
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.data, '')
+        Shopcart.add_or_increment(1, 1, 1, 12.00)
+        resp = self.app.get('/shopcarts/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/shopcarts/2', headers={'If-None-Match': '*'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_not_modified_without_loading(self):
+        """ Answer 304 from the version alone when the cart cache is off """
+        self.assertFalse(cart_cache.enabled)
+        for url in ('/shopcarts/1', '/shopcarts/1/total', '/shopcarts/1/product/1'):
+            etag = self.app.get(url).headers['ETag']
+            with recorded_queries() as log:
+                resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(len(log), 1)
+            self.assertIn('FROM cart_totals', log.statements[0])
+            self.assertNotIn('shopcart.', log.statements[0])
+
+    def test_update_shopcart_if_match(self):
+        """ Refuse to change a Shopcart modified since the client read it """
+        etag = self.app.get('/shopcarts/1').headers['ETag']
+        data = json.dumps(dict(user_id=1, product_id=1, quantity=3, price=12.00))
+        resp = self.app.put('/shopcarts/1/product/1', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        # the shopcart changed, so the old version can't be used any more
+        resp = self.app.put('/shopcarts/1/product/1', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/shopcarts/1/product/2', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/shopcarts/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(len(Shopcart.findByUserId(1).all()), 2)
+        etag = self.app.get('/shopcarts/1').headers['ETag']
+        resp = self.app.delete('/shopcarts/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Shopcart.findByUserId(1).all(), [])
 
     def test_delete_product(self):
         """ Delete product in Shopcart """
@@ -309,6 +471,29 @@ class TestShopcartServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(resp.data)), 1)
 
+    def test_get_top_users_by_total_cost_of_shopcart(self):
+        """ Query the users with the most valuable shopcarts within a range """
+        Shopcart(user_id=3, product_id=1, quantity=5, price=12.00).save()
+        Shopcart(user_id=4, product_id=1, quantity=9, price=12.00).save()
+        resp = self.app.get('/shopcarts/users?amount=20&order=desc&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [4, 3])
+        resp = self.app.get('/shopcarts/users?amount=20&max_amount=100')
+        self.assertEqual(json.loads(resp.data), [1, 3])
+        resp = self.app.get('/shopcarts/users?amount=20&order=sideways')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/shopcarts/users?amount=20&max_amount=lots')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_users_by_amount_out_of_range(self):
+        """ Refuse amounts that are not finite or beyond the range of the totals """
+        for query in ('amount=nan', 'amount=inf', 'amount=-inf', 'amount=1e20',
+                      'amount=-1e300', 'amount=0&max_amount=1e30', 'amount=1e400'):
+            resp = self.app.get('/shopcarts/users?' + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        resp = self.app.get('/shopcarts/users?amount=-1e10&max_amount=1e16')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_get_users_by_total_cost_of_shopcart_bad_request(self):
         resp = self.app.get('/shopcarts/users?amount="hello"',
                             content_type='application/json')
@@ -334,6 +519,21 @@ class TestShopcartServer(unittest.TestCase):
         # Delet the test products of same user
         resp = self.app.delete('/shopcarts/{uid}'.format(uid = 1))
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Shopcart.findByUserId(1).count(), 0)
+
+    def test_delete_some_user_products(self):
+        """ Delete a subset of products in Shopcart """
+        Shopcart(user_id=1, product_id=3, quantity=1, price=12.00).save()
+        resp = self.app.delete('/shopcarts/1?product_id=1&product_id=3')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual([entry.product_id for entry in Shopcart.findByUserId(1)], [2])
+
+        resp = self.app.delete('/shopcarts/1?product_id=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for product_id in ('99999999999999999999', '2147483648', '-2147483649'):
+            resp = self.app.delete('/shopcarts/1?product_id=2&product_id=' + product_id)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, product_id)
+        self.assertEqual(Shopcart.findByUserId(1).count(), 1)
 
     def test_reset(self):
         # Add test products in database
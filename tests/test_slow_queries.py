@@ -0,0 +1,167 @@
+"""
+Test cases for the Slow Query Log
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import json
+from collections import deque
+from mock import MagicMock
+from app.model import Shopcart, db
+from app import slow_queries
+from app.service import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    """ Test Cases for the slow query log """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        Shopcart(user_id=1, product_id=1, quantity=1, price=12.00).save()
+        db.session.remove()
+        slow_queries.clear()
+        slow_queries.enabled = True
+        slow_queries.threshold = 0
+        slow_queries.explain_rate = 1
+        slow_queries.parameters = True
+        slow_queries.admin_token = 'secret'
+        self.app = app.test_client()
+
+    def tearDown(self):
+        slow_queries.enabled = False
+        slow_queries.parameters = False
+        slow_queries.admin_token = None
+        slow_queries.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def test_record_slow_queries(self):
+        """ Record the statements of a request with their route and plan """
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual(resp.status_code, 200)
+        queries = slow_queries.dump()
+        self.assertTrue(queries)
+        for query in queries:
+            self.assertEqual(query['route'], 'GET /shopcarts/<int:user_id>')
+            self.assertGreaterEqual(query['duration'], 0)
+        select = [query for query in queries if 'FROM shopcart ' in query['statement']][0]
+        self.assertIn('1', select['parameters'])
+        self.assertTrue(select['plan'])
+        self.assertNotIn('EXPLAIN failed', select['plan'][0])
+
+    def test_redact_parameters(self):
+        """ Keep the parameters of the statements only when asked to """
+        slow_queries.parameters = False
+        self.app.get('/shopcarts/1')
+        self.assertTrue(slow_queries.dump())
+        self.assertEqual([query['parameters'] for query in slow_queries.dump()
+                          if query['parameters'] is not None], [])
+
+    def test_threshold(self):
+        """ Record nothing faster than the threshold """
+        slow_queries.threshold = 60
+        self.app.get('/shopcarts/1')
+        self.assertEqual(slow_queries.dump(), [])
+
+    def test_disabled(self):
+        """ Record nothing when the log is disabled """
+        slow_queries.enabled = False
+        self.app.get('/shopcarts/1')
+        self.assertEqual(slow_queries.dump(), [])
+
+    def test_explain_rate(self):
+        """ Explain none of the statements at a rate of 0 """
+        slow_queries.explain_rate = 0
+        self.app.get('/shopcarts/1')
+        self.assertTrue(slow_queries.dump())
+        self.assertEqual([query['plan'] for query in slow_queries.dump()
+                          if query['plan'] is not None], [])
+
+    def test_bounded_buffer(self):
+        """ Keep only the most recent slow queries """
+        queries = slow_queries.queries
+        slow_queries.queries = deque(maxlen=2)
+        try:
+            for user_id in (1, 2, 3):
+                self.app.get('/shopcarts/{}'.format(user_id))
+            dump = slow_queries.dump()
+            self.assertEqual(len(dump), 2)
+            self.assertIn('3', dump[0]['parameters'])
+        finally:
+            slow_queries.queries = queries
+
+    def test_explain_other_statements(self):
+        """ Leave the statements a plan does not apply to unexplained """
+        with db.engine.connect() as conn:
+            connection = conn.connection
+            self.assertIsNone(slow_queries.explain('sqlite', connection, 'PRAGMA user_version', ()))
+            self.assertIsNone(slow_queries.explain('mysql', connection, 'SELECT 1', ()))
+            plan = slow_queries.explain('sqlite', connection, 'SELECT * FROM missing', ())
+            self.assertTrue(plan[0].startswith('EXPLAIN failed'))
+
+    def test_explain_db2(self):
+        """ Explain a DB2 statement on a connection of its own, by query number """
+        connection = MagicMock()
+        engine = MagicMock()
+        cursor = engine.raw_connection.return_value.cursor.return_value
+        cursor.fetchall.return_value = [(1, 'RETURN', 7.5), (2, 'IXSCAN', 7.5)]
+        plan = slow_queries.explain('ibm_db_sa', connection, 'SELECT 1 FROM shopcart', (),
+                                    engine)
+        self.assertEqual(plan, ['1 RETURN 7.5', '2 IXSCAN 7.5'])
+        self.assertFalse(connection.cursor.called)
+        (explain,), _ = cursor.execute.call_args_list[0]
+        (operators, (queryno, tag)), _ = cursor.execute.call_args_list[1]
+        self.assertIn('SET QUERYNO = {} '.format(queryno), explain)
+        self.assertIn("SET QUERYTAG = '{}' ".format(tag), explain)
+        self.assertIn('S.QUERYNO = ?', operators)
+        self.assertTrue(engine.raw_connection.return_value.rollback.called)
+        self.assertTrue(engine.raw_connection.return_value.close.called)
+        slow_queries.explain('ibm_db_sa', connection, 'SELECT 1 FROM shopcart', (), engine)
+        (_, (next_queryno, _)), _ = cursor.execute.call_args_list[3]
+        self.assertNotEqual(next_queryno, queryno)
+
+    def test_admin_endpoint(self):
+        """ Dump the slow queries at /admin/slow-queries """
+        self.app.get('/shopcarts/1')
+        resp = self.app.get('/admin/slow-queries',
+                            headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['enabled'])
+        self.assertEqual(data['threshold'], 0)
+        self.assertEqual(len(data['queries']), len(slow_queries.dump()))
+        self.assertEqual(data['queries'][0]['route'], 'GET /shopcarts/<int:user_id>')
+
+    def test_admin_endpoint_auth(self):
+        """ Serve /admin/slow-queries only to the bearers of the admin token """
+        resp = self.app.get('/admin/slow-queries')
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.headers['WWW-Authenticate'], 'Bearer')
+        resp = self.app.get('/admin/slow-queries', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(resp.status_code, 401)
+        slow_queries.admin_token = None
+        resp = self.app.get('/admin/slow-queries', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(resp.status_code, 404)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
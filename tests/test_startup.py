@@ -0,0 +1,52 @@
+"""
+Test cases for the Startup Benchmark
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+from benchmarks import startup
+
+# Slack over the ratio of the benchmark, as the rest of the suite loads the machine
+TOLERANCE = 0.5
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+class TestStartup(unittest.TestCase):
+
+    """ Test Cases for the cold start of the service """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cold_start(self):
+        """ Start within the ratio of the benchmark without loading other drivers """
+        database_uri = 'sqlite:///{}'.format(os.path.join(self.directory, 'startup.db'))
+        report = startup.run(runs=3, database_uri=database_uri)
+        self.assertEqual(report['dialects'], [])
+        max_ratio = float(os.getenv('STARTUP_MAX_RATIO', startup.DEFAULT_MAX_RATIO))
+        self.assertIsNone(startup.check(report, max_ratio * (1 + TOLERANCE)))
+
+    def test_check(self):
+        """ Flag a ratio over the maximum or over the baseline """
+        report = {'ratio': 1.5}
+        self.assertIsNone(startup.check(report, 2.0))
+        self.assertIsNone(startup.check(report, 2.0, {'ratio': 1.3}, 0.2))
+        self.assertIsNotNone(startup.check(report, 1.4))
+        self.assertIsNotNone(startup.check(report, 2.0, {'ratio': 1.2}, 0.2))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()